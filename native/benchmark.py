@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmarks for the native messenger.
+
+    latency   per-message round-trip time of a one-shot native_main.py
+              ("cold", what Firefox does today) against native_launcher.py
+              relaying to an already running daemon ("warm").
+    framing   time and peak memory spent reading and writing messages of
+              various sizes through a pipe, with the messenger's framing
+              against the simple read/decode/write it replaced.
+    suite     latency percentiles, throughput and peak RSS of each command
+              with realistic payloads, one-shot and long-lived, as JSON.
+    compare   compare two suite results and flag regressions.
+    startup   what a one-shot messenger costs before it can answer: the
+              modules native_main imports and how long that takes
+              (-X importtime), and the "version" round trip of the script
+              and of the launcher, over bare interpreter start-up. Checked
+              against startup_budget.json.
+
+Example: python3 native/benchmark.py latency -n 50
+         python3 native/benchmark.py suite -o before.json
+         python3 native/benchmark.py suite -o after.json
+         python3 native/benchmark.py compare before.json after.json
+         python3 native/benchmark.py startup
+"""
+
+import argparse
+import json
+import os
+import platform
+import py_compile
+import signal
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NATIVE_MAIN = os.path.join(HERE, "native_main.py")
+NATIVE_LAUNCHER = os.path.join(HERE, "native_launcher.py")
+STARTUP_BUDGET = os.path.join(HERE, "startup_budget.json")
+
+sys.path.insert(0, HERE)
+import native_main  # noqa: E402
+
+
+def frame(message):
+    body = json.dumps(message).encode("utf-8")
+    return struct.pack("@I", len(body)) + body
+
+
+def one_shot(argv, message, env=None):
+    """ Spawn argv, send it a single message and return (seconds, reply) """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        argv, input=frame(message), stdout=subprocess.PIPE, env=env,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    length = struct.unpack("@I", proc.stdout[:4])[0]
+    return elapsed, json.loads(proc.stdout[4:4 + length])
+
+
+def summarise(name, samples):
+    ms = sorted(s * 1000 for s in samples)
+    print(
+        "%-6s n=%-4d min=%7.2fms median=%7.2fms mean=%7.2fms max=%7.2fms"
+        % (
+            name, len(ms), ms[0], statistics.median(ms),
+            statistics.mean(ms), ms[-1],
+        )
+    )
+
+
+def stop_daemon(sock_path):
+    try:
+        with open(sock_path + ".lock") as lock:
+            os.kill(int(lock.read()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+
+
+def legacy_read(stream):
+    """ How native_main.py used to read messages """
+    length = struct.unpack("@I", stream.read(4))[0]
+    return json.loads(stream.read(length).decode("utf-8"))
+
+
+def legacy_write(message, stream):
+    """ How native_main.py used to write messages """
+    content = json.dumps(message).encode("utf-8")
+    stream.write(struct.pack("@I", len(content)))
+    stream.write(content)
+    stream.flush()
+
+
+def framed_writer(stream):
+    writer = native_main.MessageWriter(stream)
+    # No encodeMessage: it'd refuse replies over the browser's limit
+    return lambda message: writer.write(json.dumps(message).encode("utf-8"))
+
+
+def through_pipe(feed, consume):
+    """ Run feed(write_fd) in a thread and consume(read_fd) here.
+    Returns consume's result.
+    """
+    r, w = os.pipe()
+    feeder = threading.Thread(target=lambda: (feed(w), os.close(w)))
+    feeder.start()
+    try:
+        return consume(r)
+    finally:
+        feeder.join()
+        os.close(r)
+
+
+def drain(fd):
+    while os.read(fd, 1 << 20):
+        pass
+
+
+def time_reads(reader, data, n):
+    def feed(w):
+        with open(w, "wb", closefd=False) as stream:
+            for _ in range(n):
+                stream.write(data)
+
+    def consume(r):
+        with open(r, "rb", closefd=False) as stream:
+            read = reader(stream)
+            start = time.perf_counter()
+            for _ in range(n):
+                read()
+            return time.perf_counter() - start
+
+    return through_pipe(feed, consume)
+
+
+def time_writes(writer, message, n):
+    r, w = os.pipe()
+    drainer = threading.Thread(target=drain, args=(r,))
+    drainer.start()
+    try:
+        with open(w, "wb", closefd=False) as stream:
+            write = writer(stream)
+            start = time.perf_counter()
+            for _ in range(n):
+                write(message)
+            elapsed = time.perf_counter() - start
+    finally:
+        os.close(w)
+        drainer.join()
+        os.close(r)
+    return elapsed
+
+
+def peak_read_memory(reader, data):
+    """ Peak bytes allocated while reading one message """
+    def feed(w):
+        with open(w, "wb", closefd=False) as stream:
+            stream.write(data)
+
+    def consume(r):
+        with open(r, "rb", closefd=False) as stream:
+            read = reader(stream)
+            tracemalloc.start()
+            try:
+                read()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    return through_pipe(feed, consume)
+
+
+def framing(args):
+    # Implementations are set up once per stream, like a connection's
+    readers = [
+        ("legacy", lambda stream: lambda: legacy_read(stream)),
+        ("framed", lambda stream: native_main.MessageReader(stream).read),
+    ]
+    writers = [
+        ("legacy", lambda stream: lambda m: legacy_write(m, stream)),
+        ("framed", framed_writer),
+    ]
+    print(
+        "%-8s %-6s %-6s %10s %10s %10s"
+        % ("size", "op", "impl", "ms/msg", "MB/s", "peak MB")
+    )
+    for size in args.sizes:
+        message = {"cmd": "write", "file": "/dev/null", "content": "a" * size}
+        data = frame(message)
+        n = max(3, min(args.n, (64 << 20) // len(data)))
+        megabytes = len(data) * n / 1e6
+        for name, reader in readers:
+            elapsed = time_reads(reader, data, n)
+            peak = peak_read_memory(reader, data) / 1e6
+            print(
+                "%-8d %-6s %-6s %10.3f %10.1f %10.2f"
+                % (size, "read", name, elapsed * 1000 / n,
+                   megabytes / elapsed, peak)
+            )
+        for name, writer in writers:
+            elapsed = time_writes(writer, message, n)
+            print(
+                "%-8d %-6s %-6s %10.3f %10.1f %10s"
+                % (size, "write", name, elapsed * 1000 / n,
+                   megabytes / elapsed, "")
+            )
+
+
+class Messenger:
+    """ A messenger process that messages are sent to one at a time """
+
+    def __init__(self, argv, env=None):
+        self.proc = subprocess.Popen(
+            argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env
+        )
+
+    def send(self, message):
+        self.proc.stdin.write(frame(message))
+        self.proc.stdin.flush()
+
+    def receive(self):
+        """ Replies up to and including the final one """
+        replies = []
+        while not replies or replies[-1].get("more"):
+            header = self.proc.stdout.read(4)
+            if len(header) < 4:
+                raise EOFError("messenger exited")
+            length = struct.unpack("@I", header)[0]
+            replies.append(json.loads(self.proc.stdout.read(length)))
+        return replies
+
+    def peak_rss(self):
+        """ Peak RSS in kB so far, if it can be told """
+        try:
+            with open("/proc/%d/status" % self.proc.pid) as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def close(self):
+        """ Let the messenger exit. Returns its peak RSS in kB. """
+        peak = self.peak_rss()
+        self.proc.stdin.close()
+        self.proc.stdout.read()
+        _, status, usage = os.wait4(self.proc.pid, 0)
+        self.proc.returncode = os.waitstatus_to_exitcode(status)
+        # Without /proc, make do with the rusage, which may count memory
+        # the child had before exec, i.e. ours
+        return peak if peak is not None else usage.ru_maxrss
+
+
+def percentile(ordered, p):
+    """ Nearest-rank percentile of an ordered list """
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def suite_cases(tmp, args, capabilities):
+    """ (name, message, payload bytes) of everything the suite runs """
+    cases = [("version", {"cmd": "version"}, 0)]
+    for size in args.sizes:
+        content = "a" * size
+        path = os.path.join(tmp, "file-%d" % size)
+        with open(path, "w") as f:
+            f.write(content)
+        cases.append((
+            "write-%s" % human(size),
+            {"cmd": "write", "file": os.path.join(tmp, "out"),
+             "content": content},
+            size,
+        ))
+        read = {"cmd": "read", "file": path}
+        if size > 512 * 1024 and "read_range" in capabilities:
+            # Too big for one reply
+            read.update(offset=0, length=size, chunk_size=512 * 1024)
+        cases.append(("read-%s" % human(size), read, size))
+
+    listing = os.path.join(tmp, "dir")
+    os.mkdir(listing)
+    for i in range(args.dir_entries):
+        open(os.path.join(listing, "entry-%06d" % i), "w").close()
+    cases.append((
+        "list_dir-%d" % args.dir_entries,
+        {"cmd": "list_dir", "path": listing},
+        0,
+    ))
+    cases.append(("run", {"cmd": "run", "command": "echo hello"}, 0))
+    cases.append(
+        ("temp", {"cmd": "temp", "content": "a" * 1024, "prefix": "bench"},
+         1024)
+    )
+    return cases
+
+
+def human(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return "%d%s" % (size, unit)
+        size //= 1024
+
+
+def run_case(argv, mode, message, count, env=None):
+    """ Latencies in seconds, replies that were errors, and peak RSS in kB
+    of sending message count times to messengers run with env.
+    """
+    samples = []
+    errors = 0
+    peak = 0
+    messenger = None
+    if mode == "long-lived":
+        # Don't count start-up against the first message
+        messenger = Messenger(argv, env)
+        messenger.send({"cmd": "version"})
+        messenger.receive()
+    try:
+        for _ in range(count):
+            if mode == "one-shot":
+                messenger = Messenger(argv, env)
+            start = time.perf_counter()
+            messenger.send(message)
+            replies = messenger.receive()
+            samples.append(time.perf_counter() - start)
+            if replies[-1].get("cmd") == "error" or replies[-1].get("code"):
+                errors += 1
+            if mode == "one-shot":
+                peak = max(peak, messenger.close())
+    finally:
+        if mode == "long-lived":
+            peak = messenger.close()
+    return samples, errors, peak
+
+
+def suite(args):
+    argv = [sys.executable, args.messenger]
+    probe = Messenger(argv)
+    probe.send({"cmd": "version"})
+    version = probe.receive()[-1]
+    probe.close()
+    capabilities = set(version.get("capabilities") or [])
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # "temp" leaves its files in the messenger's temporary directory
+        env = dict(os.environ, TMPDIR=tmp)
+        for name, message, payload in suite_cases(tmp, args, capabilities):
+            for mode in args.modes:
+                count = args.n if mode == "long-lived" else args.n_one_shot
+                # Don't shovel gigabytes around for the biggest payloads
+                if payload:
+                    count = max(3, min(count, args.budget // payload))
+                samples, errors, peak = run_case(
+                    argv, mode, message, count, env
+                )
+                ms = sorted(sample * 1000 for sample in samples)
+                total = sum(samples)
+                result = {
+                    "case": name,
+                    "mode": mode,
+                    "n": len(ms),
+                    "errors": errors,
+                    "p50_ms": round(percentile(ms, 50), 3),
+                    "p95_ms": round(percentile(ms, 95), 3),
+                    "p99_ms": round(percentile(ms, 99), 3),
+                    "mean_ms": round(statistics.mean(ms), 3),
+                    "messages_per_s": round(len(ms) / total, 1),
+                    "mb_per_s": round(payload * len(ms) / total / 1e6, 1),
+                    "peak_rss_kb": peak,
+                }
+                results.append(result)
+                print(
+                    "%-16s %-10s n=%-4d p50=%8.2fms p95=%8.2fms "
+                    "p99=%8.2fms %8.1f msg/s %7.1f MB/s rss=%6dkB%s"
+                    % (
+                        name, mode, result["n"], result["p50_ms"],
+                        result["p95_ms"], result["p99_ms"],
+                        result["messages_per_s"], result["mb_per_s"],
+                        peak, " errors=%d" % errors if errors else "",
+                    ),
+                    file=sys.stderr,
+                )
+
+    report = {
+        "messenger": os.path.abspath(args.messenger),
+        "version": version.get("version"),
+        "capabilities": sorted(capabilities),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def compare(args):
+    """ Print how each case's latency changed from before to after. Exits
+    with status 1 if any got slower by more than the threshold.
+    """
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    old = {(r["case"], r["mode"]): r for r in before["results"]}
+    print("%s (%s) -> %s (%s)" % (
+        before["messenger"], before["version"],
+        after["messenger"], after["version"],
+    ))
+    regressions = 0
+    for result in after["results"]:
+        key = (result["case"], result["mode"])
+        if key not in old:
+            print("%-16s %-10s new" % key)
+            continue
+        changes = []
+        slower = False
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "peak_rss_kb"):
+            was, now = old[key][metric], result[metric]
+            change = (now - was) / was * 100 if was else 0
+            if (
+                metric == args.metric
+                and change > args.threshold
+                and (metric == "peak_rss_kb" or now - was > args.min_delta)
+            ):
+                slower = True
+            changes.append("%s %+6.1f%%" % (metric, change))
+        regressions += slower
+        print("%-16s %-10s %s%s" % (
+            key + ("  ".join(changes), "  REGRESSION" if slower else "")
+        ))
+    if regressions:
+        sys.exit(1)
+
+
+def latency(args):
+    message = {"cmd": "version"}
+    python = [sys.executable]
+
+    cold = [
+        one_shot(python + [NATIVE_MAIN], message)[0]
+        for _ in range(args.n)
+    ]
+    summarise("cold", cold)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sock_dir = os.path.join(tmp, "sock")
+        os.mkdir(sock_dir, 0o700)
+        sock_path = os.path.join(sock_dir, "native_main.sock")
+        env = dict(os.environ, TRIDACTYL_NATIVE_SOCKET=sock_path)
+        try:
+            first, reply = one_shot(python + [NATIVE_LAUNCHER], message, env)
+            assert "version" in reply, reply
+            print("daemon start-up: %.2fms" % (first * 1000))
+            warm = [
+                one_shot(python + [NATIVE_LAUNCHER], message, env)[0]
+                for _ in range(args.n)
+            ]
+            summarise("warm", warm)
+        finally:
+            stop_daemon(sock_path)
+
+
+def import_times(python, code):
+    """ {module: cumulative microseconds} of the modules imported by
+    python -c code, from -X importtime
+    """
+    proc = subprocess.run(
+        python + ["-X", "importtime", "-c", code],
+        stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+    )
+    times = {}
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def median_ms(samples):
+    return round(statistics.median(samples) * 1000, 2)
+
+
+def startup(args):
+    """ Report start-up costs and exit with status 1 if any is over
+    budget
+    """
+    with open(args.budget) as f:
+        budget = json.load(f)
+    python = [sys.executable, "-S"]
+    message = {"cmd": "version"}
+
+    setup = "import sys; sys.path.insert(0, %r)" % HERE
+    py_compile.compile(NATIVE_MAIN, doraise=True)
+    bare = import_times(python, setup)
+    import_ms = []
+    for _ in range(args.n_imports):
+        times = import_times(python, setup + "; import native_main")
+        import_ms.append(times["native_main"] / 1000)
+    modules = sorted(
+        name for name in times
+        if name not in bare and name != "native_main"
+    )
+
+    interpreter = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        subprocess.run(python + ["-c", "pass"], check=True)
+        interpreter.append(time.perf_counter() - start)
+    env = dict(os.environ, TRIDACTYL_NATIVE_NO_DAEMON="1")
+    script = [
+        one_shot(python + [NATIVE_MAIN], message, env)[0]
+        for _ in range(args.n)
+    ]
+    launcher = [
+        one_shot(python + [NATIVE_LAUNCHER], message, env)[0]
+        for _ in range(args.n)
+    ]
+
+    results = {
+        "import_ms": round(statistics.median(import_ms), 2),
+        "script_overhead_ms": median_ms(script) - median_ms(interpreter),
+        "launcher_overhead_ms": median_ms(launcher) - median_ms(interpreter),
+    }
+    print("interpreter start-up: %7.2fms" % median_ms(interpreter))
+    over = []
+    for name, value in results.items():
+        limit = budget[name]
+        print("%-20s  %7.2fms (budget %.2fms)%s" % (
+            name + ":", value, limit,
+            "  OVER BUDGET" if value > limit else "",
+        ))
+        if value > limit:
+            over.append(name)
+    unexpected = [name for name in modules if name not in budget["modules"]]
+    print("modules imported: %d, unbudgeted: %s" % (
+        len(modules), ", ".join(unexpected) or "none",
+    ))
+    if args.verbose:
+        for name in sorted(modules, key=times.get, reverse=True):
+            print("  %-28s %7.2fms" % (name, times[name] / 1000))
+    if over or unexpected:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = commands.add_parser("latency", help="cold vs. warm message latency")
+    p.add_argument("-n", type=int, default=30, help="messages per path")
+    p.set_defaults(func=latency)
+
+    p = commands.add_parser(
+        "framing", help="message reading and writing throughput"
+    )
+    p.add_argument(
+        "-n", type=int, default=2000,
+        help="messages per size (fewer for big messages)",
+    )
+    p.add_argument(
+        "--sizes", type=int, nargs="+",
+        default=[100, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024],
+        help="message content sizes in bytes",
+    )
+    p.set_defaults(func=framing)
+
+    p = commands.add_parser("suite", help="per-command benchmark suite")
+    p.add_argument(
+        "--messenger", default=NATIVE_MAIN,
+        help="native_main.py to benchmark, e.g. an older version",
+    )
+    p.add_argument(
+        "--modes", nargs="+", default=["one-shot", "long-lived"],
+        choices=["one-shot", "long-lived"],
+    )
+    p.add_argument(
+        "-n", type=int, default=100, help="messages per long-lived case"
+    )
+    p.add_argument(
+        "--n-one-shot", type=int, default=20,
+        help="messages (and processes) per one-shot case",
+    )
+    p.add_argument(
+        "--sizes", type=int, nargs="+",
+        default=[1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024],
+        help="read and write payload sizes in bytes",
+    )
+    p.add_argument(
+        "--dir-entries", type=int, default=10000,
+        help="entries in the directory listed",
+    )
+    p.add_argument(
+        "--budget", type=int, default=200 * 1024 * 1024,
+        help="bytes of payload per case, which limits big payloads' n",
+    )
+    p.add_argument("-o", "--output", help="JSON results file")
+    p.set_defaults(func=suite)
+
+    p = commands.add_parser("compare", help="compare two suite results")
+    p.add_argument("before")
+    p.add_argument("after")
+    p.add_argument(
+        "--metric", default="p50_ms",
+        choices=["p50_ms", "p95_ms", "p99_ms", "peak_rss_kb"],
+        help="what counts as a regression",
+    )
+    p.add_argument(
+        "--threshold", type=float, default=10,
+        help="percentage by which metric may grow",
+    )
+    p.add_argument(
+        "--min-delta", type=float, default=0.1,
+        help="milliseconds by which latencies may grow regardless",
+    )
+    p.set_defaults(func=compare)
+
+    p = commands.add_parser(
+        "startup", help="import and start-up costs against a budget"
+    )
+    p.add_argument("-n", type=int, default=20, help="round trips per path")
+    p.add_argument(
+        "--n-imports", type=int, default=10,
+        help="-X importtime runs, as single runs are noisy",
+    )
+    p.add_argument("--budget", default=STARTUP_BUDGET, help="budget file")
+    p.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="list the modules imported and what each cost",
+    )
+    p.set_defaults(func=startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
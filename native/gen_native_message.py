@@ -1,10 +1,43 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
-import sys
+""" Build native messages for native_main.py, decode its replies and replay
+traces of real traffic against it.
+
+Messages are built from key..value pairs, whose values are strings, and
+key:=json pairs for anything else. Separate messages with "--".
+
+    gen_native_message.py cmd..version | native_main.py
+    gen_native_message.py cmd..list_dir path..~ limit:=20 -- cmd..version \\
+        | native_main.py | gen_native_message.py decode
+
+Traces are recorded by running the messenger with TRIDACTYL_NATIVE_TRACE
+set to a file (and TRIDACTYL_NATIVE_TRACE_REDACT to leave contents out).
+Replaying one runs each recorded connection against its own native_main.py
+at the recorded pace (or --speed times faster, 0 for flat out), checks the
+replies against the recorded ones and reports latencies per command:
+
+    gen_native_message.py replay trace.jsonl --speed 10 --concurrency 8
+
+Replays run the recorded commands and write the recorded files for real
+(with "x"s for contents, if redacted), so they're best done as a throwaway
+user or in a container.
+"""
+
+import argparse
+import collections
+import concurrent.futures
 import json
+import os
+import statistics
 import struct
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NATIVE_MAIN = os.path.join(HERE, "native_main.py")
 
 
 def usage():
@@ -15,6 +48,9 @@ def usage():
     )
 
     sys.stderr.write("\n   - Note: Use '..' as key-value separator")
+    sys.stderr.write(
+        "\n   - Note: Use ':=' for JSON values and '--' between messages"
+    )
     sys.stderr.write(
         "\n   - Example: %s %s %s %s | %s\n"
         % (
@@ -25,27 +61,343 @@ def usage():
             "native_main.py",
         )
     )
+    sys.stderr.write(
+        "\n   - See also: %s decode --help, %s replay --help\n"
+        % (os.path.basename(__file__), os.path.basename(__file__))
+    )
 
     exit(-1)
 
 
-if __name__ == "__main__":
-    """Main functionalities are here for now."""
-    separator = ".."
-    msg = dict()
-    if len(sys.argv) > 1:
-        for i in range(1, len(sys.argv)):
-            key = sys.argv[i].strip().split(separator)[0]
-            val = sys.argv[i].strip().split(separator)[1]
-            msg[key] = val
+def parse_pair(arg):
+    """ (key, value) of a key..value or key:=json argument """
+    arg = arg.strip()
+    string = arg.find("..")
+    typed = arg.find(":=")
+    if typed != -1 and (string == -1 or typed < string):
+        return arg[:typed], json.loads(arg[typed + 2:])
+    if string == -1:
+        raise ValueError("No '..' or ':=' in %r" % arg)
+    key, value = arg.split("..")[:2]
+    return key, value
+
+
+def parse_messages(args):
+    messages = [{}]
+    for arg in args:
+        if arg == "--":
+            messages.append({})
+        else:
+            key, value = parse_pair(arg)
+            messages[-1][key] = value
+    return [message for message in messages if message]
+
+
+def frame(message):
+    body = json.dumps(message).encode("utf-8")
+    return struct.pack("@I", len(body)) + body
+
+
+def read_frames(stream):
+    """ Decode framed messages from a binary stream until it ends """
+    while True:
+        header = stream.read(4)
+        if len(header) < 4:
+            return
+        length = struct.unpack("@I", header)[0]
+        yield json.loads(stream.read(length).decode("utf-8"))
+
+
+def decode(args):
+    for message in read_frames(sys.stdin.buffer):
+        print(json.dumps(message))
+
+
+def load_trace(path):
+    """ The connections of a trace, in order of their first message, as
+    (conn, [(seconds since the start of the trace, message)], [replies])
+    """
+    incoming = collections.OrderedDict()
+    outgoing = collections.defaultdict(list)
+    start = None
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if start is None:
+                start = event["t"]
+            conn = event["conn"]
+            if event["dir"] == "in":
+                # The launcher's introduction doesn't go to native_main.py
+                if event["message"].get("cmd") != "hello":
+                    incoming.setdefault(conn, []).append(
+                        (event["t"] - start, event["message"])
+                    )
+            elif not event["message"].get("more"):
+                outgoing[conn].append(event["message"])
+    return [
+        (conn, messages, outgoing[conn])
+        for conn, messages in incoming.items()
+    ]
+
+
+def replay_connection(argv, messages, start, speed, timeout):
+    """ Send messages to a new messenger at their time (divided by speed)
+    after start. Returns a dict per message with its reply and latency,
+    both None if it never got one.
+    """
+    proc = subprocess.Popen(
+        argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    lock = threading.Lock()
+    by_id = {}
+    in_order = collections.deque()
 
+    def collect():
+        for reply in read_frames(proc.stdout):
+            if reply.get("more"):
+                continue
+            received = time.perf_counter()
+            with lock:
+                if reply.get("id") in by_id:
+                    result = by_id.pop(reply["id"])
+                elif in_order:
+                    result = in_order.popleft()
+                else:
+                    continue
+            result["reply"] = reply
+            result["latency"] = received - result["sent"]
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+    results = []
+    try:
+        for t, message in messages:
+            if speed:
+                delay = start + t / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            result = {"message": message, "reply": None, "latency": None}
+            with lock:
+                if "id" in message:
+                    by_id[message["id"]] = result
+                else:
+                    in_order.append(result)
+            results.append(result)
+            result["sent"] = time.perf_counter()
+            proc.stdin.write(frame(message))
+            proc.stdin.flush()
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    collector.join(timeout)
+    if collector.is_alive():
+        proc.kill()
+        collector.join()
+    proc.wait()
+    return results
+
+
+def differences(recorded, replayed, strict):
+    """ Names of what differs between a recorded and a replayed reply """
+    different = [
+        key for key in ("cmd", "code")
+        if recorded.get(key) != replayed.get(key)
+    ]
+    if ("error" in recorded) != ("error" in replayed):
+        different.append("error")
+    content = recorded.get("content")
+    if (
+        strict
+        and isinstance(content, str)
+        # Redacted
+        and content != "x" * len(content)
+        and content != replayed.get("content")
+    ):
+        different.append("content")
+    return different
+
+
+def verify(results, recorded, strict):
+    """ Compare replies with the recorded ones, matching them up by id or,
+    for messages without one, by order. Returns a list of mismatches.
+    """
+    by_id = {reply["id"]: reply for reply in recorded if "id" in reply}
+    in_order = collections.deque(
+        reply for reply in recorded if "id" not in reply
+    )
+    mismatches = []
+    for result in results:
+        message = result["message"]
+        if "id" in message:
+            expected = by_id.get(message["id"])
+        else:
+            expected = in_order.popleft() if in_order else None
+        if expected is None or result["reply"] is None:
+            continue
+        different = differences(expected, result["reply"], strict)
+        if different:
+            mismatches.append({
+                "cmd": message.get("cmd"),
+                "fields": different,
+                "recorded": expected,
+                "replayed": result["reply"],
+            })
+    return mismatches
+
+
+def percentile(ordered, p):
+    """ Nearest-rank percentile of an ordered list """
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def replay(args):
+    argv = [sys.executable, args.messenger]
+    connections = load_trace(args.trace)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        futures = [
+            pool.submit(
+                replay_connection, argv, messages, start, args.speed,
+                args.timeout,
+            )
+            for _, messages, _ in connections
+        ]
+        replayed = [future.result() for future in futures]
+    wall = time.perf_counter() - start
+
+    latencies = collections.defaultdict(list)
+    unanswered = collections.Counter()
+    errors = collections.Counter()
+    mismatches = []
+    for (_, _, recorded), results in zip(connections, replayed):
+        for result in results:
+            cmd = result["message"].get("cmd")
+            if result["reply"] is None:
+                unanswered[cmd] += 1
+                continue
+            latencies[cmd].append(result["latency"] * 1000)
+            if result["reply"].get("cmd") == "error":
+                errors[cmd] += 1
+        if args.verify:
+            mismatches += verify(results, recorded, args.strict)
+
+    commands = {}
+    for cmd, ms in sorted(latencies.items()):
+        ms.sort()
+        commands[cmd] = {
+            "n": len(ms),
+            "errors": errors[cmd],
+            "unanswered": unanswered[cmd],
+            "p50_ms": round(percentile(ms, 50), 3),
+            "p95_ms": round(percentile(ms, 95), 3),
+            "p99_ms": round(percentile(ms, 99), 3),
+            "max_ms": round(ms[-1], 3),
+            "mean_ms": round(statistics.mean(ms), 3),
+        }
+    for cmd, count in unanswered.items():
+        if cmd not in commands:
+            commands[cmd] = {"n": 0, "errors": 0, "unanswered": count}
+    messages = sum(len(results) for results in replayed)
+    report = {
+        "trace": args.trace,
+        "connections": len(connections),
+        "messages": messages,
+        "wall_s": round(wall, 3),
+        "messages_per_s": round(messages / wall, 1) if wall else None,
+        "commands": commands,
+        "mismatches": mismatches,
+    }
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print(
+            "%d connections, %d messages in %.2fs (%.1f messages/s)"
+            % (len(connections), messages, wall, report["messages_per_s"] or 0)
+        )
+        for cmd, stats in commands.items():
+            if not stats["n"]:
+                print("%-16s unanswered=%d" % (cmd, stats["unanswered"]))
+                continue
+            print(
+                "%-16s n=%-5d p50=%8.2fms p95=%8.2fms p99=%8.2fms "
+                "max=%8.2fms errors=%d unanswered=%d"
+                % (
+                    cmd, stats["n"], stats["p50_ms"], stats["p95_ms"],
+                    stats["p99_ms"], stats["max_ms"], stats["errors"],
+                    stats["unanswered"],
+                )
+            )
+        for mismatch in mismatches[:10]:
+            print(
+                "mismatch in %s (%s): recorded %s, replayed %s"
+                % (
+                    mismatch["cmd"], ", ".join(mismatch["fields"]),
+                    json.dumps(mismatch["recorded"])[:200],
+                    json.dumps(mismatch["replayed"])[:200],
+                )
+            )
+        if len(mismatches) > 10:
+            print("... and %d more mismatches" % (len(mismatches) - 10))
+    if mismatches or unanswered:
+        sys.exit(1)
+
+
+def main():
     if len(sys.argv) == 1:
         usage()
 
-    msg = json.dumps(msg)
-    msg = "\r\n" + msg + "\r\n"
-    msg = msg.encode("utf-8")
-    packed_len = struct.pack("@I", len(msg))
+    if sys.argv[1] not in ("decode", "replay"):
+        try:
+            messages = parse_messages(sys.argv[1:])
+        except ValueError as e:
+            sys.stderr.write("%s\n" % e)
+            usage()
+        sys.stdout.buffer.write(b"".join(map(frame, messages)))
+        sys.stdout.flush()
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser(
+        "decode", help="print framed messages from stdin as JSON lines"
+    )
+    p.set_defaults(func=decode)
+
+    p = commands.add_parser("replay", help="replay a recorded trace")
+    p.add_argument("trace", help="file recorded with TRIDACTYL_NATIVE_TRACE")
+    p.add_argument("--messenger", default=NATIVE_MAIN)
+    p.add_argument(
+        "--speed", type=float, default=1,
+        help="pace relative to the recording; 0 sends as fast as possible",
+    )
+    p.add_argument(
+        "--concurrency", type=int, default=8,
+        help="connections replayed at once",
+    )
+    p.add_argument(
+        "--timeout", type=float, default=30,
+        help="seconds to wait for a connection's last replies",
+    )
+    p.add_argument(
+        "--no-verify", dest="verify", action="store_false",
+        help="don't compare replies with the recorded ones",
+    )
+    p.add_argument(
+        "--strict", action="store_true",
+        help="compare unredacted contents too",
+    )
+    p.add_argument("--json", action="store_true", help="report as JSON")
+    p.set_defaults(func=replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
 
-    sys.stdout.buffer.write(packed_len + msg)
-    sys.stdout.flush()
+if __name__ == "__main__":
+    main()
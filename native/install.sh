@@ -11,6 +11,10 @@ sedEscape() {
 }
 
 # To install, curl -fsSl 'url to this script' | sh
+#
+# Firefox is pointed at native_launcher.py, which runs native_main.py from
+# precompiled bytecode. Set TRIDACTYL_NATIVE_DAEMON=1 to have the launcher keep
+# a resident native_main.py around instead of starting Python for every message.
 
 run() {
     set -e
@@ -21,6 +25,7 @@ run() {
     # Use argument as version or 1.15.0, as that was the last version before we switched to using tags
     manifest_loc="https://raw.githubusercontent.com/tridactyl/tridactyl/${1:-1.15.0}/native/tridactyl.json"
     native_loc="https://raw.githubusercontent.com/tridactyl/tridactyl/${1:-1.15.0}/native/native_main.py"
+    launcher_loc="https://raw.githubusercontent.com/tridactyl/tridactyl/${1:-1.15.0}/native/native_launcher.py"
 
     # Decide where to put the manifest based on OS
     # Get OSTYPE from bash if it's installed. If it's not, then this will
@@ -44,6 +49,9 @@ run() {
     manifest_file="$manifest_home/tridactyl.json"
     native_file="$XDG_DATA_HOME/native_main.py.new"
     native_file_final="$XDG_DATA_HOME/native_main.py"
+    launcher_file="$XDG_DATA_HOME/native_launcher.py.new"
+    launcher_file_final="$XDG_DATA_HOME/native_launcher.py"
+    manifest_target="$launcher_file_final"
 
     echo "Installing manifest here: $manifest_home"
     echo "Installing script here: XDG_DATA_HOME: $XDG_DATA_HOME"
@@ -53,9 +61,13 @@ run() {
     if [ "$1" = "local" ]; then
         cp -f native/tridactyl.json "$manifest_file"
         cp -f native/native_main.py "$native_file"
+        cp -f native/native_launcher.py "$launcher_file"
     else
         curl -sS --create-dirs -o "$manifest_file" "$manifest_loc"
         curl -sS --create-dirs -o "$native_file" "$native_loc"
+        # Versions before the launcher only have native_main.py
+        curl -fsS --create-dirs -o "$launcher_file" "$launcher_loc" 2>/dev/null \
+            || rm -f "$launcher_file"
     fi
 
     if [ ! -f "$manifest_file" ] ; then
@@ -68,14 +80,41 @@ run() {
         exit 1
     fi
 
-    sed -i.bak "s/REPLACE_ME_WITH_SED/$(sedEscape "$native_file_final")/" "$manifest_file"
+    if [ ! -f "$launcher_file" ] ; then
+        if [ -n "$TRIDACTYL_NATIVE_DAEMON" ]; then
+            echoerr "Failed to create '$launcher_file'. Please make sure that the directories exist and that you have the necessary permissions."
+            exit 1
+        fi
+        manifest_target="$native_file_final"
+    fi
+
+    sed -i.bak "s/REPLACE_ME_WITH_SED/$(sedEscape "$manifest_target")/" "$manifest_file"
     chmod +x "$native_file"
 
     # Requirements for native messenger
     python_path=$(command -v python3) || python_path=""
     if [ -x "$python_path" ]; then
-        sed -i.bak "1s/.*/#!$(sedEscape /usr/bin/env) $(sedEscape "$python_path")/" "$native_file"
+        # The messenger only needs the standard library, so skip site (-S),
+        # which saves a few milliseconds per message. That takes naming the
+        # interpreter directly, which only works if it isn't itself a
+        # script, as e.g. pyenv's shims are.
+        if [ "$(head -c 2 "$python_path")" = "#!" ]; then
+            shebang="#!$(sedEscape /usr/bin/env) $(sedEscape "$python_path")"
+        else
+            shebang="#!$(sedEscape "$python_path") -S"
+        fi
+        sed -i.bak "1s/.*/$shebang/" "$native_file"
         mv "$native_file" "$native_file_final"
+        # Precompile native_main.py for the launcher, which imports it
+        "$python_path" -m py_compile "$native_file_final" || true
+        if [ -f "$launcher_file" ]; then
+            chmod +x "$launcher_file"
+            sed -i.bak "1s/.*/$shebang/" "$launcher_file"
+            if [ -z "$TRIDACTYL_NATIVE_DAEMON" ]; then
+                sed -i.bak "s/^USE_DAEMON = True$/USE_DAEMON = False/" "$launcher_file"
+            fi
+            mv "$launcher_file" "$launcher_file_final"
+        fi
     else
         echoerr "Error: Python 3 must exist in PATH."
         echoerr "Please install it and run this script again."
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Thin front end for native_main.py.
+
+Firefox starts a fresh process for every one-shot native message. Instead of
+paying for a full native_main.py start-up each time, this launcher connects to
+a resident native_main.py daemon on a per-user Unix socket (starting it on
+demand) and relays Firefox's pipes to it byte for byte. The daemon exits by
+itself once it has been idle for a while.
+
+Only builtin modules are imported on the fast path. Wherever a daemon can't be
+used (no AF_UNIX, unsafe socket directory, TRIDACTYL_NATIVE_NO_DAEMON set) the
+launcher runs native_main.py in-process instead.
+
+A daemon keeps the environment and working directory it was started with, so
+launchers only share one if theirs are the same: the socket's name includes a
+hash of both. A browser started with, say, a different DISPLAY gets a daemon
+of its own, and the old one exits once it's idle.
+
+install.sh always installs the launcher, but sets USE_DAEMON to False unless
+asked for the daemon. It is still worth going through: Python compiles a
+script it is given on the command line every time it starts, whereas an
+imported native_main.py is loaded from the bytecode that install.sh
+precompiled.
+"""
+
+import os
+import sys
+import time
+
+# Rewritten by install.sh
+USE_DAEMON = True
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NATIVE_MAIN = os.path.join(HERE, "native_main.py")
+
+# How long to wait for a freshly spawned daemon to start listening
+DAEMON_START_TIMEOUT = 5.0
+
+
+def environment_key():
+    """ Short hash of our environment and working directory """
+    try:
+        # hashlib takes longer to import than the rest of the launcher
+        from _blake2 import blake2b
+    except ImportError:
+        from hashlib import blake2b
+
+    key = blake2b(os.fsencode(os.getcwd()), digest_size=8)
+    for name, value in sorted(os.environb.items()):
+        key.update(b"\0" + name + b"=" + value)
+    return key.hexdigest()
+
+
+def socket_path():
+    """ Per-user path of the daemon for our environment """
+    override = os.environ.get("TRIDACTYL_NATIVE_SOCKET")
+    if override:
+        return override
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        base = os.path.join(runtime_dir, "tridactyl")
+    else:
+        base = os.path.join(
+            os.environ.get("TMPDIR") or "/tmp",
+            "tridactyl-%d" % os.getuid(),
+        )
+    return os.path.join(base, "native_main-%s.sock" % environment_key())
+
+
+def private_dir(path):
+    """ Create the socket directory if needed and check that nobody else
+    can get at it. Returns False if it's not safe to use.
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def connect(path):
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def spawn_daemon(path):
+    """ Start native_main.py --daemon fully detached from Firefox's pipes """
+    if os.fork() != 0:
+        return
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        # Keep flags such as -S from the launcher's shebang
+        flags = ["-S"] if sys.flags.no_site else []
+        os.execv(
+            sys.executable,
+            [sys.executable] + flags + [NATIVE_MAIN, "--daemon", path],
+        )
+    finally:
+        os._exit(127)
+
+
+def daemon_connection():
+    """ Connect to the daemon, starting it if necessary """
+    path = socket_path()
+    if not private_dir(os.path.dirname(path)):
+        return None
+    sock = connect(path)
+    if sock is not None:
+        return sock
+    spawn_daemon(path)
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.005)
+        sock = connect(path)
+        if sock is not None:
+            return sock
+    return None
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def hello():
+    """ The message introducing us to the daemon. It's our parent, not the
+    daemon's, that is the browser.
+    """
+    body = ('{"cmd": "hello", "ppid": %d}' % os.getppid()).encode()
+    return len(body).to_bytes(4, sys.byteorder) + body
+
+
+def relay(sock):
+    """ Shovel bytes between our stdio and the daemon until it hangs up """
+    import select
+    import socket
+
+    stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+    readers = [stdin, sock]
+    while True:
+        ready = select.select(readers, [], [])[0]
+        if stdin in ready:
+            data = os.read(stdin, 65536)
+            if data:
+                sock.sendall(data)
+            else:
+                sock.shutdown(socket.SHUT_WR)
+                readers.remove(stdin)
+        if sock in ready:
+            data = sock.recv(65536)
+            if not data:
+                return
+            write_all(stdout, data)
+
+
+def run_inline():
+    sys.path.insert(0, HERE)
+    import native_main
+
+    native_main.main()
+
+
+def main():
+    sock = None
+    if USE_DAEMON and not os.environ.get("TRIDACTYL_NATIVE_NO_DAEMON"):
+        # Imported here as socket alone takes longer to import than
+        # native_main does
+        import socket
+
+        if hasattr(socket, "AF_UNIX") and hasattr(os, "fork"):
+            sock = daemon_connection()
+    if sock is None:
+        run_inline()
+        return
+    try:
+        sock.sendall(hello())
+        relay(sock)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
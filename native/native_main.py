@@ -1,21 +1,122 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# Only modules that are cheap to import, or that json and threading load
+# anyway, are imported here. Anything else is imported by the functions
+# that need it, so that short-lived messengers answering "version" or
+# "env" don't pay for subprocess, pathlib and friends. Keep it that way:
+# "benchmark.py startup" checks the modules imported at start-up against
+# startup_budget.json.
+import collections
 import json
 import os
-import pathlib
 import re
-import shutil
-import struct
-import subprocess
 import sys
-import tempfile
+import threading
 import time
-import unicodedata
 
-DEBUG = False
 VERSION = "0.1.11"
 
+# Version of the persistent-port protocol: every message may carry an "id"
+# which is echoed in its reply, so that many requests can be in flight on
+# one runtime.connectNative port.
+PROTOCOL_VERSION = 1
+
+# Advertised in the "version" reply so the extension can pick features
+# without relying on version numbers.
+CAPABILITIES = [
+    "port",
+    "concurrent",
+    "run_stream",
+    "read_range",
+    "batch",
+    "which_many",
+    "edit",
+    "proc_cmdline",
+    "list_dir_v2",
+    "find_files",
+    "stats",
+    "run_async",
+    "run_v2",
+    "write_v2",
+    "detect_profile",
+    "clipboard",
+    "env_many",
+    "watch_config",
+]
+
+# Messages carrying an id are handled concurrently by up to this many worker
+# threads per connection; at most TRIDACTYL_NATIVE_QUEUE more wait for a free
+# worker before we stop reading from the browser.
+MAX_WORKERS = int(os.environ.get("TRIDACTYL_NATIVE_WORKERS") or 4)
+MAX_QUEUED = int(os.environ.get("TRIDACTYL_NATIVE_QUEUE") or 32)
+
+# Upper bound on the bytes of output or file content carried by one partial
+# reply. The browser rejects messages from native applications bigger than
+# 1MB, and JSON escaping can blow up a byte to six.
+MAX_STREAM_CHUNK = 128 * 1024
+
+# Largest message accepted from the browser, in bytes. Bigger ones are
+# skipped and answered with an error.
+MAX_MESSAGE_SIZE = int(
+    os.environ.get("TRIDACTYL_NATIVE_MAX_MESSAGE") or 64 * 1024 * 1024
+)
+
+# The browser's limit on the size of messages from native applications
+MAX_REPLY_SIZE = 1024 * 1024
+
+# Size of the buffer each connection reads messages into. Bigger messages
+# get a throwaway one.
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Log an event per message handled and child process run to this file
+# ("1" for ~/.tridactyl/native_main.log), as JSON lines. The log is written
+# LOG_BUFFER events at a time and rotated once it reaches LOG_MAX_BYTES,
+# keeping LOG_BACKUPS old ones.
+LOG_FILE = os.environ.get("TRIDACTYL_NATIVE_LOG")
+LOG_MAX_BYTES = int(
+    os.environ.get("TRIDACTYL_NATIVE_LOG_MAX_BYTES") or 1024 * 1024
+)
+LOG_BACKUPS = 2
+LOG_BUFFER = 64
+
+# Append every message received and sent to this file, for replay with
+# gen_native_message.py. TRIDACTYL_NATIVE_TRACE_REDACT leaves file
+# contents and command output out.
+TRACE_FILE = os.environ.get("TRIDACTYL_NATIVE_TRACE")
+TRACE_REDACT = bool(os.environ.get("TRIDACTYL_NATIVE_TRACE_REDACT"))
+
+# Seconds between checks of watched config files when inotify isn't
+# available. With inotify it only bounds how long a stopped watch takes to
+# notice.
+POLL_INTERVAL = float(os.environ.get("TRIDACTYL_NATIVE_POLL_INTERVAL") or 2)
+
+# Seconds a resident daemon (see native_launcher.py) waits without any
+# connection before exiting.
+DAEMON_IDLE_TIMEOUT = float(
+    os.environ.get("TRIDACTYL_NATIVE_IDLE_TIMEOUT") or 300
+)
+
+# Commands started by run_async each get a directory under JOBS_DIR holding
+# the job's description, output and exit status. At most JOB_MAX_OUTPUT
+# bytes of output are kept per job, unless the message asks for another
+# limit. Finished jobs are removed JOB_KEEP seconds after they finished, or
+# earlier once there are more than MAX_FINISHED_JOBS of them.
+JOBS_DIR = os.path.join(os.path.expanduser("~"), ".tridactyl", "jobs")
+JOB_MAX_OUTPUT = 4 * 1024 * 1024
+JOB_KEEP = 3600
+MAX_FINISHED_JOBS = 32
+
+# How long a job may go without its supervisor recording the command's pid
+# before it's considered lost
+JOB_START_TIMEOUT = 10
+
+# Chunked writes (write_begin, write_chunk, write_commit) keep their state
+# in UPLOADS_DIR, so that they work across one-shot messengers too.
+# Sessions not committed within UPLOAD_KEEP seconds are thrown away.
+UPLOADS_DIR = os.path.join(os.path.expanduser("~"), ".tridactyl", "uploads")
+UPLOAD_KEEP = 24 * 3600
+
 
 class NoConnectionError(Exception):
     """ Exception thrown when stdin cannot be read """
@@ -25,12 +126,207 @@ def is_command_on_path(command):
     """ Returns 'True' if the if the specified command is found on
         user's $PATH.
     """
+    import shutil
+
     if shutil.which(command):
         return True
     else:
         return False
 
 
+# Listings of $PATH directories, with the mtime they were read at
+PATH_LISTINGS = {}
+PATH_LISTINGS_LOCK = threading.Lock()
+
+
+def path_listing(directory):
+    """ Names in a directory on $PATH, cached until the directory changes """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return frozenset()
+    with PATH_LISTINGS_LOCK:
+        cached = PATH_LISTINGS.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        names = frozenset(os.listdir(directory))
+    except OSError:
+        names = frozenset()
+    with PATH_LISTINGS_LOCK:
+        PATH_LISTINGS[directory] = (mtime, names)
+    return names
+
+
+def which_many(commands):
+    """ Look up many commands on the user's $PATH at once.
+
+    Returns a list of {"command", "index", "path"} for the commands that
+    were found, in the order they were given, with the absolute path
+    shutil.which would have picked. $PATH is scanned once, using cached
+    directory listings, rather than once per command.
+    """
+    import shutil
+
+    if os.name != "posix":
+        # Leave PATHEXT and friends to shutil
+        found = ((c, shutil.which(c)) for c in commands)
+    else:
+        directories = [
+            d for d in os.environ.get("PATH", os.defpath).split(os.pathsep)
+            if d
+        ]
+        listings = [(d, path_listing(d)) for d in directories]
+
+        def lookup(command):
+            if os.sep in command:
+                candidates = [os.path.expanduser(command)]
+            else:
+                candidates = [
+                    os.path.join(d, command)
+                    for d, names in listings if command in names
+                ]
+            for candidate in candidates:
+                if (
+                    os.access(candidate, os.X_OK)
+                    and not os.path.isdir(candidate)
+                ):
+                    return os.path.abspath(candidate)
+            return None
+
+        found = ((c, lookup(c)) for c in commands)
+
+    return [
+        {"command": command, "index": index, "path": path}
+        for index, (command, path) in enumerate(found)
+        if path is not None
+    ]
+
+
+# Seconds to give a clipboard tool, which may hang waiting on the display
+CLIPBOARD_TIMEOUT = 5
+
+# Detected clipboard tools, by the environment they were detected in
+CLIPBOARD_BACKENDS = {}
+CLIPBOARD_BACKENDS_LOCK = threading.Lock()
+
+
+def clipboard_backend():
+    """ The clipboard tool to use, as (name, {command: path}), or None.
+
+    Wayland's wl-copy is preferred where there's a Wayland display, then
+    xsel and xclip where there's an X one, and pbcopy on macOS. Looked up
+    once per $PATH and display, so a long-lived messenger doesn't search
+    again for every yank.
+    """
+    key = (
+        os.environ.get("PATH"),
+        os.environ.get("WAYLAND_DISPLAY"),
+        os.environ.get("DISPLAY"),
+    )
+    with CLIPBOARD_BACKENDS_LOCK:
+        if key in CLIPBOARD_BACKENDS:
+            return CLIPBOARD_BACKENDS[key]
+    candidates = []
+    if key[1]:
+        candidates.append(("wl-copy", ["wl-copy", "wl-paste"]))
+    if key[2]:
+        candidates += [("xsel", ["xsel"]), ("xclip", ["xclip"])]
+    if sys.platform == "darwin":
+        candidates.append(("pbcopy", ["pbcopy", "pbpaste"]))
+    found = {
+        result["command"]: result["path"]
+        for result in which_many(
+            [command for _, commands in candidates for command in commands]
+        )
+    }
+    backend = None
+    for name, commands in candidates:
+        if all(command in found for command in commands):
+            backend = (name, {command: found[command] for command in commands})
+            break
+    with CLIPBOARD_BACKENDS_LOCK:
+        CLIPBOARD_BACKENDS[key] = backend
+    return backend
+
+
+def clipboard_argv(backend, action, selection):
+    """ The command line that gets or sets selection, "primary" or
+    "clipboard", with backend
+    """
+    name, paths = backend
+    primary = selection == "primary"
+    if name == "wl-copy":
+        if action == "get":
+            argv = [paths["wl-paste"], "--no-newline"]
+        else:
+            argv = [paths["wl-copy"]]
+        return argv + (["--primary"] if primary else [])
+    if name == "xsel":
+        return [
+            paths["xsel"], "-o" if action == "get" else "-i",
+            "-p" if primary else "-b",
+        ]
+    if name == "xclip":
+        return [
+            paths["xclip"], "-o" if action == "get" else "-i",
+            "-selection", selection,
+        ]
+    # macOS has no primary selection
+    return [paths["pbpaste" if action == "get" else "pbcopy"]]
+
+
+def clipboard(message):
+    """Handle 'clipboard' message.
+
+    Gets (action "get") or sets (action "set", to content) the primary
+    selection or, with selection "clipboard", the clipboard, using the
+    tool clipboard_backend picks. The tool is run directly, without a
+    shell, and gets the content on its stdin. It is killed after timeout
+    seconds (CLIPBOARD_TIMEOUT by default) or when cancelled, as for 'run'.
+    The reply names the tool and has the argv it was run with.
+    """
+    import subprocess
+
+    backend = clipboard_backend()
+    if backend is None:
+        raise FileNotFoundError("Couldn't find an external clipboard tool")
+    action = message["action"]
+    if action not in ("get", "set"):
+        raise ValueError("Unknown clipboard action: %r" % action)
+    argv = clipboard_argv(
+        backend, action, message.get("selection", "primary")
+    )
+    start = time.perf_counter()
+    get = action == "get"
+    p = subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL if get else subprocess.PIPE,
+        # When setting, the tool may leave a child behind to own the
+        # selection, which would hold on to a pipe on stdout
+        stdout=subprocess.PIPE if get else subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=(os.name == "posix"),
+    )
+    output, code, reason = collect(
+        p,
+        message,
+        b"" if get else message.get("content", "").encode("utf-8"),
+        default_timeout=CLIPBOARD_TIMEOUT,
+    )
+    METRICS.child("clipboard", time.perf_counter() - start, code)
+    reply = {
+        "cmd": "clipboard",
+        "code": code,
+        "content": output.decode("utf-8", "replace"),
+        "backend": backend[0],
+        "argv": argv,
+    }
+    if reason is not None:
+        reply[reason] = True
+    return reply
+
+
 def eprint(*args, **kwargs):
     """ Print to stderr, which gets echoed in the browser console
         when run by Firefox
@@ -43,66 +339,231 @@ def getenv(variable, default):
     return os.environ.get(variable) or default
 
 
-def getMessage():
-    """Read a message from stdin and decode it.
+def env_many(message):
+    """Handle 'env_many' and 'env_snapshot' messages.
+
+    env_many replies with the variables named in vars, null where unset.
+    env_snapshot replies with every variable whose name matches one of the
+    shell patterns in match (by default, all of them). Either expands the
+    ~ and $VARIABLEs in the path templates in paths, too.
+    """
+    if message["cmd"] == "env_many":
+        content = {name: os.environ.get(name) for name in message["vars"]}
+    else:
+        import fnmatch
+
+        patterns = message.get("match") or ["*"]
+        content = {
+            name: value for name, value in os.environ.items()
+            if any(fnmatch.fnmatchcase(name, p) for p in patterns)
+        }
+    reply = {"cmd": message["cmd"], "code": 0, "content": content}
+    if "paths" in message:
+        reply["paths"] = [
+            os.path.expandvars(os.path.expanduser(path))
+            for path in message["paths"]
+        ]
+    return reply
+
+
+class MessageTooLargeError(Exception):
+    pass
+
+
+# The id at the very start of a message body, where src/lib/native.ts puts
+# it, so that a message that can't be parsed can still be answered
+LEADING_ID = re.compile(r'\s*\{\s*"id"\s*:\s*(\d+)')
+
+
+def leading_id(body):
+    """ The id at the start of a message body, if there is one """
+    if not isinstance(body, str):
+        body = bytes(body[:64]).decode("ascii", "replace")
+    match = LEADING_ID.match(body)
+    return int(match.group(1)) if match else None
+
+
+class MessageReader:
+    """ Reads messages off a binary stream (stdin by default).
 
     "Each message is serialized using JSON, UTF-8 encoded and is preceded with
     a 32-bit value containing the message length in native byte order."
 
     https://developer.mozilla.org/en-US/Add-ons/WebExtensions/Native_messaging#App_side
 
+    Bodies up to READ_BUFFER_SIZE are read into a reused buffer and
+    decoded straight out of it. Bigger ones are read into a throwaway bytes
+    object, which unlike a bigger buffer needn't be zeroed first. Either way
+    it's gone by the time the decoded text gets parsed.
     """
-    rawLength = sys.stdin.buffer.read(4)
-    if len(rawLength) == 0:
-        sys.exit(0)
-    messageLength = struct.unpack("@I", rawLength)[0]
-    message = sys.stdin.buffer.read(messageLength).decode("utf-8")
-    return json.loads(message)
 
+    def __init__(self, stream=None):
+        self.stream = sys.stdin.buffer if stream is None else stream
+        self.header = memoryview(bytearray(4))
+        self.buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        # Of the last message read
+        self.size = 0
+        # Of the last message that couldn't be read, if known
+        self.failed_id = None
+
+    def fill(self, view):
+        """ Read into all of view unless the stream ends first. Returns the
+        number of bytes read.
+        """
+        done = self.stream.readinto(view) or 0
+        while done < len(view):
+            count = self.stream.readinto(view[done:])
+            if not count:
+                break
+            done += count
+        return done
+
+    def skip(self, length):
+        first = True
+        while length > 0:
+            count = self.fill(self.buffer[:length])
+            if not count:
+                raise NoConnectionError
+            if first:
+                self.failed_id = leading_id(self.buffer[:count])
+                first = False
+            length -= count
+
+    def text(self, length):
+        """ The next length bytes, decoded """
+        if length > len(self.buffer):
+            body = self.stream.read(length)
+        else:
+            body = self.buffer[:length]
+            if self.fill(body) < length:
+                body = b""
+        if len(body) < length:
+            eprint("Connection closed in the middle of a message")
+            raise NoConnectionError
+        return str(body, "utf-8")
+
+    def read(self):
+        """ The next message.
+
+        Raises NoConnectionError once the other end has gone away, and
+        MessageTooLargeError (having skipped the message) for messages over
+        MAX_MESSAGE_SIZE. If it can, sets failed_id to the id of a message
+        that is too large or isn't valid JSON.
+        """
+        self.failed_id = None
+        count = self.fill(self.header)
+        if count < 4:
+            if count:
+                eprint("Connection closed in the middle of a message header")
+            raise NoConnectionError
+        length = int.from_bytes(self.header, sys.byteorder)
+        if length > MAX_MESSAGE_SIZE:
+            self.skip(length)
+            raise MessageTooLargeError(
+                "Message of {} bytes is over the limit of {} bytes".format(
+                    length, MAX_MESSAGE_SIZE
+                )
+            )
+        self.size = length
+        try:
+            text = self.text(length)
+        except UnicodeDecodeError as e:
+            self.failed_id = leading_id(e.object)
+            raise
+        try:
+            return json.loads(text)
+        except ValueError:
+            self.failed_id = leading_id(text)
+            raise
 
-# Encode a message for transmission,
-# given its content.
-def encodeMessage(messageContent):
-    """ Encode a message for transmission, given its content."""
-    encodedContent = json.dumps(messageContent).encode("utf-8")
-    encodedLength = struct.pack("@I", len(encodedContent))
-    return {"length": encodedLength, "content": encodedContent}
 
+class MessageWriter:
+    """ Writes messages encoded by encodeMessage to a binary stream (stdout
+    by default), header and body in a single system call where possible.
+    """
 
-# Send an encoded message to stdout
-def sendMessage(encodedMessage):
-    """ Send an encoded message to stdout."""
-    sys.stdout.buffer.write(encodedMessage["length"])
-    sys.stdout.buffer.write(encodedMessage["content"])
-    try:
-        sys.stdout.buffer.write(encodedMessage["code"])
-    except KeyError:
-        pass
+    def __init__(self, stream=None):
+        self.stream = sys.stdout.buffer if stream is None else stream
+        self.fd = None
+        if hasattr(os, "writev"):
+            try:
+                self.fd = self.stream.fileno()
+            except (AttributeError, OSError):
+                pass
+            else:
+                # Don't let anything already buffered end up after us
+                self.stream.flush()
+
+    def write(self, encoded):
+        header = len(encoded).to_bytes(4, sys.byteorder)
+        if self.fd is None:
+            self.stream.write(header)
+            self.stream.write(encoded)
+            self.stream.flush()
+            return
+        parts = [header, memoryview(encoded)]
+        while parts:
+            written = os.writev(self.fd, parts)
+            while parts and written >= len(parts[0]):
+                written -= len(parts.pop(0))
+            if parts:
+                parts[0] = memoryview(parts[0])[written:]
+
+
+def getMessage(stream=None):
+    """ Read one message from stdin (or the given binary stream).
+    Connections use a MessageReader, which reuses its buffer.
+    """
+    return MessageReader(stream).read()
 
-    sys.stdout.buffer.flush()
 
+def encodeMessage(messageContent):
+    """ Encode a message for transmission, given its content.
 
-def findUserConfigFile():
-    """ Find a user config file, if it exists. Return the file path, or None
-    if not found
+    Replies bigger than the browser accepts are turned into error replies,
+    keeping their id so that the request doesn't go unanswered.
     """
+    encoded = json.dumps(messageContent).encode("utf-8")
+    if len(encoded) > MAX_REPLY_SIZE:
+        error = {
+            "cmd": "error",
+            "error": "Reply of {} bytes is over the browser's limit of {}"
+            " bytes".format(len(encoded), MAX_REPLY_SIZE),
+        }
+        if "id" in messageContent:
+            error["id"] = messageContent["id"]
+        encoded = json.dumps(error).encode("utf-8")
+    return encoded
+
+
+def sendMessage(encodedMessage, stream=None):
+    """ Send an encoded message to stdout (or the given binary stream)."""
+    MessageWriter(stream).write(encodedMessage)
+
+
+def configCandidates():
+    """ Paths a user config file may be found at, in order of preference """
     home = os.path.expanduser("~")
     config_dir = getenv(
         "XDG_CONFIG_HOME", os.path.join(home, ".config")
     )
 
-    # Will search for files in this order
-    candidate_files = [
+    return [
         os.path.join(config_dir, "tridactyl", "tridactylrc"),
         os.path.join(home, ".tridactylrc"),
         os.path.join(home, "_config", "tridactyl", "tridactylrc"),
         os.path.join(home, "_tridactylrc"),
     ]
 
+
+def findUserConfigFile():
+    """ Find a user config file, if it exists. Return the file path, or None
+    if not found
+    """
     config_path = None
 
     # find the first path in the list that exists
-    for path in candidate_files:
+    for path in configCandidates():
         if os.path.isfile(path):
             config_path = path
             break
@@ -110,7 +571,17 @@ def findUserConfigFile():
     return config_path
 
 
+# Config files read, by path: (mtime, size, content)
+CONFIG_CACHE = {}
+CONFIG_CACHE_LOCK = threading.Lock()
+
+
 def getUserConfig():
+    """ Return (path, mtime, size, content) of the user config file, or
+    None.
+
+    The content is only read again if the file's mtime or size changed.
+    """
     # look it up freshly each time - the user could have moved or killed it
     cfg_file = findUserConfigFile()
 
@@ -118,15 +589,178 @@ def getUserConfig():
     if not cfg_file:
         return None
 
-    # for now, this is a simple file read, but if the files can
-    # include other files, that will need more work
-    return open(cfg_file, "r", encoding="utf-8").read()
+    st = os.stat(cfg_file)
+    with CONFIG_CACHE_LOCK:
+        cached = CONFIG_CACHE.get(cfg_file)
+    if cached is None or cached[:2] != (st.st_mtime, st.st_size):
+        # for now, this is a simple file read, but if the files can
+        # include other files, that will need more work
+        with open(cfg_file, "r", encoding="utf-8") as file:
+            content = file.read()
+        cached = (st.st_mtime, st.st_size, content)
+        with CONFIG_CACHE_LOCK:
+            CONFIG_CACHE[cfg_file] = cached
+    return (cfg_file,) + cached
+
+
+def file_signature(path):
+    """ What we compare to tell whether a watched file changed """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class Inotify:
+    """ Just enough of inotify(7), through ctypes, to wait for changes in a
+    set of directories.
+    """
+
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    # | IN_CREATE | IN_DELETE
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = set()
+
+    def add(self, directory):
+        """ Watch directory too. Directories that don't exist (yet) are
+        left to polling until a later add() finds them.
+        """
+        if directory not in self.directories and self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), self.MASK
+        ) >= 0:
+            self.directories.add(directory)
+
+    def wait(self, timeout):
+        """ Wait until something happens or timeout seconds pass """
+        import select
+
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher:
+    """ Watches a connection's config files on a thread of its own, so that
+    a watch doesn't tie up one of the connection's workers for as long as
+    it lasts.
+
+    Every watch_config adds its files to the same set and all of them are
+    waited on through one inotify fd on Linux; elsewhere, or if that fails,
+    they are polled every POLL_INTERVAL seconds. Each change is pushed to
+    the browser as a message without an id:
+
+        {"cmd": "configchanged", "path": ..., "exists": bool,
+         "config": findUserConfigFile()}
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.lock = threading.Lock()
+        # Watched paths and their file_signature when last checked
+        self.signatures = {}
+        self.stopped = None
+        self.notifier = None
+
+    def watch(self, files):
+        """ Watch every candidate config path plus files (e.g. files the
+        config sources) until stop()
+        """
+        paths = configCandidates() + [
+            os.path.expandvars(os.path.expanduser(f)) for f in files
+        ]
+        with self.lock:
+            if self.stopped is None:
+                self.stopped = threading.Event()
+                self.notifier = None
+                if sys.platform.startswith("linux"):
+                    try:
+                        self.notifier = Inotify()
+                    except (OSError, AttributeError):
+                        pass
+                threading.Thread(
+                    target=self.run, args=(self.stopped, self.notifier),
+                    name="config-watcher", daemon=True,
+                ).start()
+            for path in paths:
+                if path not in self.signatures:
+                    self.signatures[path] = file_signature(path)
+                    if self.notifier:
+                        self.notifier.add(os.path.dirname(path))
+            return {
+                "paths": list(self.signatures),
+                "backend": "inotify" if self.notifier else "poll",
+            }
+
+    def stop(self):
+        """ Forget every watched path and let the thread finish """
+        with self.lock:
+            stopped, self.stopped = self.stopped, None
+            self.signatures.clear()
+        if stopped is not None:
+            stopped.set()
+
+    def changes(self, notifier):
+        """ Watched paths that changed since the last check """
+        with self.lock:
+            changed = []
+            for path, signature in self.signatures.items():
+                current = file_signature(path)
+                if current != signature:
+                    self.signatures[path] = current
+                    changed.append((path, current is not None))
+                    if notifier:
+                        notifier.add(os.path.dirname(path))
+            return changed
+
+    def run(self, stopped, notifier):
+        try:
+            while not stopped.is_set():
+                if notifier:
+                    notifier.wait(POLL_INTERVAL)
+                else:
+                    stopped.wait(POLL_INTERVAL)
+                if stopped.is_set():
+                    break
+                for path, exists in self.changes(notifier):
+                    self.send({
+                        "cmd": "configchanged",
+                        "path": path,
+                        "exists": exists,
+                        "config": findUserConfigFile(),
+                    })
+        except OSError:
+            # The browser went away; the read loop will notice too.
+            pass
+        finally:
+            if notifier:
+                notifier.close()
 
 
 def sanitizeFilename(fn):
     """ Transform a string to make it suitable for use as a filename.
 
     From https://stackoverflow.com/a/295466/147356"""
+    import unicodedata
 
     fn = (
         unicodedata.normalize("NFKD", fn)
@@ -139,7 +773,111 @@ def sanitizeFilename(fn):
     return fn
 
 
+def make_temp_file(content, prefix=None):
+    """ Write content to a new temporary file and return its path """
+    import tempfile
+
+    if prefix is None:
+        prefix = ""
+    prefix = "tmp_{}_".format(sanitizeFilename(prefix))
+
+    (handle, filepath) = tempfile.mkstemp(prefix=prefix, suffix=".txt")
+    with os.fdopen(handle, "w", encoding="utf-8") as file:
+        file.write(content)
+    return filepath
+
+
+def edit(message):
+    """Handle 'edit' message.
+
+    Does the whole of :editor in one go: writes content to a temporary file
+    (as 'temp' does), runs editorcmd on it (as 'run' does), reads the file
+    back and removes it, unless keep is set. The first %f, %l and %c in
+    editorcmd are replaced with the file, line and column; without %f the
+    file is appended. timings has the milliseconds spent in each phase.
+    The editor can be given a timeout and cancelled as for 'run'.
+    """
+    import subprocess
+
+    timings = {}
+    start = time.perf_counter()
+
+    def lap(phase):
+        nonlocal start
+        now = time.perf_counter()
+        timings[phase] = round((now - start) * 1000, 3)
+        start = now
+
+    filepath = make_temp_file(message["content"], message.get("prefix"))
+    lap("write")
+
+    command = (
+        message["editorcmd"]
+        .replace("%l", str(message.get("line", 1)), 1)
+        .replace("%c", str(message.get("col", 1)), 1)
+    )
+    if "%f" in command:
+        command = command.replace("%f", filepath, 1)
+    else:
+        command += " " + filepath
+
+    try:
+        p = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            start_new_session=(os.name == "posix"),
+        )
+        output, code, reason = collect(p, message)
+        lap("editor")
+        reply = {"file": filepath, "code": code}
+        if reason is not None:
+            reply[reason] = True
+        if code == 0:
+            with open(filepath, "r", encoding="utf-8") as file:
+                reply["content"] = file.read()
+        else:
+            reply["content"] = output.decode("utf-8", "replace")
+        lap("read")
+    finally:
+        if not message.get("keep"):
+            os.remove(filepath)
+            lap("cleanup")
+    reply["timings"] = timings
+    return reply
+
+
+def proc_cmdline(pid):
+    """ The argv of process pid, as a list.
+
+    Read from /proc/<pid>/cmdline where there is one, which keeps arguments
+    containing spaces intact. Elsewhere, fall back to splitting the output
+    of ps on whitespace.
+    """
+    try:
+        with open("/proc/%d/cmdline" % pid, "rb") as file:
+            raw = file.read()
+        argv = [
+            arg.decode("utf-8", "replace")
+            for arg in raw.split(b"\0")
+        ]
+        if argv and argv[-1] == "":
+            argv.pop()
+    except FileNotFoundError:
+        if os.path.isdir("/proc/self") or os.name != "posix":
+            raise ProcessLookupError("No process with pid %d" % pid)
+        import subprocess
+
+        argv = subprocess.check_output(
+            ["ps", "-ww", "-p", str(pid), "-o", "args="]
+        ).decode("utf-8", "replace").split()
+    return argv
+
+
 def is_valid_firefox_profile(profile_dir):
+    import pathlib
+
     is_valid = False
     validity_indicator = "times.json"
 
@@ -152,8 +890,197 @@ def is_valid_firefox_profile(profile_dir):
     return is_valid
 
 
+def firefox_dir():
+    if os.name == "nt":
+        return os.path.join(os.environ["APPDATA"], "Mozilla", "Firefox")
+    if sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Application Support/Firefox")
+    return os.path.expanduser("~/.mozilla/firefox")
+
+
+# Parsed profiles.ini files, with the (mtime, size) they were parsed at
+PROFILES_INI = {}
+PROFILES_INI_LOCK = threading.Lock()
+
+
+def read_profiles_ini(ff_dir):
+    """ The profiles in ff_dir/profiles.ini, as a list of their sections'
+    keys plus relativePath and absolutePath, like parseProfilesIni in
+    native.ts. None if there's no such file.
+    """
+    import configparser
+
+    path = os.path.join(ff_dir, "profiles.ini")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    with PROFILES_INI_LOCK:
+        cached = PROFILES_INI.get(path)
+    if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    ini = configparser.ConfigParser(interpolation=None, strict=False)
+    ini.optionxform = str
+    ini.read(path, encoding="utf-8")
+    base = ff_dir + os.sep
+    profiles = []
+    for name in ini.sections():
+        profile = dict(ini[name])
+        if "Path" not in profile:
+            # New profiles.ini have a useless section at the top
+            continue
+        profile["Path"] = profile["Path"].replace("/", os.sep)
+        if profile.get("IsRelative") == "1":
+            profile["relativePath"] = profile["Path"]
+            profile["absolutePath"] = base + profile["Path"]
+        else:
+            profile["absolutePath"] = profile["Path"]
+            if profile["Path"].startswith(base):
+                profile["relativePath"] = profile["Path"][len(base):]
+        profiles.append(profile)
+    with PROFILES_INI_LOCK:
+        PROFILES_INI[path] = ((st.st_mtime_ns, st.st_size), profiles)
+    return profiles
+
+
+def locked_profiles(ff_dir, profiles):
+    """ Profile directories that Firefox holds a lock on, checking those
+    in profiles.ini and those directly under ff_dir (or ff_dir/Profiles
+    on macOS) rather than walking the whole tree
+    """
+    if sys.platform == "darwin":
+        lock = ".parentlock"
+        parent = os.path.join(ff_dir, "Profiles")
+    else:
+        lock = "lock"
+        parent = ff_dir
+    candidates = {profile["absolutePath"] for profile in profiles or []}
+    try:
+        with os.scandir(parent) as entries:
+            candidates.update(
+                entry.path for entry in entries if entry.is_dir()
+            )
+    except OSError:
+        pass
+    # lock is a symlink to nowhere
+    return sorted(
+        path for path in candidates
+        if os.path.lexists(os.path.join(path, lock))
+    )
+
+
+def process_start(pid):
+    """ When process pid started, in clock ticks since boot, to tell it
+    from a later process with the same pid. None where there's no /proc.
+    """
+    try:
+        with open("/proc/%d/stat" % pid, "rb") as file:
+            stat = file.read()
+    except OSError:
+        return None
+    # Field 22; the command name before it may contain spaces
+    return int(stat.rpartition(b")")[2].split()[19])
+
+
+# Profiles detect_profile found, by what it found them from, most recently
+# used last
+DETECTED_PROFILES = {}
+DETECTED_PROFILES_SIZE = 8
+DETECTED_PROFILES_LOCK = threading.Lock()
+
+
+def detect_profile(message):
+    """Handle 'detect_profile' message.
+
+    Works out which profile Firefox is running, all in one go, the same
+    way getProfileUncached in native.ts does: from the profiledir setting,
+    from --profile or -P in Firefox's command line, from the only profile
+    that's locked, or else the default profile in profiles.ini. The reply
+    has the profile and how it was found.
+
+    The answer is kept for as long as the same browser is running and
+    profiles.ini doesn't change, so asking again costs a couple of stats.
+    """
+    ff_dir = os.path.expanduser(message.get("firefox_dir") or firefox_dir())
+    ff_dir = ff_dir.rstrip("/" + os.sep)
+    profiledir = message.get("profiledir", "auto")
+    try:
+        st = os.stat(os.path.join(ff_dir, "profiles.ini"))
+        ini = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        ini = None
+    pid = browser_pid()
+    key = (ff_dir, profiledir, ini, pid, process_start(pid))
+    with DETECTED_PROFILES_LOCK:
+        found = DETECTED_PROFILES.pop(key, None)
+        if found is not None:
+            DETECTED_PROFILES[key] = found
+            return dict(found)
+    found = find_profile(ff_dir, profiledir, pid)
+    with DETECTED_PROFILES_LOCK:
+        DETECTED_PROFILES[key] = found
+        while len(DETECTED_PROFILES) > DETECTED_PROFILES_SIZE:
+            del DETECTED_PROFILES[next(iter(DETECTED_PROFILES))]
+    return dict(found)
+
+
+def find_profile(ff_dir, profiledir, pid):
+    """ The profile detect_profile is looking for, uncached """
+    profiles = read_profiles_ini(ff_dir)
+
+    def profile_at(path, how):
+        for profile in profiles or []:
+            if profile["absolutePath"] == path:
+                return {"profile": profile, "how": how}
+        # Fill in what profiles in profiles.ini have anyway
+        return {
+            "profile": {
+                "IsRelative": "0", "Path": path, "absolutePath": path,
+            },
+            "how": how,
+        }
+
+    if profiledir != "auto":
+        return profile_at(profiledir, "profiledir")
+
+    try:
+        argv = proc_cmdline(pid)
+    except Exception:
+        argv = []
+    for flag in ("--profile", "-profile"):
+        if flag in argv[:-1]:
+            return profile_at(argv[argv.index(flag) + 1], "cmdline")
+    if profiles is not None:
+        for flag in ("-p", "-P"):
+            if flag in argv[:-1]:
+                name = argv[argv.index(flag) + 1]
+                for profile in profiles:
+                    if profile.get("Name") == name:
+                        return {"profile": profile, "how": "cmdline"}
+                raise ValueError(
+                    "'%s' found in command line arguments but no matching"
+                    " profile name found in profiles.ini" % flag
+                )
+
+    if os.name != "nt":
+        locked = locked_profiles(ff_dir, profiles)
+        if len(locked) == 1:
+            return profile_at(locked[0], "lock")
+
+    for profile in profiles or []:
+        if profile.get("Default") == "1":
+            return {"profile": profile, "how": "default"}
+    raise ValueError(
+        "Couldn't deduce which profile you want. See ':help profiledir'"
+    )
+
+
 def win_firefox_restart(message):
     """Handle 'win_firefox_restart' message."""
+    import pathlib
+    import shutil
+    import subprocess
+
     reply = {}
     profile_dir = None
     browser_cmd = None
@@ -378,41 +1305,1824 @@ Start-Process `
     return reply
 
 
-def write_log(msg):
-    debug_log_dirname = ".tridactyl"
-    debug_log_filename = "native_main.log"
+def kill_process_group(p):
+    """ Kill a child and, on POSIX, everything else in its session, so that
+    e.g. the shell spawned by shell=True doesn't leave its children behind.
+    The child must have been started with start_new_session=True.
+    """
+    if os.name == "posix":
+        import signal
+
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        p.kill()
+
+
+class ChildGuard:
+    """ Kills a child started for a message, and its process group, once
+    the message's timeout (in seconds, default_timeout if it has none) has
+    passed or a 'cancel' message names the message's id. reason says why it
+    was killed, if it was.
+    """
+
+    def __init__(self, p, message, default_timeout=None):
+        self.p = p
+        self.reason = None
+        self.lock = threading.Lock()
+        self.timer = None
+        timeout = message.get("timeout", default_timeout)
+        if timeout is not None:
+            self.timer = threading.Timer(
+                float(timeout), self.kill, ("timed_out",)
+            )
+            self.timer.daemon = True
+            self.timer.start()
+        # Children of the current connection, by message id
+        self.running = getattr(CONNECTION, "running", None)
+        self.key = message.get("id")
+        if self.running is not None and self.key is not None:
+            self.running[self.key] = self
+
+    def kill(self, reason):
+        with self.lock:
+            if self.reason is not None or self.p.returncode is not None:
+                return
+            self.reason = reason
+            kill_process_group(self.p)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.running is not None and self.key is not None:
+            self.running.pop(self.key, None)
+
+
+def feed_stdin(p, data):
+    """ Write data to a child's stdin and close it, ignoring children that
+    don't read it all
+    """
+    try:
+        p.stdin.write(data)
+        p.stdin.close()
+    except OSError:
+        pass
+
 
-    debug_log_path = os.path.join(
-        os.path.expanduser("~"),
-        debug_log_dirname,
-        debug_log_filename,
+def collect(p, message, stdin=b"", max_bytes=None, default_timeout=None):
+    """ Feed stdin to child p, read its stdout if that is a pipe, and wait
+    for it, all under a ChildGuard for message. Output past max_bytes gets
+    p killed.
+
+    Returns (output, code, reason), reason being why the guard killed p,
+    if it did.
+    """
+    chunks = []
+    size = 0
+    with ChildGuard(p, message, default_timeout) as guard:
+        if stdin:
+            feeder = threading.Thread(target=feed_stdin, args=(p, stdin))
+            feeder.start()
+        elif p.stdin is not None:
+            p.stdin.close()
+        while p.stdout is not None:
+            data = p.stdout.read1(65536)
+            if not data:
+                p.stdout.close()
+                break
+            if max_bytes is not None and size + len(data) > max_bytes:
+                chunks.append(data[:max_bytes - size])
+                guard.kill("truncated")
+                p.stdout.close()
+                break
+            chunks.append(data)
+            size += len(data)
+        if stdin:
+            feeder.join()
+        code = p.wait()
+    return b"".join(chunks), code, guard.reason
+
+
+def run(message):
+    """Handle 'run' message.
+
+    command is a shell command line or, to run a program directly without
+    a shell, an argv list. content is written to its stdin. The command
+    and everything it started are killed once timeout seconds have passed,
+    a 'cancel' message names this message's id, or it has written more
+    than max_bytes; the reply then says timed_out, cancelled or truncated
+    and has the output up to that point.
+    """
+    import subprocess
+
+    command = message["command"]
+    max_bytes = message.get("max_bytes")
+    stdin = message.get("content", "").encode("utf-8")
+
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        command,
+        shell=isinstance(command, str),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        start_new_session=(os.name == "posix"),
     )
+    output, code, reason = collect(p, message, stdin, max_bytes)
+    METRICS.child("run", time.perf_counter() - start, code)
+    reply = {
+        "cmd": "run",
+        "content": output.decode("utf-8", "replace"),
+        "code": code,
+    }
+    if reason is not None:
+        reply[reason] = True
+    return reply
 
-    open(debug_log_path, "a+").write(msg)
 
+def run_stream(message, send):
+    """Handle 'run_stream' message.
+
+    Like 'run', but output is sent as it arrives in partial replies
+    ({"more": true, "stream": "stdout"|"stderr", "seq": n, "content": ...})
+    instead of being buffered, so it isn't bound by the native messaging
+    size limit. The returned final reply carries the exit code. Once more
+    than max_bytes of output have been read, the child is killed and the
+    final reply is marked as truncated. command, timeout and cancelling
+    work as for 'run'.
+    """
+    import codecs
+    import subprocess
+
+    chunk_size = min(int(message.get("chunk_size", 32768)), MAX_STREAM_CHUNK)
+    max_bytes = message.get("max_bytes")
+    stdin = message.get("content", "").encode("utf-8")
+
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        message["command"],
+        shell=isinstance(message["command"], str),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if message.get("stderr") else None,
+        start_new_session=(os.name == "posix"),
+    )
+
+    lock = threading.Lock()
+    state = {"seq": 0, "bytes": 0, "truncated": False}
+
+    def pump(pipe, name):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            raw = pipe.read1(chunk_size)
+            with lock:
+                # Once truncated, keep draining but forward nothing more
+                data = b"" if state["truncated"] else raw
+                if max_bytes is not None:
+                    room = max_bytes - state["bytes"]
+                    if len(data) > room:
+                        data = data[:room]
+                        state["truncated"] = True
+                        kill_process_group(p)
+                state["bytes"] += len(data)
+                text = decoder.decode(data, final=not raw)
+                if text:
+                    send({
+                        "cmd": "run_stream",
+                        "more": True,
+                        "stream": name,
+                        "seq": state["seq"],
+                        "content": text,
+                    })
+                    state["seq"] += 1
+            if not raw:
+                return
+
+    threads = [threading.Thread(target=feed_stdin, args=(p, stdin))]
+    threads.append(threading.Thread(target=pump, args=(p.stdout, "stdout")))
+    if p.stderr is not None:
+        threads.append(
+            threading.Thread(target=pump, args=(p.stderr, "stderr"))
+        )
+    with ChildGuard(p, message) as guard:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        code = p.wait()
+
+    METRICS.child("run_stream", time.perf_counter() - start, code)
+    reply = {
+        "cmd": "run_stream",
+        "code": code,
+        "bytes": state["bytes"],
+        "truncated": state["truncated"],
+    }
+    if guard.reason is not None:
+        reply[guard.reason] = True
+    return reply
+
+
+def utf8_boundary(buf, start, stop):
+    """ Move stop back so that buf[start:stop] doesn't end halfway through
+    a UTF-8 sequence. Gives up if that would leave nothing.
+    """
+    if stop >= len(buf):
+        return len(buf)
+    boundary = stop
+    while boundary > start and buf[boundary] & 0xC0 == 0x80:
+        boundary -= 1
+    return boundary if boundary > start else stop
+
+
+def read_file(message, send):
+    """Handle 'read' message.
+
+    Every reply carries the file's size and mtime. If they match the
+    message's if_size and if_mtime, the reply says "unchanged" instead of
+    sending the content again.
+
+    By default the whole file is read as text. With offset and/or length
+    (in bytes), only that range is read; the range is shortened to end on a
+    character boundary and next_offset says where the next read should
+    start. With chunk_size, the range is sent as a sequence of partial
+    replies of at most chunk_size bytes each. Ranges are served from a
+    memory map of the file, so large files are never read in one piece.
+    """
+    import mmap
+
+    path = os.path.expandvars(os.path.expanduser(message["file"]))
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return {"content": "", "code": 2}
+
+    with file:
+        st = os.fstat(file.fileno())
+        reply = {"code": 0, "size": st.st_size, "mtime": st.st_mtime}
+        if (
+            message.get("if_mtime") == st.st_mtime
+            and message.get("if_size") == st.st_size
+        ):
+            reply["unchanged"] = True
+            return reply
+
+        offset = message.get("offset")
+        length = message.get("length")
+        chunk_size = message.get("chunk_size")
+        if offset is None and length is None and chunk_size is None:
+            with open(
+                file.fileno(), "r", encoding="utf-8", closefd=False
+            ) as text:
+                reply["content"] = text.read()
+            return reply
+
+        offset = min(int(offset or 0), st.st_size)
+        end = st.st_size
+        if length is not None:
+            end = min(end, offset + int(length))
+        if offset >= end:
+            reply.update(content="", offset=offset, next_offset=offset)
+            return reply
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if chunk_size is None:
+                stop = utf8_boundary(buf, offset, end)
+                reply["content"] = buf[offset:stop].decode("utf-8", "replace")
+            else:
+                # Room for at least one whole character, which
+                # utf8_boundary needs to avoid splitting one
+                chunk_size = max(4, min(int(chunk_size), MAX_STREAM_CHUNK))
+                stop = offset
+                seq = 0
+                while stop < end:
+                    start = stop
+                    stop = utf8_boundary(
+                        buf, start, min(start + chunk_size, end)
+                    )
+                    send({
+                        "cmd": "read",
+                        "more": True,
+                        "seq": seq,
+                        "offset": start,
+                        "content": buf[start:stop].decode("utf-8", "replace"),
+                    })
+                    seq += 1
+                reply["chunks"] = seq
+        reply["offset"] = offset
+        reply["next_offset"] = stop
+    return reply
+
+
+def write_target(path):
+    """ The file that writing to path should replace: the target of a
+    symlink rather than the link itself
+    """
+    return os.path.realpath(path) if os.path.islink(path) else path
+
+
+def create_sibling(path, suffix):
+    """ Create and open a new, uniquely named hidden file next to path,
+    for writing. Returns (fd, name). Its permissions are those a new file
+    gets from the umask, or path's if it exists.
+    """
+    directory, name = os.path.split(path)
+    while True:
+        temp = os.path.join(
+            directory, ".%s.%s%s" % (name, os.urandom(4).hex(), suffix)
+        )
+        try:
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        os.chmod(temp, os.stat(path).st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        os.close(fd)
+        os.remove(temp)
+        raise
+    return fd, temp
+
+
+def fsync_dir(directory):
+    """ Make a rename in directory durable """
+    if os.name != "posix":
+        return
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(temp, path, fsync=False):
+    """ Move temp over path in one step, or throw it away if that fails """
+    try:
+        os.replace(temp, path)
+    except OSError:
+        os.remove(temp)
+        raise
+    if fsync:
+        fsync_dir(os.path.dirname(path))
+
+
+def written(data):
+    """ The size and hash of data, as reported when writes complete """
+    import hashlib
+
+    return {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def atomic_write(path, data, fsync=False):
+    """ Replace the file at path (or a symlink's target) with data, so that
+    it's either left as it was or completely written, even if we crash.
+    With fsync, the data is on disk before we return.
+    """
+    path = write_target(path)
+    try:
+        fd, temp = create_sibling(path, ".tmp")
+    except PermissionError:
+        # We may write to the file but not to its directory
+        with open(path, "wb") as file:
+            file.write(data)
+        return written(data)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+    except BaseException:
+        os.remove(temp)
+        raise
+    replace_file(temp, path, fsync)
+    return written(data)
+
+
+def append_file(path, data, fsync=False):
+    with open(path, "ab") as file:
+        file.write(data)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+    return written(data)
+
+
+def write_file(message):
+    """Handle 'write' message.
+
+    Replaces the file atomically (see atomic_write), or with append set,
+    appends content to it. fsync waits for the data to reach the disk.
+    The reply has the size and SHA-256 of what was written.
+    """
+    path = os.path.expandvars(os.path.expanduser(message["file"]))
+    data = message["content"].encode("utf-8")
+    fsync = message.get("fsync", False)
+    if message.get("append"):
+        reply = append_file(path, data, fsync)
+    else:
+        reply = atomic_write(path, data, fsync)
+    reply["code"] = 0
+    return reply
+
+
+def upload_meta(session):
+    if not (session.isascii() and session.isalnum()):
+        raise ValueError("Invalid write session: %r" % session)
+    return os.path.join(UPLOADS_DIR, session + ".json")
+
+
+def get_upload(session):
+    upload = read_json_file(upload_meta(session))
+    if upload is None:
+        raise KeyError("No write session %s" % session)
+    return upload
+
+
+def end_upload(session, upload):
+    for path in (upload["temp"], upload_meta(session)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def reap_uploads():
+    """ Throw away sessions that were started more than UPLOAD_KEEP
+    seconds ago and never committed or aborted
+    """
+    try:
+        names = os.listdir(UPLOADS_DIR)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for name in names:
+        session, ext = os.path.splitext(name)
+        if ext != ".json":
+            continue
+        upload = read_json_file(os.path.join(UPLOADS_DIR, name))
+        if upload is not None and now - upload["started"] > UPLOAD_KEEP:
+            end_upload(session, upload)
+
+
+def write_begin(message):
+    """Handle 'write_begin' message.
+
+    Starts a chunked write of file: content sent with write_chunk goes to
+    a temporary file next to it, which write_commit then puts in place
+    like 'write' would (with the same append and fsync options), or
+    write_abort throws away. Replies with the session's id.
+    """
+    reap_uploads()
+    path = write_target(
+        os.path.expandvars(os.path.expanduser(message["file"]))
+    )
+    fd, temp = create_sibling(path, ".part")
+    os.close(fd)
+    session = os.urandom(8).hex()
+    os.makedirs(UPLOADS_DIR, mode=0o700, exist_ok=True)
+    write_json_file(upload_meta(session), {
+        "file": path,
+        "temp": temp,
+        "append": bool(message.get("append")),
+        "fsync": bool(message.get("fsync")),
+        "started": time.time(),
+    })
+    return {"cmd": "write_begin", "code": 0, "session": session}
+
+
+def write_chunk(message):
+    """Handle 'write_chunk' message.
+
+    Adds content to a chunked write. If offset is given, it must be the
+    number of bytes written so far, which catches lost or repeated
+    chunks. Replies with the new size.
+    """
+    upload = get_upload(message["session"])
+    with open(upload["temp"], "ab") as file:
+        size = os.fstat(file.fileno()).st_size
+        offset = message.get("offset")
+        if offset is not None and offset != size:
+            raise ValueError(
+                "Chunk at offset %d, but %d bytes were written"
+                % (offset, size)
+            )
+        file.write(message["content"].encode("utf-8"))
+        size = file.tell()
+    return {"cmd": "write_chunk", "code": 0, "size": size}
+
+
+def write_commit(message):
+    """Handle 'write_commit' message.
+
+    Finishes a chunked write. If sha256 is given and doesn't match what
+    was sent, nothing is written. Replies with the size and SHA-256 of
+    the content.
+    """
+    import hashlib
+    import shutil
+
+    session = message["session"]
+    upload = get_upload(session)
+    temp = upload["temp"]
+    digest = hashlib.sha256()
+    with open(temp, "rb+") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+        size = file.tell()
+        if upload["fsync"] and not upload["append"]:
+            os.fsync(file.fileno())
+    expected = message.get("sha256")
+    if expected is not None and expected != digest.hexdigest():
+        end_upload(session, upload)
+        raise ValueError(
+            "Write of %s failed: SHA-256 mismatch" % upload["file"]
+        )
+    try:
+        if upload["append"]:
+            with open(temp, "rb") as src, open(upload["file"], "ab") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+                if upload["fsync"]:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+        else:
+            replace_file(temp, upload["file"], upload["fsync"])
+    finally:
+        end_upload(session, upload)
+    return {
+        "cmd": "write_commit",
+        "code": 0,
+        "size": size,
+        "sha256": digest.hexdigest(),
+    }
+
+
+def write_abort(message):
+    """Handle 'write_abort' message."""
+    session = message["session"]
+    end_upload(session, get_upload(session))
+    return {"cmd": "write_abort", "code": 0}
+
+
+def write_json_file(path, value):
+    """ Replace the JSON file at path in one go, so that readers never see
+    half of it
+    """
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as file:
+        json.dump(value, file)
+    os.replace(temp, path)
+
+
+def read_json_file(path):
+    """ The content of the JSON file at path, or None if there isn't one """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def job_dir(job_id):
+    job_id = str(job_id)
+    if not (job_id.isascii() and job_id.isdigit()):
+        raise ValueError("Invalid job id: %r" % job_id)
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def new_job_dir():
+    """ Create the directory of a new job and return it. Ids count up from
+    the last one handed out, so that they aren't reused after reaping.
+    """
+    os.makedirs(JOBS_DIR, mode=0o700, exist_ok=True)
+    last = os.path.join(JOBS_DIR, "last")
+    try:
+        with open(last, "r") as file:
+            job_id = int(file.read())
+    except (OSError, ValueError):
+        job_id = 0
+    while True:
+        job_id += 1
+        try:
+            os.mkdir(os.path.join(JOBS_DIR, str(job_id)))
+        except FileExistsError:
+            continue
+        with open(last, "w") as file:
+            file.write(str(job_id))
+        return job_dir(job_id)
+
+
+def process_alive(pid):
+    if os.name != "posix":
+        # os.kill would terminate it
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def run_async(message):
+    """Handle 'run_async' message.
+
+    Starts command in the background and replies with its job id straight
+    away. The command is run by a supervisor, native_main.py --job, in a
+    session of its own, so that it outlives this messenger. The supervisor
+    writes the command's output (stdout and stderr interleaved) and, in
+    the end, its exit status to the job's directory under JOBS_DIR, where
+    job_status, job_output and job_wait look for them.
+    """
+    import subprocess
+
+    reap_jobs()
+    directory = new_job_dir()
+    job = {
+        "id": int(os.path.basename(directory)),
+        "command": message["command"],
+        "cwd": os.path.expanduser(message.get("cwd") or "~"),
+        "started": time.time(),
+        "max_output": int(message.get("max_output", JOB_MAX_OUTPUT)),
+    }
+    write_json_file(os.path.join(directory, "job.json"), job)
+
+    if getattr(sys, "frozen", False):
+        argv = [sys.executable]
+    else:
+        flags = ["-S"] if sys.flags.no_site else []
+        argv = [sys.executable] + flags + [os.path.abspath(__file__)]
+    if os.name == "posix":
+        detach = {"start_new_session": True}
+    else:
+        detach = {
+            "creationflags": subprocess.DETACHED_PROCESS
+            | subprocess.CREATE_NEW_PROCESS_GROUP
+        }
+    supervisor = subprocess.Popen(
+        argv + ["--job", directory],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        **detach
+    )
+    if hasattr(os, "fork"):
+        # It forks again straight away (see run_job)
+        supervisor.wait()
+    return {"cmd": "run_async", "code": 0, "job": job["id"]}
+
+
+def run_job(directory):
+    """ Supervise the command of the job in directory: see run_async """
+    import subprocess
+
+    if hasattr(os, "fork") and os.fork() != 0:
+        # Leave nothing for the messenger that started us to wait for
+        os._exit(0)
+    job = read_json_file(os.path.join(directory, "job.json"))
+    max_output = job["max_output"]
+    size = 0
+    try:
+        with open(os.path.join(directory, "output"), "wb", 0) as output:
+            p = subprocess.Popen(
+                job["command"],
+                shell=True,
+                cwd=job["cwd"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            write_json_file(
+                os.path.join(directory, "pid.json"),
+                {"supervisor": os.getpid(), "pid": p.pid},
+            )
+            while True:
+                data = p.stdout.read1(65536)
+                if not data:
+                    break
+                if size < max_output:
+                    output.write(data[:max_output - size])
+                size += len(data)
+            status = {"code": p.wait()}
+    except OSError as e:
+        status = {"code": -1, "error": str(e)}
+    status.update(
+        finished=time.time(), bytes=size, truncated=size > max_output
+    )
+    write_json_file(os.path.join(directory, "status.json"), status)
+
+
+def job_state(job_id):
+    """ What is known about a job, or None if there is no such job.
+
+    state is "running", "exited" (with the exit code and when) or "lost",
+    if the supervisor disappeared without recording an exit status. size
+    is how much output there is to read.
+    """
+    directory = job_dir(job_id)
+    job = read_json_file(os.path.join(directory, "job.json"))
+    if job is None:
+        return None
+    state = {
+        "job": job["id"],
+        "command": job["command"],
+        "started": job["started"],
+    }
+    try:
+        state["size"] = os.stat(os.path.join(directory, "output")).st_size
+    except FileNotFoundError:
+        state["size"] = 0
+    status = read_json_file(os.path.join(directory, "status.json"))
+    pids = read_json_file(os.path.join(directory, "pid.json"))
+    if status is not None:
+        state.update(status, state="exited")
+    elif pids is not None:
+        state["pid"] = pids["pid"]
+        alive = process_alive(pids["supervisor"])
+        state["state"] = "running" if alive else "lost"
+    elif time.time() - job["started"] < JOB_START_TIMEOUT:
+        state["state"] = "running"
+    else:
+        state["state"] = "lost"
+    return state
+
+
+def get_job(job_id):
+    state = job_state(job_id)
+    if state is None:
+        raise KeyError("No job %s" % job_id)
+    return state
+
+
+def reap_jobs():
+    """ Remove jobs that finished (or were lost) more than JOB_KEEP seconds
+    ago, and all but the latest MAX_FINISHED_JOBS finished ones
+    """
+    import shutil
+
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    finished = []
+    for name in names:
+        if not name.isdigit():
+            continue
+        directory = os.path.join(JOBS_DIR, name)
+        state = job_state(name)
+        if state is None:
+            # Never got its job.json
+            try:
+                ended = os.stat(directory).st_mtime
+            except OSError:
+                continue
+        elif state["state"] == "running":
+            continue
+        else:
+            ended = state.get("finished", state["started"])
+        finished.append((ended, directory))
+    finished.sort(reverse=True)
+    for n, (ended, directory) in enumerate(finished):
+        if n >= MAX_FINISHED_JOBS or now - ended > JOB_KEEP:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def job_status(message):
+    """Handle 'job_status' message.
+
+    The state of the job given by "job" (see job_state), or with no job,
+    the states of all jobs in "jobs".
+    """
+    reap_jobs()
+    if message.get("job") is not None:
+        return get_job(message["job"])
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        names = []
+    jobs = (job_state(name) for name in names if name.isdigit())
+    return {
+        "jobs": sorted(
+            (state for state in jobs if state is not None),
+            key=lambda state: state["job"],
+        ),
+    }
+
+
+def complete_utf8(data):
+    """ The length of data without any incomplete UTF-8 sequence at its
+    end
+    """
+    lead = len(data) - 1
+    while lead >= 0 and len(data) - lead < 4 and data[lead] & 0xC0 == 0x80:
+        lead -= 1
+    if lead < 0 or data[lead] < 0xC0:
+        return len(data)
+    needed = 2 if data[lead] < 0xE0 else 3 if data[lead] < 0xF0 else 4
+    return lead if len(data) - lead < needed else len(data)
+
+
+def job_output(message):
+    """Handle 'job_output' message.
+
+    Up to length bytes of a job's output, starting at byte offset. As with
+    ranges of 'read', the content ends on a character boundary and
+    next_offset says where to continue. eof is set once the job is over
+    and all of its output has been read.
+    """
+    state = get_job(message["job"])
+    offset = int(message.get("offset", 0))
+    # At least one whole character, as for chunks of 'read'
+    length = max(4, min(
+        int(message.get("length") or MAX_STREAM_CHUNK), MAX_STREAM_CHUNK
+    ))
+    path = os.path.join(job_dir(message["job"]), "output")
+    try:
+        with open(path, "rb") as file:
+            file.seek(offset)
+            # One more byte to tell whether the range ends mid-character
+            data = file.read(length + 1)
+    except FileNotFoundError:
+        data = b""
+    stop = utf8_boundary(data, 0, length)
+    if stop == len(data) and state["state"] == "running":
+        # The rest of the last character may not have been written yet
+        stop = complete_utf8(data)
+    return {
+        "cmd": "job_output",
+        "job": state["job"],
+        "state": state["state"],
+        "content": data[:stop].decode("utf-8", "replace"),
+        "offset": offset,
+        "next_offset": offset + stop,
+        "eof": (
+            state["state"] != "running" and offset + stop >= state["size"]
+        ),
+    }
+
+
+def job_wait(message):
+    """Handle 'job_wait' message.
+
+    Waits up to timeout seconds (default 30) for a job to end and returns
+    its state, with timed_out set if it's still running.
+    """
+    deadline = time.monotonic() + float(message.get("timeout", 30))
+    delay = 0.01
+    while True:
+        state = get_job(message["job"])
+        if state["state"] != "running" or time.monotonic() >= deadline:
+            break
+        time.sleep(min(delay, max(0, deadline - time.monotonic())))
+        delay = min(delay * 2, 0.25)
+    state["timed_out"] = state["state"] == "running"
+    return state
+
+
+def is_failure(reply):
+    """ Whether a reply reports that its command failed """
+    return (
+        reply.get("cmd") == "error"
+        or bool(reply.get("error"))
+        or reply.get("code") not in (0, None)
+    )
 
-def handleMessage(message):
-    """ Generate reply from incoming message. """
-    cmd = message["cmd"]
-    reply = {"cmd": cmd}
 
-    if DEBUG:
-        msg = "%s %s\n" % (
-            time.strftime("%H:%M:%S %p", time.localtime()),
-            str(message),
+def resolve_references(sub, replies):
+    """ Fill in the fields of a batched message named in its "refs".
+
+    refs maps field names to "N.key", the field key of the Nth reply, e.g.
+    {"cmd": "read", "refs": {"file": "0.content"}} after a "temp". Nothing
+    else in the message is touched, so user data such as the content of a
+    "write" is passed on as is.
+    """
+    refs = sub.get("refs")
+    if not refs:
+        return sub
+    sub = {k: v for k, v in sub.items() if k != "refs"}
+    for field, ref in refs.items():
+        index, _, key = str(ref).partition(".")
+        if (
+            not index.isdigit()
+            or int(index) >= len(replies)
+            or key not in replies[int(index)]
+        ):
+            raise KeyError("no result {} in batch".format(ref))
+        sub[field] = replies[int(index)][key]
+    return sub
+
+
+def batch(message, send):
+    """Handle 'batch' message.
+
+    Runs message["messages"] in order and returns all their replies at
+    once. Later messages may take fields from earlier replies by naming
+    them in "refs", e.g. {"cmd": "read", "refs": {"file": "0.content"}}
+    after a "temp". Unless stop_on_error is false, the batch stops at the first
+    failing message. code is 0 if every message that ran succeeded.
+    """
+    stop_on_error = message.get("stop_on_error", True)
+    replies = []
+    for sub in message["messages"]:
+        try:
+            sub = resolve_references(sub, replies)
+        except KeyError as e:
+            reply = {"cmd": "error", "error": e.args[0]}
+        else:
+            reply = safeHandleMessage(sub, send)
+        replies.append(reply)
+        if stop_on_error and is_failure(reply):
+            break
+    return {
+        "cmd": "batch",
+        "replies": replies,
+        "code": 1 if any(map(is_failure, replies)) else 0,
+    }
+
+
+# Directory listings, with the mtime they were read at, most recent last
+DIR_CACHE = {}
+DIR_CACHE_SIZE = 32
+DIR_CACHE_LOCK = threading.Lock()
+
+
+def scan_dir(path, stat=False):
+    """ Entries of a directory as {name, type} dicts, with their size and
+    mtime too if stat is true.
+
+    Types come from the directory itself where the filesystem provides
+    them, so only a stat adds a system call per entry; on large directories
+    and network mounts that is most of the cost.
+
+    Listings are cached until the directory's mtime changes, so e.g. every
+    keystroke of a completion in the same directory costs a single stat.
+    Sizes and mtimes of the entries themselves may be stale until then.
+    """
+    key = os.path.abspath(path)
+    mtime = os.stat(key).st_mtime_ns
+    with DIR_CACHE_LOCK:
+        cached = DIR_CACHE.get(key)
+    if cached is None or cached[0] != mtime or (stat and not cached[2]):
+        entries = []
+        with os.scandir(key) as it:
+            for entry in it:
+                try:
+                    kind = "dir" if entry.is_dir() else (
+                        "file" if entry.is_file() else "other"
+                    )
+                except OSError:
+                    kind = "other"
+                found = {"name": entry.name, "type": kind}
+                if stat:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        # e.g. a dangling symlink
+                        st = None
+                    found["size"] = st.st_size if st else 0
+                    found["mtime"] = st.st_mtime if st else 0
+                entries.append(found)
+        cached = (mtime, entries, stat)
+    with DIR_CACHE_LOCK:
+        # Move it to the end, as the most recently used
+        DIR_CACHE.pop(key, None)
+        DIR_CACHE[key] = cached
+        while len(DIR_CACHE) > DIR_CACHE_SIZE:
+            del DIR_CACHE[next(iter(DIR_CACHE))]
+    return cached[1]
+
+
+def fuzzy_score(pattern, name):
+    """ Score how well name matches pattern, lower being better, or None if
+    the letters of pattern don't appear in name in order.
+
+    Prefixes beat substrings, which beat scattered matches; tighter
+    matches beat looser ones.
+    """
+    if not pattern:
+        return 0
+    if name.startswith(pattern):
+        return 0
+    found = name.find(pattern)
+    if found != -1:
+        return 1 + found
+    position = name.find(pattern[0])
+    if position == -1:
+        return None
+    first = position
+    for char in pattern[1:]:
+        position = name.find(char, position + 1)
+        if position == -1:
+            return None
+    return len(name) + position - first
+
+
+def list_dir(path, message):
+    """ The 'files' of a 'list_dir' reply, and, if any of prefix, fuzzy,
+    sort, limit, complete or stat were asked for, the matching 'entries'
+    with their type, and their size and mtime if stat is true or they are
+    sorted by either.
+
+    prefix keeps names starting with it; fuzzy keeps names containing its
+    letters in order, best matches first. ignore_case does what it says.
+    sort is one of "name", "mtime", "size" or "type" (directories first).
+    limit caps the number of entries returned; total has the number of
+    matches before that.
+    """
+    options = ("prefix", "fuzzy", "sort", "limit", "complete", "stat")
+    if not any(message.get(option) is not None for option in options):
+        return {"files": [entry["name"] for entry in scan_dir(path)]}
+
+    sort = message.get("sort")
+    entries = scan_dir(
+        path, bool(message.get("stat")) or sort in ("mtime", "size")
+    )
+
+    fold = str.lower if message.get("ignore_case") else (lambda x: x)
+    prefix = fold(message.get("prefix") or "")
+    fuzzy = fold(message.get("fuzzy") or "")
+
+    matches = []
+    for entry in entries:
+        name = fold(entry["name"])
+        if not name.startswith(prefix):
+            continue
+        score = fuzzy_score(fuzzy, name)
+        if score is not None:
+            matches.append((score, entry))
+
+    if sort == "mtime":
+        matches.sort(key=lambda m: -m[1]["mtime"])
+    elif sort == "size":
+        matches.sort(key=lambda m: -m[1]["size"])
+    elif sort == "type":
+        matches.sort(key=lambda m: (m[1]["type"] != "dir", m[1]["name"]))
+    elif sort == "name" or not fuzzy:
+        matches.sort(key=lambda m: m[1]["name"])
+    else:
+        matches.sort(key=lambda m: (m[0], m[1]["name"]))
+
+    limit = message.get("limit")
+    selected = [entry for _, entry in matches[:limit]]
+    return {
+        "files": [entry["name"] for entry in selected],
+        "entries": selected,
+        "total": len(matches),
+    }
+
+
+# Recursive file indexes for find_files, by absolute root, most recently
+# used last
+INDEXES = {}
+INDEX_CACHE_SIZE = 4
+INDEX_LOCK = threading.Lock()
+
+INDEX_VERSION = 1
+INDEX_MAGIC = b"TRIDACTYL-INDEX %d\n" % INDEX_VERSION
+INDEX_DEFAULTS = {
+    "ignore": [".git", ".hg", ".svn", "node_modules", "__pycache__"],
+    "max_depth": 32,
+    # Files and directories; this is what bounds the index's memory
+    "max_entries": 2000000,
+}
+# Seconds before find_files refreshes an index before answering
+INDEX_MAX_AGE = 300
+# Most candidate matches find_files ranks per root. Short queries match
+# nearly everything, and are refined before they get interesting anyway.
+INDEX_MAX_CANDIDATES = 10000
+
+# Bits of a name's character mask: one per letter, then digits, ".",
+# "_" and "-", and anything else
+INDEX_CHAR_BITS = dict(
+    [(chr(ord("a") + i), 1 << i) for i in range(26)]
+    + [(str(i), 1 << 26) for i in range(10)]
+    + [(".", 1 << 27), ("_", 1 << 28), ("-", 1 << 28)]
+)
+INDEX_OTHER_BIT = 1 << 29
+
+
+def char_mask(chars):
+    mask = 0
+    for char in set(chars):
+        mask |= INDEX_CHAR_BITS.get(char, INDEX_OTHER_BIT)
+    return mask
+
+
+def name_masks(names, memo):
+    """ char_mask of each name, memo being shared by names with the same
+    characters
+    """
+    for name in names:
+        chars = frozenset(name.lower())
+        mask = memo.get(chars)
+        if mask is None:
+            mask = memo[chars] = char_mask(chars)
+        yield mask
+
+
+def fuzzy_regex(pattern, flags=0):
+    """ Match pattern's characters in order within one line. Each step
+    only skips characters that can't match, so a failing line is given up
+    without backtracking.
+    """
+    source = re.escape(pattern[0])
+    for char in pattern[1:]:
+        char = re.escape(char)
+        source += "[^\\n%s]*%s" % (char, char)
+    return re.compile(source + "[^\\n]*", flags)
+
+
+def index_path(root):
+    import hashlib
+
+    digest = hashlib.sha1(root.encode("utf-8", "surrogateescape"))
+    return os.path.join(
+        os.path.expanduser("~"), ".tridactyl", "index",
+        digest.hexdigest() + ".idx",
+    )
+
+
+class FileIndex:
+    """ The names of the files below a root, laid out for fuzzy search.
+
+    Directories are numbered breadth first; the files of directory d are
+    numbered dir_first[d] to dir_first[d + 1] - 1. The names themselves
+    are kept in one newline separated string, grouped into buckets of
+    names containing the same set of characters (see char_mask) so that
+    a query only has to scan the buckets that have all of its characters.
+    ids maps line numbers in names to file numbers, lines the reverse.
+
+    Instances are never modified: refresh() returns a new one.
+    """
+
+    ARRAYS = (
+        ("line_starts", "I"), ("ids", "I"), ("lines", "I"),
+        ("bucket_masks", "Q"),
+        ("bucket_starts", "I"), ("dir_first", "I"), ("dir_mtimes", "q"),
+        ("dir_parents", "i"),
+    )
+
+    def __init__(self, root, options):
+        import array
+
+        self.root = root
+        self.options = options
+        self.built = time.time()
+        self.truncated = False
+        self.names = ""
+        self.dirs = []
+        for name, typecode in self.ARRAYS:
+            setattr(self, name, array.array(typecode))
+
+    @classmethod
+    def build(cls, root, options, old=None):
+        """ Walk root breadth first, reusing the listings of directories
+        whose mtime hasn't changed since old was built.
+        """
+        import bisect
+        import copy
+        import fnmatch
+
+        index = cls(root, options)
+        if old is not None and (old.options != options or old.truncated):
+            # Listings of truncated indexes may miss subdirectories
+            old = None
+        if old is not None:
+            old_dirs = {rel: d for d, rel in enumerate(old.dirs)}
+            old_children = [[] for _ in old.dirs]
+            for d, parent in enumerate(old.dir_parents):
+                if parent >= 0:
+                    old_children[parent].append(d)
+
+        ignore = options["ignore"]
+        ignored = re.compile(
+            "|".join(fnmatch.translate(p) for p in ignore)
+        ).match if ignore else (lambda name: None)
+        max_depth = options["max_depth"]
+        budget = options["max_entries"]
+
+        # Per directory, its file names or, if unchanged, the range of
+        # its file numbers in old
+        listings = []
+        count = 0
+        changed = old is None
+        queue = collections.deque([("", -1, 0)])
+        while queue:
+            rel, parent, depth = queue.popleft()
+            path = os.path.join(root, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            d = len(index.dirs)
+            index.dirs.append(rel)
+            index.dir_mtimes.append(mtime)
+            index.dir_parents.append(parent)
+            index.dir_first.append(count)
+
+            o = old_dirs.get(rel) if old is not None else None
+            if o is not None and old.dir_mtimes[o] == mtime:
+                files = range(old.dir_first[o], old.dir_first[o + 1])
+                subdirs = [
+                    old.dirs[child].rpartition(os.sep)[2]
+                    for child in old_children[o]
+                ]
+            else:
+                changed = True
+                files, subdirs = [], []
+                try:
+                    with os.scandir(path) as it:
+                        for entry in it:
+                            name = entry.name
+                            if "\n" in name or ignored(name):
+                                continue
+                            try:
+                                is_dir = entry.is_dir(follow_symlinks=False)
+                            except OSError:
+                                is_dir = False
+                            (subdirs if is_dir else files).append(name)
+                except OSError:
+                    pass
+
+            if len(files) > budget:
+                files = files[:budget]
+                index.truncated = True
+            budget -= len(files)
+            count += len(files)
+            listings.append(files)
+            if depth >= max_depth:
+                index.truncated = index.truncated or bool(subdirs)
+                continue
+            for name in subdirs:
+                if budget <= 0:
+                    index.truncated = True
+                    break
+                budget -= 1
+                queue.append((os.path.join(rel, name), d, depth + 1))
+        index.dir_first.append(count)
+
+        if not changed and index.dirs == old.dirs:
+            unchanged = copy.copy(old)
+            unchanged.built = index.built
+            return unchanged
+        names = []
+        masks = []
+        memo = {}
+        for files in listings:
+            if isinstance(files, range):
+                for fid in files:
+                    line = old.lines[fid]
+                    names.append(old.name(line))
+                    masks.append(old.bucket_masks[
+                        bisect.bisect_right(old.bucket_starts, line) - 1
+                    ])
+            else:
+                names.extend(files)
+                masks.extend(name_masks(files, memo))
+        index.bucket(names, masks)
+        return index
+
+    def bucket(self, names, masks):
+        """ Lay names (in file number order) out by their masks """
+        import array
+        import bisect
+        import itertools
+
+        order = sorted(range(len(names)), key=masks.__getitem__)
+        ordered = [names[fid] for fid in order]
+        self.ids = array.array("I", order)
+        self.lines = array.array(
+            "I", sorted(range(len(order)), key=order.__getitem__)
+        )
+        self.names = "".join([name + "\n" for name in ordered])
+        # Each name and its newline
+        self.line_starts = array.array("I", itertools.accumulate(
+            map((1).__add__, map(len, ordered)), initial=0
+        ))
+        sorted_masks = list(map(masks.__getitem__, order))
+        self.bucket_masks = array.array("Q", sorted(set(masks)))
+        self.bucket_starts = array.array("I", [
+            bisect.bisect_left(sorted_masks, mask)
+            for mask in self.bucket_masks
+        ] + [len(order)])
+        self.fold()
+
+    def fold(self):
+        """ Set up the lowercased copies of names and directories that
+        case insensitive searches run on
+        """
+        import array
+
+        self.dir_text = "".join([rel + "\n" for rel in self.dirs])
+        self.dir_starts = array.array("I", [0])
+        for rel in self.dirs:
+            self.dir_starts.append(self.dir_starts[-1] + len(rel) + 1)
+        self.folded = self.names.lower()
+        self.dir_folded = self.dir_text.lower()
+        # Unless some character lowercases to several, in which case
+        # searches ignore case instead
+        if len(self.folded) != len(self.names):
+            self.folded = None
+        if len(self.dir_folded) != len(self.dir_text):
+            self.dir_folded = None
+
+    def name(self, line):
+        start, stop = self.line_starts[line], self.line_starts[line + 1]
+        return self.names[start:stop - 1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self):
+        """ Write the index to its file under ~/.tridactyl/index """
+        import tempfile
+
+        sections = [
+            self.names.encode("utf-8", "surrogateescape"),
+            "\n".join(self.dirs).encode("utf-8", "surrogateescape"),
+        ] + [getattr(self, name).tobytes() for name, _ in self.ARRAYS]
+        header = {
+            "root": self.root,
+            "options": self.options,
+            "built": self.built,
+            "truncated": self.truncated,
+            "byteorder": sys.byteorder,
+            "sizes": [len(section) for section in sections],
+        }
+        path = index_path(self.root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(INDEX_MAGIC)
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                for section in sections:
+                    f.write(section)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    @classmethod
+    def load(cls, root):
+        """ The saved index of root, or None if there's no usable one """
+        try:
+            with open(index_path(root), "rb") as f:
+                if f.readline() != INDEX_MAGIC:
+                    return None
+                header = json.loads(f.readline())
+                if (
+                    header["root"] != root
+                    or header["byteorder"] != sys.byteorder
+                ):
+                    return None
+                sections = [f.read(size) for size in header["sizes"]]
+        except (OSError, ValueError, KeyError):
+            return None
+        index = cls(root, header["options"])
+        index.built = header["built"]
+        index.truncated = header["truncated"]
+        index.names = sections[0].decode("utf-8", "surrogateescape")
+        dirs = sections[1].decode("utf-8", "surrogateescape")
+        index.dirs = dirs.split("\n")
+        for (name, _), data in zip(cls.ARRAYS, sections[2:]):
+            getattr(index, name).frombytes(data)
+        index.fold()
+        return index
+
+    def matcher(self, pattern, text, folded):
+        """ A fuzzy regex for pattern, the text to search with it, and how
+        to fold names the same way. Case is ignored unless pattern has
+        capitals.
+        """
+        if pattern != pattern.lower():
+            return fuzzy_regex(pattern), text, (lambda s: s)
+        if folded is None:
+            return fuzzy_regex(pattern, re.IGNORECASE), text, str.lower
+        return fuzzy_regex(pattern), folded, str.lower
+
+    def matching_dirs(self, pattern):
+        import bisect
+
+        regex, text, _ = self.matcher(
+            pattern, self.dir_text, self.dir_folded
+        )
+        return {
+            bisect.bisect_right(self.dir_starts, m.start()) - 1
+            for m in regex.finditer(text)
+        }
+
+    def find(self, query, limit):
+        """ Up to limit (score, length, path relative to root) tuples for
+        the files fuzzily matching query, best first, and the number of
+        candidates looked at.
+
+        The part of query after its last slash is matched against file
+        names; the part before, if any, against their directories.
+        """
+        import bisect
+        import heapq
+
+        dir_query, _, query = query.replace(os.sep, "/").rpartition("/")
+        dir_query = dir_query.replace("/", "")
+        dirs = self.matching_dirs(dir_query) if dir_query else None
+        fold = str
+        if query:
+            regex, names, fold = self.matcher(query, self.names, self.folded)
+
+        if dirs is not None and (not query or sum(
+            self.dir_first[d + 1] - self.dir_first[d] for d in dirs
+        ) <= INDEX_MAX_CANDIDATES):
+            # Few enough files in the matching directories to go through
+            # all of them
+            lines = (
+                self.lines[fid]
+                for d in sorted(dirs)
+                for fid in range(self.dir_first[d], self.dir_first[d + 1])
+            )
+        elif query:
+            mask = char_mask(query.lower())
+            spans = (
+                (self.line_starts[self.bucket_starts[b]],
+                 self.line_starts[self.bucket_starts[b + 1]])
+                for b, bucket_mask in enumerate(self.bucket_masks)
+                if not mask & ~bucket_mask
+            )
+            lines = (
+                bisect.bisect_right(self.line_starts, m.start()) - 1
+                for start, stop in spans
+                for m in regex.finditer(names, start, stop)
+            )
+        else:
+            lines = range(len(self.ids))
+
+        matches = []
+        for line in lines:
+            d = bisect.bisect_right(self.dir_first, self.ids[line]) - 1
+            if dirs is not None and d not in dirs:
+                continue
+            name = self.name(line)
+            score = fuzzy_score(query, fold(name))
+            if score is None:
+                continue
+            matches.append(
+                (score, len(self.dirs[d]) + len(name), line, d)
+            )
+            if len(matches) >= INDEX_MAX_CANDIDATES:
+                break
+        best = [
+            (score, length, os.path.join(self.dirs[d], self.name(line)))
+            for score, length, line, d in heapq.nsmallest(limit, matches)
+        ]
+        return best, len(matches)
+
+
+def index_options(message):
+    return {
+        key: message.get(key, default)
+        for key, default in INDEX_DEFAULTS.items()
+    }
+
+
+def get_index(root, options, max_age=INDEX_MAX_AGE, refresh=False):
+    """ The index of root, loaded from disk, built, or incrementally
+    refreshed if it's older than max_age seconds, as needed.
+    """
+    with INDEX_LOCK:
+        index = INDEXES.pop(root, None) or FileIndex.load(root)
+        if (
+            index is None
+            or refresh
+            or index.options != options
+            or time.time() - index.built > max_age
+        ):
+            index = FileIndex.build(root, options, index)
+            try:
+                index.save()
+            except OSError as e:
+                eprint("Couldn't save index of {}: {}".format(root, e))
+        INDEXES[root] = index
+        while len(INDEXES) > INDEX_CACHE_SIZE:
+            del INDEXES[next(iter(INDEXES))]
+    return index
+
+
+def index_root(message):
+    """ Build or refresh the indexes of message's roots """
+    options = index_options(message)
+    roots = []
+    for root in message["roots"]:
+        start = time.perf_counter()
+        index = get_index(
+            os.path.abspath(os.path.expandvars(os.path.expanduser(root))),
+            options,
+            refresh=message.get("refresh", True),
         )
-        write_log(msg)
+        roots.append({
+            "root": root,
+            "dirs": len(index.dirs),
+            "files": len(index),
+            "truncated": index.truncated,
+            "built": index.built,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+        })
+    return {"roots": roots}
+
+
+def find_files(message):
+    """ Ranked fuzzy matches for query among the files below roots.
+
+    Paths are returned as root joined with the path below it, so they're
+    spelled the way the root was.
+    """
+    import heapq
+
+    options = index_options(message)
+    query = message.get("query") or ""
+    limit = message.get("limit") or 50
+    max_age = message.get("max_age", INDEX_MAX_AGE)
+    matches = []
+    candidates = 0
+    truncated = False
+    for root in message["roots"]:
+        index = get_index(
+            os.path.abspath(os.path.expandvars(os.path.expanduser(root))),
+            options,
+            max_age,
+        )
+        found, seen = index.find(query, limit)
+        candidates += seen
+        truncated = (
+            truncated or index.truncated or seen >= INDEX_MAX_CANDIDATES
+        )
+        matches.extend(
+            (score, length, os.path.join(root, rel))
+            for score, length, rel in found
+        )
+    return {
+        "files": [path for _, _, path in heapq.nsmallest(limit, matches)],
+        "total": candidates,
+        "truncated": truncated,
+    }
+
+
+class Histogram:
+    """ Counts of values falling between successive bounds, which is enough
+    to tell percentiles to within a bucket without keeping every value.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        import bisect
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ Upper bound of the bucket the p-th percentile falls in """
+        rank = -(-self.count * p // 100)
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "total": round(self.total, 3),
+            "mean": round(self.total / self.count, 3),
+            "min": round(self.min, 3),
+            "max": round(self.max, 3),
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3),
+            # [upper bound, count], null being "more than the last bound"
+            "buckets": [
+                [bound, count]
+                for bound, count in zip(self.bounds + [None], self.counts)
+                if count
+            ],
+        }
+
+
+LATENCY_BOUNDS_MS = [
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+    10000, 30000,
+]
+SIZE_BOUNDS = [4 ** i for i in range(3, 14)]  # 64B to 64MB
+
+
+class Metrics:
+    """ Per-command message counts, errors, latencies and payload sizes,
+    and counts and durations of the child processes run, since start-up
+    or the last reset. Served by the "stats" command.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.commands = {}
+        self.children = {}
+
+    def command(self, cmd, seconds, in_bytes, out_bytes, failed):
+        with self.lock:
+            stats = self.commands.get(cmd)
+            if stats is None:
+                stats = self.commands[cmd] = {
+                    "count": 0,
+                    "errors": 0,
+                    "latency_ms": Histogram(LATENCY_BOUNDS_MS),
+                    "in_bytes": Histogram(SIZE_BOUNDS),
+                    "out_bytes": Histogram(SIZE_BOUNDS),
+                }
+            stats["count"] += 1
+            stats["errors"] += failed
+            stats["latency_ms"].add(seconds * 1000)
+            stats["in_bytes"].add(in_bytes)
+            stats["out_bytes"].add(out_bytes)
+        log_event(
+            event="message", cmd=cmd, ms=round(seconds * 1000, 3),
+            in_bytes=in_bytes, out_bytes=out_bytes, failed=failed,
+        )
+
+    def child(self, kind, seconds, code):
+        """ Account for a child process started by kind ("run", ...) """
+        with self.lock:
+            stats = self.children.get(kind)
+            if stats is None:
+                stats = self.children[kind] = {
+                    "count": 0,
+                    "failures": 0,
+                    "duration_ms": Histogram(LATENCY_BOUNDS_MS),
+                }
+            stats["count"] += 1
+            stats["failures"] += code != 0
+            stats["duration_ms"].add(seconds * 1000)
+        log_event(
+            event="child", kind=kind, ms=round(seconds * 1000, 3), code=code
+        )
+
+    def snapshot(self, reset=False):
+        def summarise(table):
+            return {
+                name: {
+                    key: value.summary()
+                    if isinstance(value, Histogram) else value
+                    for key, value in stats.items()
+                }
+                for name, stats in table.items()
+            }
+
+        with self.lock:
+            snapshot = {
+                "pid": os.getpid(),
+                "since": self.since,
+                "uptime_s": round(time.time() - self.since, 3),
+                "commands": summarise(self.commands),
+                "children": summarise(self.children),
+            }
+            if reset:
+                self.reset()
+        return snapshot
+
+
+METRICS = Metrics()
+
+# Structured log, if enabled by TRIDACTYL_NATIVE_LOG or a "log" message
+LOG = None
+LOG_PATH = None
+
+
+def enable_log(path=None):
+    """ Log an event per message and child process to path, as JSON lines.
+    Events are buffered and the file is rotated as it reaches
+    LOG_MAX_BYTES. Message contents are never logged, only their sizes.
+    """
+    global LOG, LOG_PATH
+    import logging
+    import logging.handlers
+
+    if path is None:
+        path = os.path.join(
+            os.path.expanduser("~"), ".tridactyl", "native_main.log"
+        )
+    disable_log()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    target = logging.handlers.RotatingFileHandler(
+        path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True
+    )
+    target.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger("tridactyl.native")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    # Flushed every LOG_BUFFER events, on warnings, and at exit
+    logger.addHandler(logging.handlers.MemoryHandler(
+        LOG_BUFFER, flushLevel=logging.WARNING, target=target
+    ))
+    LOG, LOG_PATH = logger, path
+    return path
+
+
+def disable_log():
+    global LOG, LOG_PATH
+    if LOG is not None:
+        for handler in list(LOG.handlers):
+            handler.close()
+            LOG.removeHandler(handler)
+        LOG = LOG_PATH = None
+
+
+def flush_log():
+    if LOG is not None:
+        for handler in LOG.handlers:
+            handler.flush()
+
+
+def log_event(**fields):
+    if LOG is not None:
+        fields["t"] = round(time.time(), 6)
+        fields["pid"] = os.getpid()
+        LOG.info(json.dumps(fields))
+
+
+def handleMessage(message, send=None):
+    """ Generate reply from incoming message.
+
+    Commands that reply more than once call send() with their partial
+    replies and return the final one.
+    """
+    if send is None:
+        def send(partial):
+            sendMessage(encodeMessage(partial))
+
+    cmd = message["cmd"]
+    reply = {"cmd": cmd}
 
     if cmd == "version":
-        reply = {"version": VERSION}
+        reply = {
+            "version": VERSION,
+            "protocol": PROTOCOL_VERSION,
+            "capabilities": CAPABILITIES,
+        }
 
     elif cmd == "getconfig":
-        file_content = getUserConfig()
-        if file_content:
-            reply["content"] = file_content
+        config = getUserConfig()
+        if config:
+            path, mtime, size, content = config
+            reply.update(path=path, mtime=mtime, size=size)
+            if (
+                message.get("if_path") == path
+                and message.get("if_mtime") == mtime
+                and message.get("if_size") == size
+            ):
+                reply["unchanged"] = True
+            else:
+                reply["content"] = content
         else:
             reply["code"] = "File not found"
 
+    elif cmd == "watch_config":
+        watcher = getattr(CONNECTION, "watcher", None)
+        if watcher is None:
+            reply["code"] = "No connection to push changes to"
+        else:
+            reply.update(watcher.watch(message.get("files", [])))
+            reply["code"] = 0
+
+    elif cmd == "unwatch":
+        watcher = getattr(CONNECTION, "watcher", None)
+        if watcher is not None:
+            watcher.stop()
+        reply["code"] = 0
+
     elif cmd == "getconfigpath":
         reply["content"] = findUserConfigFile()
         reply["code"] = 0
@@ -420,33 +3130,58 @@ def handleMessage(message):
             reply["code"] = "Path not found"
 
     elif cmd == "run":
-        commands = message["command"]
-        stdin = message.get("content", "").encode("utf-8")
+        reply = run(message)
+
+    elif cmd == "cancel":
+        guard = getattr(CONNECTION, "running", {}).get(message["request"])
+        if guard is not None:
+            guard.kill("cancelled")
+        reply["code"] = 0 if guard is not None else 1
+
+    elif cmd == "run_stream":
+        reply = run_stream(message, send)
 
-        p = subprocess.Popen(commands, shell=True,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE)
+    elif cmd == "run_async":
+        reply = run_async(message)
 
-        reply["content"] = p.communicate(stdin)[0].decode("utf-8")
-        reply["code"] = p.returncode
+    elif cmd == "job_status":
+        reply.update(job_status(message))
+
+    elif cmd == "job_output":
+        reply = job_output(message)
+
+    elif cmd == "job_wait":
+        reply.update(job_wait(message))
+
+    elif cmd == "batch":
+        reply = batch(message, send)
+
+    elif cmd == "which_many":
+        reply["content"] = which_many(message["commands"])
+        reply["code"] = 0
+
+    elif cmd == "ppid":
+        reply["content"] = str(browser_pid())
+        reply["code"] = 0
+
+    elif cmd == "clipboard":
+        reply = clipboard(message)
+
+    elif cmd == "detect_profile":
+        reply.update(detect_profile(message))
+        reply["code"] = 0
+
+    elif cmd == "proc_cmdline":
+        pid = int(message.get("pid") or browser_pid())
+        reply["content"] = proc_cmdline(pid)
+        reply["code"] = 0
 
     elif cmd == "eval":
         output = eval(message["command"])
         reply["content"] = output
 
     elif cmd == "read":
-        try:
-            with open(
-                os.path.expandvars(
-                    os.path.expanduser(message["file"])
-                ),
-                "r", encoding="utf-8"
-            ) as file:
-                reply["content"] = file.read()
-                reply["code"] = 0
-        except FileNotFoundError:
-            reply["content"] = ""
-            reply["code"] = 2
+        reply.update(read_file(message, send))
 
     elif cmd == "mkdir":
         os.makedirs(
@@ -457,6 +3192,8 @@ def handleMessage(message):
         reply["code"] = 0
 
     elif cmd == "move":
+        import shutil
+
         dest = os.path.expanduser(message["to"])
         if (os.path.isfile(dest)):
             reply["code"] = 1
@@ -468,35 +3205,45 @@ def handleMessage(message):
                 reply["code"] = 2
 
     elif cmd == "write":
-        with open(message["file"], "w", encoding="utf-8") as file:
-            file.write(message["content"])
+        reply.update(write_file(message))
+
+    elif cmd == "write_begin":
+        reply = write_begin(message)
+
+    elif cmd == "write_chunk":
+        reply = write_chunk(message)
+
+    elif cmd == "write_commit":
+        reply = write_commit(message)
+
+    elif cmd == "write_abort":
+        reply = write_abort(message)
 
     elif cmd == "writerc":
         path = os.path.expanduser(message["file"])
         if not os.path.isfile(path) or message["force"]:
             try:
-                with open(path, "w", encoding="utf-8") as file:
-                    file.write(message["content"])
-                    reply["code"] = 0 # Success.
+                atomic_write(path, message["content"].encode("utf-8"))
+                reply["code"] = 0 # Success.
             except EnvironmentError:
                 reply["code"] = 2 # Some OS related error.
         else:
             reply["code"] = 1 # File exist, send force="true" or try another filename.
 
     elif cmd == "temp":
-        prefix = message.get("prefix")
-        if prefix is None:
-            prefix = ""
-        prefix = "tmp_{}_".format(sanitizeFilename(prefix))
+        reply["content"] = make_temp_file(
+            message["content"], message.get("prefix")
+        )
 
-        (handle, filepath) = tempfile.mkstemp(prefix=prefix, suffix=".txt")
-        with os.fdopen(handle, "w", encoding="utf-8") as file:
-            file.write(message["content"])
-        reply["content"] = filepath
+    elif cmd == "edit":
+        reply.update(edit(message))
 
     elif cmd == "env":
         reply["content"] = getenv(message["var"], "")
 
+    elif cmd in ("env_many", "env_snapshot"):
+        reply = env_many(message)
+
     elif cmd == "win_firefox_restart":
         reply = win_firefox_restart(message)
 
@@ -504,11 +3251,32 @@ def handleMessage(message):
         path = os.path.expanduser(message.get("path"))
         reply["sep"] = os.sep
         reply["isDir"] = os.path.isdir(path)
+        options = message
         if not reply["isDir"]:
+            if message.get("complete"):
+                # Completing a partially typed name: it's the filter
+                options = dict(message, fuzzy=os.path.basename(path))
             path = os.path.dirname(path)
             if not path:
                 path = "./"
-        reply["files"] = os.listdir(path)
+        reply.update(list_dir(path, options))
+
+    elif cmd == "index":
+        reply.update(index_root(message))
+
+    elif cmd == "find_files":
+        reply.update(find_files(message))
+
+    elif cmd == "stats":
+        reply.update(METRICS.snapshot(reset=message.get("reset", False)))
+        reply["log"] = LOG_PATH
+
+    elif cmd == "log":
+        if message.get("enabled", True):
+            reply["path"] = enable_log(message.get("path"))
+        else:
+            disable_log()
+            reply["path"] = None
 
     else:
         reply = {"cmd": "error", "error": "Unhandled message"}
@@ -517,7 +3285,326 @@ def handleMessage(message):
     return reply
 
 
-while True:
-    message = getMessage()
-    reply = handleMessage(message)
-    sendMessage(encodeMessage(reply))
+def safeHandleMessage(message, send=None):
+    """ Like handleMessage, but turns exceptions into error replies. """
+    try:
+        return handleMessage(message, send)
+    except Exception as e:
+        eprint("Error handling message: {}".format(message.get("cmd")))
+        return {"cmd": "error", "error": "{}: {}".format(
+            type(e).__name__, e
+        )}
+
+
+def answer(message, send):
+    """ Reply to a message, tagging the reply with the message's id.
+    Partial replies go straight to send().
+
+    Exceptions are turned into error replies so that one bad request
+    doesn't take down every other request in flight on the same port.
+    """
+    def send_partial(partial):
+        if "id" in message:
+            partial["id"] = message["id"]
+        send(partial)
+
+    reply = safeHandleMessage(message, send_partial)
+    if "id" in message:
+        reply["id"] = message["id"]
+    return reply
+
+
+# State of the connection served by the current thread
+CONNECTION = threading.local()
+
+
+class Tracer:
+    """ Records the messages of every connection to TRACE_FILE, one JSON
+    object per line, for gen_native_message.py replay:
+
+        {"t": time.time(), "conn": "<pid>-<n>", "dir": "in" or "out",
+         "message": {...}}
+
+    Lines are appended with a single write each, so the one-shot
+    processes Firefox starts can all share a trace. With TRACE_REDACT,
+    "content" strings are replaced by as many "x"s, keeping their sizes
+    but not file contents or command output.
+    """
+
+    lock = threading.Lock()
+    fd = None
+    connections = 0
+
+    def __init__(self):
+        with self.lock:
+            Tracer.connections += 1
+            self.conn = "%d-%d" % (os.getpid(), Tracer.connections)
+
+    @classmethod
+    def redact(cls, value):
+        if isinstance(value, dict):
+            return {
+                key: "x" * len(item)
+                if key == "content" and isinstance(item, str)
+                else cls.redact(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [cls.redact(item) for item in value]
+        return value
+
+    def record(self, direction, message):
+        if TRACE_REDACT:
+            message = self.redact(message)
+        line = json.dumps({
+            "t": time.time(),
+            "conn": self.conn,
+            "dir": direction,
+            "message": message,
+        }) + "\n"
+        with self.lock:
+            if Tracer.fd is None:
+                Tracer.fd = os.open(
+                    TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+                )
+            os.write(Tracer.fd, line.encode("utf-8"))
+
+
+def browser_pid():
+    """ pid of the browser we're talking to: our parent, unless we're a
+    daemon, in which case it's the parent of the launcher relaying for us.
+    """
+    return getattr(CONNECTION, "browser_pid", None) or os.getppid()
+
+
+class Connection:
+    """ One conversation with the browser, over stdio or a daemon socket.
+
+    Messages without an id come from clients that expect replies in order,
+    so they are answered inline. Messages with an id are handed to a pool
+    of worker threads and answered in completion order, so one slow "run"
+    doesn't hold up everything behind it. Replies are written under a
+    single lock so that frames never interleave.
+    """
+
+    def __init__(self, instream=None, outstream=None, relayed=False):
+        self.reader = MessageReader(instream)
+        self.writer = MessageWriter(outstream)
+        # Whether we're a daemon talking to the browser through
+        # native_launcher.py, which introduces itself with a "hello"
+        self.relayed = relayed
+        self.browser_pid = None
+        self.write_lock = threading.Lock()
+        # Backpressure: reading blocks while every slot is taken
+        self.slots = threading.BoundedSemaphore(MAX_WORKERS + MAX_QUEUED)
+        self.executor = None
+        self.tracer = Tracer() if TRACE_FILE else None
+        # ChildGuards of the commands run for messages, by message id
+        self.running = {}
+        self.watcher = ConfigWatcher(self.send)
+
+    def send(self, reply):
+        if self.tracer:
+            self.tracer.record("out", reply)
+        encoded = encodeMessage(reply)
+        with self.write_lock:
+            self.writer.write(encoded)
+        return len(encoded)
+
+    def enter(self):
+        """ Make this connection the current one for this thread """
+        CONNECTION.browser_pid = self.browser_pid
+        CONNECTION.running = self.running
+        CONNECTION.watcher = self.watcher
+
+    def respond(self, message, size):
+        """ Answer message, which was size bytes, accounting for it in
+        METRICS
+        """
+        start = time.perf_counter()
+        sent = 0
+        final = {}
+
+        def send(reply):
+            nonlocal sent, final
+            sent += self.send(reply)
+            final = reply
+
+        try:
+            send(answer(message, send))
+        finally:
+            METRICS.command(
+                message.get("cmd"), time.perf_counter() - start, size, sent,
+                final.get("cmd") == "error",
+            )
+
+    def dispatch(self, message, size):
+        if self.relayed and message.get("cmd") == "hello":
+            self.browser_pid = message.get("ppid")
+            self.enter()
+            return
+        if "id" not in message or message.get("cmd") == "cancel":
+            # A cancel mustn't queue up behind what it is cancelling
+            self.respond(message, size)
+            return
+        if self.executor is None:
+            import concurrent.futures
+
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, initializer=self.enter
+            )
+        self.slots.acquire()
+        self.executor.submit(self.work, message, size)
+
+    def work(self, message, size):
+        try:
+            self.respond(message, size)
+        except OSError:
+            # The browser went away; the read loop will notice too.
+            pass
+        finally:
+            self.slots.release()
+
+    def serve(self):
+        """ Answer messages until the other end hangs up. """
+        self.enter()
+        try:
+            while True:
+                try:
+                    message = self.reader.read()
+                except NoConnectionError:
+                    return
+                except (MessageTooLargeError, ValueError) as e:
+                    reply = {"cmd": "error", "error": "{}: {}".format(
+                        type(e).__name__, e
+                    )}
+                    if self.reader.failed_id is not None:
+                        reply["id"] = self.reader.failed_id
+                    self.send(reply)
+                    continue
+                if self.tracer:
+                    self.tracer.record("in", message)
+                self.dispatch(message, self.reader.size)
+        finally:
+            self.watcher.stop()
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            flush_log()
+
+
+def serve(instream=None, outstream=None, relayed=False):
+    Connection(instream, outstream, relayed).serve()
+
+
+class Daemon:
+    """ Resident messenger listening on a per-user Unix socket.
+
+    Each connection speaks exactly the same framed protocol as stdio, so
+    native_launcher.py can relay Firefox's pipes to it byte for byte. The
+    daemon exits after DAEMON_IDLE_TIMEOUT seconds without a connection,
+    or once native_main.py has been replaced on disk (e.g. by an update).
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_activity = time.monotonic()
+        self.source_mtime = self._source_mtime()
+
+    @staticmethod
+    def _source_mtime():
+        try:
+            return os.stat(os.path.abspath(__file__)).st_mtime
+        except OSError:
+            return None
+
+    def opened(self):
+        with self.lock:
+            self.active += 1
+            self.last_activity = time.monotonic()
+
+    def closed(self):
+        with self.lock:
+            self.active -= 1
+            self.last_activity = time.monotonic()
+
+    def should_exit(self):
+        with self.lock:
+            if self.active:
+                return False
+            idle = time.monotonic() - self.last_activity
+        return (
+            idle > DAEMON_IDLE_TIMEOUT
+            or self._source_mtime() != self.source_mtime
+        )
+
+    def watchdog(self, server):
+        while True:
+            time.sleep(min(DAEMON_IDLE_TIMEOUT, 5))
+            if self.should_exit():
+                server.shutdown()
+                return
+
+    def run(self):
+        import fcntl
+        import socketserver
+
+        # Only one daemon may own the socket: losers of a startup race
+        # simply exit and the launchers connect to the winner.
+        lock_file = open(self.socket_path + ".lock", "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.opened()
+                try:
+                    serve(self.rfile, self.wfile, relayed=True)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    daemon.closed()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        old_umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(
+                self.socket_path, Handler
+            )
+        finally:
+            os.umask(old_umask)
+        server.daemon_threads = True
+
+        threading.Thread(
+            target=self.watchdog, args=(server,), daemon=True
+        ).start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+            lock_file.close()
+
+
+def main():
+    if LOG_FILE:
+        enable_log(None if LOG_FILE == "1" else LOG_FILE)
+    if len(sys.argv) > 2 and sys.argv[1] == "--daemon":
+        Daemon(sys.argv[2]).run()
+    elif len(sys.argv) > 2 and sys.argv[1] == "--job":
+        run_job(sys.argv[2])
+    else:
+        serve()
+
+
+if __name__ == "__main__":
+    main()
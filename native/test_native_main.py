@@ -0,0 +1,779 @@
+#!/usr/bin/env python3
+"""Tests for native_main.py.
+
+Most of them run the messenger the way Firefox does, talking to it over its
+stdin and stdout, so they cover the framing and dispatch too. Run them with
+
+    python3 -m unittest discover -s native
+"""
+
+import hashlib
+import json
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NATIVE_MAIN = os.path.join(HERE, "native_main.py")
+
+sys.path.insert(0, HERE)
+import native_main  # noqa: E402
+
+
+class Messenger:
+    """ A native_main.py process and the replies it has sent so far """
+
+    def __init__(self, env=None):
+        self.proc = subprocess.Popen(
+            [sys.executable, NATIVE_MAIN],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=dict(os.environ, **(env or {})),
+        )
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def send(self, *messages):
+        for message in messages:
+            encoded = json.dumps(message).encode("utf-8")
+            self.proc.stdin.write(struct.pack("@I", len(encoded)) + encoded)
+        self.proc.stdin.flush()
+
+    def read(self):
+        while True:
+            header = self.proc.stdout.read(4)
+            if len(header) < 4:
+                return
+            length = struct.unpack("@I", header)[0]
+            self.replies.put(json.loads(self.proc.stdout.read(length)))
+
+    def reply(self, timeout=10):
+        return self.replies.get(timeout=timeout)
+
+    def final(self, timeout=10):
+        """ The next reply that isn't a partial one """
+        while True:
+            reply = self.reply(timeout)
+            if not reply.get("more"):
+                return reply
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait(10)
+        self.proc.stdout.close()
+
+
+class MessengerTestCase(unittest.TestCase):
+    env = {}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def messenger(self, **env):
+        # Keep jobs, uploads and temporary files in our directory
+        env = dict(self.env, HOME=self.tmp, TMPDIR=self.tmp, **env)
+        messenger = Messenger(env)
+        self.addCleanup(messenger.close)
+        return messenger
+
+    def path(self, *names):
+        return os.path.join(self.tmp, *names)
+
+
+class TestConcurrency(MessengerTestCase):
+    def test_fast_reply_overtakes_slow_run(self):
+        m = self.messenger()
+        m.send(
+            {"cmd": "run", "command": "sleep 1; echo slow", "id": 1},
+            {"cmd": "version", "id": 2},
+        )
+
+        first, second = m.reply(), m.reply()
+
+        self.assertEqual(first["id"], 2)
+        self.assertIn("version", first)
+        self.assertEqual(second["id"], 1)
+        self.assertEqual(second["content"], "slow\n")
+
+    def test_messages_without_id_are_answered_in_order(self):
+        m = self.messenger()
+        m.send(
+            {"cmd": "run", "command": "sleep 0.5; echo slow"},
+            {"cmd": "version"},
+        )
+
+        self.assertEqual(m.reply()["content"], "slow\n")
+        self.assertIn("version", m.reply())
+
+    def test_reading_stops_while_every_slot_is_taken(self):
+        m = self.messenger(
+            TRIDACTYL_NATIVE_WORKERS="1", TRIDACTYL_NATIVE_QUEUE="0"
+        )
+        m.send(
+            {"cmd": "run", "command": "sleep 0.5", "id": 1},
+            {"cmd": "version", "id": 2},
+            # Answered inline as soon as it's read, so only after the
+            # slot 1 holds is freed
+            {"cmd": "version"},
+        )
+
+        self.assertEqual(m.reply()["id"], 1)
+        self.assertEqual(
+            {m.reply().get("id"), m.reply().get("id")}, {2, None}
+        )
+
+    def test_cancel_kills_a_running_command(self):
+        m = self.messenger()
+        m.send({
+            "cmd": "run_stream",
+            "command": "echo started; exec sleep 30",
+            "id": 1,
+        })
+        self.assertEqual(m.reply()["content"], "started\n")
+        start = time.monotonic()
+
+        m.send({"cmd": "cancel", "request": 1, "id": 2})
+        replies = {reply["id"]: reply for reply in (m.reply(), m.final())}
+
+        self.assertEqual(replies[2]["code"], 0)
+        self.assertTrue(replies[1]["cancelled"])
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_cancelling_an_unknown_request_fails(self):
+        m = self.messenger()
+        m.send({"cmd": "cancel", "request": 41, "id": 42})
+
+        self.assertEqual(m.reply(), {"cmd": "cancel", "code": 1, "id": 42})
+
+    def test_pipelined_list_dirs_in_parallel(self):
+        # More directories than DIR_CACHE holds, so that listings are
+        # evicted while other workers are reading the cache
+        count = native_main.DIR_CACHE_SIZE + 8
+        for d in range(count):
+            os.mkdir(self.path(str(d)))
+            for f in range(d % 5):
+                open(self.path(str(d), "file%d" % f), "w").close()
+        m = self.messenger(TRIDACTYL_NATIVE_WORKERS="8")
+
+        requests = 10 * count
+        m.send(*(
+            {"cmd": "list_dir", "path": self.path(str(i % count)), "id": i}
+            for i in range(requests)
+        ))
+        replies = [m.reply() for _ in range(requests)]
+
+        self.assertEqual(
+            sorted(reply["id"] for reply in replies), list(range(requests))
+        )
+        for reply in replies:
+            d = reply["id"] % count
+            self.assertEqual(
+                sorted(reply["files"]),
+                ["file%d" % f for f in range(d % 5)],
+            )
+
+
+class TestBatch(MessengerTestCase):
+    def batch(self, messages, **options):
+        m = self.messenger()
+        m.send(dict(options, cmd="batch", messages=messages))
+        return m.reply()
+
+    def test_refs_take_fields_from_earlier_replies(self):
+        reply = self.batch([
+            {"cmd": "temp", "content": "hello", "prefix": "batch"},
+            {"cmd": "read", "refs": {"file": "0.content"}},
+        ])
+
+        temp, read = reply["replies"]
+        self.assertEqual(reply["code"], 0)
+        self.assertEqual(os.path.dirname(temp["content"]), self.tmp)
+        self.assertEqual(read["content"], "hello")
+
+    def test_fields_not_named_in_refs_are_left_alone(self):
+        target = self.path("target")
+        reply = self.batch([
+            {"cmd": "version"},
+            {"cmd": "write", "file": target, "content": "0.content $0"},
+        ])
+
+        self.assertEqual(reply["code"], 0)
+        with open(target) as file:
+            self.assertEqual(file.read(), "0.content $0")
+
+    def test_stops_at_the_first_failure(self):
+        reply = self.batch([
+            {"cmd": "read", "file": self.path("missing")},
+            {"cmd": "write", "file": self.path("written"), "content": ""},
+        ])
+
+        self.assertEqual(reply["code"], 1)
+        self.assertEqual(len(reply["replies"]), 1)
+        self.assertNotEqual(reply["replies"][0]["code"], 0)
+        self.assertFalse(os.path.exists(self.path("written")))
+
+    def test_carries_on_after_failures_if_asked_to(self):
+        reply = self.batch([
+            {"cmd": "read", "file": self.path("missing")},
+            {"cmd": "write", "file": self.path("written"), "content": ""},
+        ], stop_on_error=False)
+
+        self.assertEqual(reply["code"], 1)
+        self.assertEqual(reply["replies"][1]["code"], 0)
+        self.assertTrue(os.path.exists(self.path("written")))
+
+    def test_bad_refs_are_errors(self):
+        reply = self.batch([
+            {"cmd": "version"},
+            {"cmd": "read", "refs": {"file": "0.content"}},
+            {"cmd": "read", "refs": {"file": "5.content"}},
+        ], stop_on_error=False)
+
+        self.assertEqual(
+            [r.get("error") for r in reply["replies"][1:]],
+            ["no result 0.content in batch", "no result 5.content in batch"],
+        )
+
+
+class TestEdit(MessengerTestCase):
+    def edit(self, editorcmd, **message):
+        m = self.messenger()
+        m.send(dict(message, cmd="edit", editorcmd=editorcmd))
+        return m.reply()
+
+    def test_returns_what_the_editor_left_and_cleans_up(self):
+        reply = self.edit("sed -i s/hello/bye/", content="hello")
+
+        self.assertEqual(reply["code"], 0)
+        self.assertEqual(reply["content"], "bye")
+        self.assertFalse(os.path.exists(reply["file"]))
+        self.assertEqual(
+            set(reply["timings"]), {"write", "editor", "read", "cleanup"}
+        )
+
+    def test_fills_in_the_file_line_and_column(self):
+        reply = self.edit(
+            "sh -c 'echo \"$0 $1\" > \"$2\"' %l %c %f",
+            content="", line=3, col=7,
+        )
+
+        self.assertEqual(reply["content"], "3 7\n")
+
+    def test_a_failing_editor_reports_its_output(self):
+        reply = self.edit("sh -c 'echo oops; exit 3'", content="hello")
+
+        self.assertEqual(reply["code"], 3)
+        self.assertEqual(reply["content"], "oops\n")
+        self.assertFalse(os.path.exists(reply["file"]))
+
+    def test_the_editor_is_killed_after_its_timeout(self):
+        start = time.monotonic()
+        reply = self.edit(
+            "sh -c 'exec sleep 30'", content="hello", timeout=0.5
+        )
+
+        self.assertTrue(reply["timed_out"])
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(os.path.exists(reply["file"]))
+
+    def test_keep_leaves_the_file(self):
+        reply = self.edit("true", content="hello", keep=True)
+
+        with open(reply["file"]) as file:
+            self.assertEqual(file.read(), "hello")
+
+
+class TestWrites(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.m = self.messenger()
+        # Away from the uploads in $HOME/.tridactyl
+        self.dir = self.path("files")
+        os.mkdir(self.dir)
+
+    def file(self, name):
+        return os.path.join(self.dir, name)
+
+    def ask(self, **message):
+        self.m.send(message)
+        return self.m.reply()
+
+    def begin(self, name, **options):
+        return self.ask(
+            cmd="write_begin", file=self.file(name), **options
+        )["session"]
+
+    def content(self, name):
+        with open(self.file(name)) as file:
+            return file.read()
+
+    def test_write_replaces_the_file_and_reports_its_hash(self):
+        with open(self.file("file"), "w") as file:
+            file.write("old content")
+
+        reply = self.ask(cmd="write", file=self.file("file"), content="new")
+
+        self.assertEqual(reply["code"], 0)
+        self.assertEqual(reply["size"], 3)
+        self.assertEqual(reply["sha256"], hashlib.sha256(b"new").hexdigest())
+        self.assertEqual(self.content("file"), "new")
+        self.assertEqual(os.listdir(self.dir), ["file"])
+
+    def test_write_through_a_symlink_replaces_its_target(self):
+        with open(self.file("target"), "w") as file:
+            file.write("old")
+        os.symlink("target", self.file("link"))
+
+        self.ask(cmd="write", file=self.file("link"), content="new")
+
+        self.assertTrue(os.path.islink(self.file("link")))
+        self.assertEqual(self.content("target"), "new")
+
+    def test_append(self):
+        for content in ("one ", "two"):
+            self.ask(
+                cmd="write", file=self.file("log"), content=content,
+                append=True,
+            )
+
+        self.assertEqual(self.content("log"), "one two")
+
+    def test_chunked_write_only_appears_on_commit(self):
+        with open(self.file("file"), "w") as file:
+            file.write("old")
+        session = self.begin("file")
+        for offset, chunk in ((0, "héllo "), (7, "world")):
+            reply = self.ask(
+                cmd="write_chunk", session=session, content=chunk,
+                offset=offset,
+            )
+        self.assertEqual(reply["size"], 12)
+        self.assertEqual(self.content("file"), "old")
+
+        reply = self.ask(
+            cmd="write_commit", session=session,
+            sha256=hashlib.sha256("héllo world".encode()).hexdigest(),
+        )
+
+        self.assertEqual(reply["code"], 0)
+        self.assertEqual(self.content("file"), "héllo world")
+        self.assertEqual(os.listdir(self.dir), ["file"])
+
+    def test_chunk_at_the_wrong_offset_is_refused(self):
+        session = self.begin("file")
+        self.ask(cmd="write_chunk", session=session, content="abc")
+
+        reply = self.ask(
+            cmd="write_chunk", session=session, content="abc", offset=0,
+        )
+
+        self.assertEqual(reply["cmd"], "error")
+        self.assertIn("3 bytes were written", reply["error"])
+
+    def test_commit_with_the_wrong_hash_writes_nothing(self):
+        session = self.begin("file")
+        self.ask(cmd="write_chunk", session=session, content="abc")
+
+        reply = self.ask(cmd="write_commit", session=session, sha256="0")
+
+        self.assertEqual(reply["cmd"], "error")
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_chunked_append(self):
+        with open(self.file("log"), "w") as file:
+            file.write("one ")
+        session = self.begin("log", append=True)
+        self.ask(cmd="write_chunk", session=session, content="two")
+
+        self.ask(cmd="write_commit", session=session)
+
+        self.assertEqual(self.content("log"), "one two")
+
+    def test_abort_throws_the_write_away(self):
+        session = self.begin("file")
+        self.ask(cmd="write_chunk", session=session, content="abc")
+
+        self.assertEqual(
+            self.ask(cmd="write_abort", session=session)["code"], 0
+        )
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(
+            self.ask(cmd="write_commit", session=session)["cmd"], "error"
+        )
+
+
+class TestJobs(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.m = self.messenger()
+
+    def ask(self, **message):
+        self.m.send(message)
+        return self.m.reply()
+
+    def start(self, command, **options):
+        reply = self.ask(cmd="run_async", command=command, **options)
+        self.assertEqual(reply["code"], 0)
+        return reply["job"]
+
+    def test_job_runs_in_the_background(self):
+        job = self.start("echo out; echo err >&2; exit 3")
+
+        state = self.ask(cmd="job_wait", job=job)
+
+        self.assertEqual(state["state"], "exited")
+        self.assertEqual(state["code"], 3)
+        self.assertFalse(state["timed_out"])
+        output = self.ask(cmd="job_output", job=job)
+        self.assertEqual(output["content"], "out\nerr\n")
+        self.assertTrue(output["eof"])
+
+    def test_job_outlives_the_messenger(self):
+        job = self.start("sleep 0.5; echo done")
+        self.m.close()
+        self.m = self.messenger()
+
+        self.assertEqual(self.ask(cmd="job_wait", job=job)["code"], 0)
+        self.assertEqual(
+            self.ask(cmd="job_output", job=job)["content"], "done\n"
+        )
+
+    def test_wait_times_out_on_a_running_job(self):
+        job = self.start("sleep 1")
+
+        state = self.ask(cmd="job_wait", job=job, timeout=0.1)
+
+        self.assertEqual(state["state"], "running")
+        self.assertTrue(state["timed_out"])
+        self.assertEqual(self.ask(cmd="job_wait", job=job)["code"], 0)
+
+    def test_output_is_read_in_whole_characters(self):
+        job = self.start("printf 'aé€😀'")
+        self.ask(cmd="job_wait", job=job)
+
+        chunks = []
+        offset = 0
+        while True:
+            output = self.ask(
+                cmd="job_output", job=job, offset=offset, length=1,
+            )
+            chunks.append(output["content"])
+            offset = output["next_offset"]
+            if output["eof"]:
+                break
+
+        self.assertEqual(chunks, ["aé", "€", "😀"])
+
+    def test_output_is_capped(self):
+        job = self.start("printf 0123456789", max_output=4)
+
+        state = self.ask(cmd="job_wait", job=job)
+
+        self.assertTrue(state["truncated"])
+        self.assertEqual(state["bytes"], 10)
+        self.assertEqual(
+            self.ask(cmd="job_output", job=job)["content"], "0123"
+        )
+
+    def test_status_of_every_job(self):
+        jobs = [self.start("true"), self.start("true")]
+        for job in jobs:
+            self.ask(cmd="job_wait", job=job)
+
+        states = self.ask(cmd="job_status")["jobs"]
+
+        self.assertEqual(jobs[1], jobs[0] + 1)
+        self.assertEqual([state["job"] for state in states], jobs)
+
+    def test_unknown_job(self):
+        reply = self.ask(cmd="job_status", job=99)
+
+        self.assertEqual(reply["cmd"], "error")
+        self.assertIn("No job 99", reply["error"])
+
+
+class TestEnvironment(MessengerTestCase):
+    env = {
+        "TRIDACTYL_TEST_A": "a",
+        "TRIDACTYL_TEST_B": "b",
+        "TRIDACTYL_OTHER": "c",
+    }
+
+    def ask(self, **message):
+        m = self.messenger()
+        m.send(message)
+        return m.reply()
+
+    def test_env_many(self):
+        reply = self.ask(
+            cmd="env_many", vars=["TRIDACTYL_TEST_A", "TRIDACTYL_UNSET"],
+        )
+
+        self.assertEqual(reply["code"], 0)
+        self.assertEqual(
+            reply["content"],
+            {"TRIDACTYL_TEST_A": "a", "TRIDACTYL_UNSET": None},
+        )
+
+    def test_env_snapshot_matches_patterns(self):
+        reply = self.ask(
+            cmd="env_snapshot", match=["TRIDACTYL_TEST_*", "TRIDACTYL_OTHER"],
+        )
+
+        self.assertEqual(reply["content"], self.env)
+
+    def test_env_snapshot_defaults_to_everything(self):
+        content = self.ask(cmd="env_snapshot")["content"]
+
+        self.assertEqual(content["TRIDACTYL_OTHER"], "c")
+        self.assertEqual(content["HOME"], self.tmp)
+
+    def test_paths_are_expanded(self):
+        reply = self.ask(
+            cmd="env_many", vars=[],
+            paths=["~/rc", "$TRIDACTYL_TEST_A/$TRIDACTYL_UNSET"],
+        )
+
+        self.assertEqual(reply["paths"], [
+            os.path.join(self.tmp, "rc"), "a/$TRIDACTYL_UNSET",
+        ])
+
+
+# Keeps the selection in a file next to itself
+FAKE_XSEL = """\
+#!/bin/sh
+store="$(dirname "$0")/selection$2"
+case "$1" in
+    -o) exec cat "$store" ;;
+    -i) exec cat > "$store" ;;
+esac
+exit 2
+"""
+
+
+class TestClipboard(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        bin_dir = self.path("bin")
+        os.mkdir(bin_dir)
+        self.xsel = os.path.join(bin_dir, "xsel")
+        with open(self.xsel, "w") as file:
+            file.write(FAKE_XSEL)
+        os.chmod(self.xsel, 0o755)
+        self.m = self.messenger(
+            PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+            DISPLAY=":0",
+            WAYLAND_DISPLAY="",
+        )
+
+    def ask(self, **message):
+        self.m.send(dict(message, cmd="clipboard"))
+        return self.m.reply()
+
+    def test_set_and_get(self):
+        reply = self.ask(action="set", content="yanked", selection="clipboard")
+
+        self.assertEqual(reply["code"], 0)
+        self.assertEqual(reply["backend"], "xsel")
+        self.assertEqual(reply["argv"], [self.xsel, "-i", "-b"])
+        self.assertEqual(
+            self.ask(action="get", selection="clipboard")["content"],
+            "yanked",
+        )
+
+    def test_a_failing_tool_is_reported_with_its_argv(self):
+        reply = self.ask(action="get")
+
+        self.assertNotEqual(reply["code"], 0)
+        self.assertEqual(reply["argv"], [self.xsel, "-o", "-p"])
+
+    def test_a_hanging_tool_is_killed(self):
+        with open(self.xsel, "w") as file:
+            file.write("#!/bin/sh\nexec sleep 30\n")
+
+        reply = self.ask(action="get", timeout=0.5)
+
+        self.assertTrue(reply["timed_out"])
+
+
+class TestWatchConfig(MessengerTestCase):
+    env = {"TRIDACTYL_NATIVE_POLL_INTERVAL": "0.2"}
+
+    def setUp(self):
+        super().setUp()
+        self.rc = self.path(".tridactylrc")
+
+    def write(self, path, content="set smoothscroll true\n"):
+        with open(path, "w") as file:
+            file.write(content)
+
+    def test_watch_covers_the_candidates_and_extra_files(self):
+        m = self.messenger(XDG_CONFIG_HOME=self.path("config"))
+        m.send({"cmd": "watch_config", "files": ["~/extra"], "id": 1})
+
+        reply = m.reply()
+
+        self.assertEqual(reply["code"], 0)
+        self.assertIn(self.rc, reply["paths"])
+        self.assertEqual(reply["paths"][-1], self.path("extra"))
+        self.assertIn(reply["backend"], ["inotify", "poll"])
+
+    def test_changes_are_pushed_without_an_id(self):
+        m = self.messenger()
+        m.send({"cmd": "watch_config", "id": 1})
+        m.reply()
+
+        self.write(self.rc)
+
+        self.assertEqual(m.reply(), {
+            "cmd": "configchanged",
+            "path": self.rc,
+            "exists": True,
+            "config": self.rc,
+        })
+
+    def test_watching_takes_no_worker(self):
+        m = self.messenger(
+            TRIDACTYL_NATIVE_WORKERS="1", TRIDACTYL_NATIVE_QUEUE="0"
+        )
+        m.send(
+            {"cmd": "watch_config", "id": 1},
+            {"cmd": "run", "command": "echo hi", "id": 2},
+        )
+
+        self.assertEqual(m.reply()["id"], 1)
+        self.assertEqual(m.reply()["content"], "hi\n")
+
+    def test_directories_created_later_are_noticed(self):
+        m = self.messenger()
+        extra = self.path("sub", "dir", "rc")
+        m.send({"cmd": "watch_config", "files": [extra], "id": 1})
+        m.reply()
+
+        os.makedirs(os.path.dirname(extra))
+        self.write(extra)
+
+        self.assertEqual(m.reply()["path"], extra)
+
+    def test_unwatch(self):
+        m = self.messenger()
+        m.send({"cmd": "watch_config", "id": 1}, {"cmd": "unwatch", "id": 2})
+        m.reply(), m.reply()
+
+        self.write(self.rc)
+        time.sleep(0.5)
+        m.send({"cmd": "version", "id": 3})
+
+        self.assertEqual(m.reply()["id"], 3)
+
+
+PROFILES_INI = """\
+[General]
+StartWithLastProfile=1
+
+[Profile0]
+Name=default
+IsRelative=1
+Path=abc.default
+Default=1
+
+[Profile1]
+Name=work
+IsRelative=0
+Path={}
+"""
+
+
+class TestDetectProfile(unittest.TestCase):
+    def setUp(self):
+        self.ff_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.ff_dir)
+        self.default = os.path.join(self.ff_dir, "abc.default")
+        self.work = os.path.join(self.ff_dir, "elsewhere", "work")
+        for path in (self.default, self.work):
+            os.makedirs(path)
+        with open(os.path.join(self.ff_dir, "profiles.ini"), "w") as file:
+            file.write(PROFILES_INI.format(self.work))
+        self.argv = ["firefox"]
+        self.cmdline_reads = 0
+        patcher = unittest.mock.patch.object(
+            native_main, "proc_cmdline", self.proc_cmdline
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        native_main.DETECTED_PROFILES.clear()
+
+    def proc_cmdline(self, pid):
+        self.cmdline_reads += 1
+        return self.argv
+
+    def detect(self, **message):
+        result = native_main.detect_profile(
+            dict(message, firefox_dir=self.ff_dir)
+        )
+        return result["profile"]["absolutePath"], result["how"]
+
+    def test_profiledir_setting_wins(self):
+        self.argv = ["firefox", "--profile", self.default]
+
+        self.assertEqual(
+            self.detect(profiledir=self.work), (self.work, "profiledir")
+        )
+
+    def test_profile_path_on_the_command_line(self):
+        self.argv = ["firefox", "--profile", "/some/profile"]
+
+        self.assertEqual(self.detect(), ("/some/profile", "cmdline"))
+
+    def test_profile_name_on_the_command_line(self):
+        self.argv = ["firefox", "-P", "work"]
+
+        self.assertEqual(self.detect(), (self.work, "cmdline"))
+
+    def test_unknown_profile_name_on_the_command_line(self):
+        self.argv = ["firefox", "-P", "play"]
+
+        with self.assertRaisesRegex(ValueError, "no matching profile"):
+            self.detect()
+
+    @unittest.skipIf(os.name == "nt", "Locks aren't looked at on Windows")
+    def test_only_locked_profile(self):
+        lock = ".parentlock" if sys.platform == "darwin" else "lock"
+        os.symlink("127.0.0.1:+1234", os.path.join(self.work, lock))
+
+        self.assertEqual(self.detect(), (self.work, "lock"))
+
+    def test_default_profile(self):
+        self.assertEqual(self.detect(), (self.default, "default"))
+
+    def test_answer_is_kept_while_profiles_ini_is_unchanged(self):
+        self.argv = ["firefox", "-P", "work"]
+        self.assertEqual(self.detect(), (self.work, "cmdline"))
+
+        self.argv = ["firefox"]
+        self.assertEqual(self.detect(), (self.work, "cmdline"))
+        self.assertEqual(self.cmdline_reads, 1)
+
+        with open(os.path.join(self.ff_dir, "profiles.ini"), "a") as file:
+            file.write("\n")
+        self.assertEqual(self.detect(), (self.default, "default"))
+
+    def test_nothing_to_go_on(self):
+        os.remove(os.path.join(self.ff_dir, "profiles.ini"))
+
+        with self.assertRaisesRegex(ValueError, "Couldn't deduce"):
+            self.detect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Compare the cost of cmd_params to a content script before and after.
+
+cmd_params used to be filled in by one cmd_params.set(name, new Map(...))
+statement per excmd, run whenever excmds.ts is evaluated, i.e. in every tab.
+excmds_macros.py now emits a single table that is only unpacked on first use.
+
+Both versions are generated from the current src/excmds.ts. The old one is
+made of excmds_macros.dict_to_js's Maps. The new one is the declaration
+excmds_macros.py emits into the content script's excmds, with cmdParamTable
+from there and LazyMap from src/lib/memoise.ts, bundled by esbuild as in a
+build. Each is evaluated repeatedly by node, each time as fresh source so
+that it is parsed again, as it is in a new tab. Reports the median time to
+evaluate each and the time to evaluate and then look up an excmd's
+parameters. Also checks that the two produce the same cmd_params.
+
+Run from the root of the repository, after yarn install; needs node.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import excmds_macros  # noqa: E402
+
+
+def before(signatures):
+    "cmd_params as excmds_macros.py used to emit it"
+    return "const cmd_params = new Map()\n" + "".join(
+        "cmd_params.set('{}', {})\n".format(
+            name, excmds_macros.dict_to_js(params))
+        for name, params in signatures.items()
+    )
+
+
+AFTER_ENTRY = """\
+import {{ LazyMap }} from "./src/lib/memoise"
+{table}
+{declaration}
+Object.assign(globalThis, {{ cmd_params }})
+"""
+
+
+def after(text):
+    """TypeScript for cmd_params as excmds_macros.py emits it into text, a
+    version of excmds.ts: its declaration and cmdParamTable, with LazyMap.
+    """
+    lines = iter(text.splitlines(keepends=True))
+    table = declaration = None
+    for line in lines:
+        if line.startswith("export const cmd_params"):
+            declaration = [line]
+            # ParamTable.render ends it with an unindented )
+            while declaration[-1] != ")\n":
+                declaration.append(next(lines))
+            declaration = "".join(declaration)
+        elif line.startswith("function cmdParamTable("):
+            table = excmds_macros.get_block(itertools.chain([line], lines))
+    if table is None or declaration is None:
+        sys.exit("Couldn't find cmd_params and cmdParamTable in excmds.ts!")
+    return AFTER_ENTRY.format(table=table, declaration=declaration)
+
+
+HARNESS = """\
+const vm = require("vm")
+const esbuild = require("esbuild")
+const { variants, after, runs, lookup } = JSON.parse(
+    require("fs").readFileSync(0),
+)
+
+// Bundled like scripts/esbuild.js bundles the content script
+variants.after = esbuild.buildSync({
+    stdin: {
+        contents: after,
+        resolveDir: process.cwd(),
+        sourcefile: "cmd_params.ts",
+        loader: "ts",
+    },
+    bundle: true,
+    target: "firefox68",
+    write: false,
+}).outputFiles[0].text
+
+function time(source, i, use) {
+    const context = vm.createContext({})
+    const start = process.hrtime.bigint()
+    // Vary the source so V8 can't reuse an earlier compilation
+    new vm.Script(source + "\\n//" + i).runInContext(context)
+    if (use) vm.runInContext(`cmd_params.get(${JSON.stringify(lookup)})`, context)
+    return Number(process.hrtime.bigint() - start) / 1e6
+}
+
+function median(xs) {
+    xs.sort((a, b) => a - b)
+    return xs[xs.length >> 1]
+}
+
+function dump(source) {
+    const context = vm.createContext({})
+    vm.runInContext(source, context)
+    return JSON.stringify(vm.runInContext(
+        "[...cmd_params.entries()].map(([k, v]) => [k, [...v.entries()]])",
+        context,
+    ))
+}
+
+const results = {}
+for (const [name, source] of Object.entries(variants)) {
+    // Warm up node and vm themselves
+    for (let i = 0; i < 10; i++) time(source, -i, true)
+    const evaluate = [], first_get = []
+    for (let i = 0; i < runs; i++) {
+        evaluate.push(time(source, 2 * i, false))
+        first_get.push(time(source, 2 * i + 1, true))
+    }
+    results[name] = {
+        bytes: Buffer.byteLength(source),
+        evaluate_ms: median(evaluate),
+        first_get_ms: median(first_get),
+        dump: dump(source),
+    }
+}
+console.log(JSON.stringify(results))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", "--runs", type=int, default=200)
+    parser.add_argument("--node", default="node")
+    parser.add_argument(
+        "--lookup", default="open",
+        help="excmd whose parameters to look up",
+    )
+    args = parser.parse_args()
+
+    texts, signatures = excmds_macros.generate()
+    proc = subprocess.run(
+        [args.node, "-e", HARNESS],
+        input=json.dumps({
+            "variants": {"before": before(signatures)},
+            "after": after(texts["content"]),
+            "runs": args.runs,
+            "lookup": args.lookup,
+        }),
+        stdout=subprocess.PIPE, text=True, check=True,
+    )
+    results = json.loads(proc.stdout)
+    if results["before"]["dump"] != results["after"]["dump"]:
+        sys.exit("cmd_params differs between before and after!")
+
+    print("{} excmds, median of {} runs".format(len(signatures), args.runs))
+    print("{:8} {:>8} {:>12} {:>14}".format(
+        "", "bytes", "evaluate ms", "+ first get ms"))
+    for name, result in results.items():
+        print("{:8} {:>8} {:>12.3f} {:>14.3f}".format(
+            name, result["bytes"], result["evaluate_ms"],
+            result["first_get_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,11 +13,28 @@ Caveats:
         signature on a single line, ending with {
         no other statement on the same line as the end brace
 
+The signatures of all the commands are collected into one compact table that
+replaces the declaration following //#cmd_params. It's only unpacked into
+cmd_params' Maps when cmd_params is first used, rather than every time a
+content script loads.
+
+excmds.ts is parsed once for both versions, and outputs that haven't changed
+aren't rewritten, so that their mtimes don't set off rebuilds. With --watch,
+keeps regenerating them whenever excmds.ts is saved.
+
 """
 
 from collections import OrderedDict
+import argparse
+import json
+import os
 import re
+import sys
 import textwrap
+import time
+
+CONTEXTS = ("background", "content")
+SOURCE = "src/excmds.ts"
 
 class Signature:
     """Extract name, parameters and types from a function signature."""
@@ -71,34 +88,74 @@ def get_block(lines):
 
     """
     brace_balance = 0
-    block = ""
+    block = []
     while True:
         current_line = next(lines)
         brace_balance += current_line.count('{')
         brace_balance -= current_line.count('}')
-        block += current_line
+        block.append(current_line)
         if brace_balance == 0:
-            return block
+            return "".join(block)
 
 
+# cmd_params used to be filled in with one cmd_params.set(name, ...) of this
+# per command; scripts/cmd_params_benchmark.py still compares against that.
 def dict_to_js(d):
     "Py dict to string that when eval'd will produce equivalent js Map"
     return "new Map(" + str(list(d.items())).replace('(','[').replace(')',']') + ")"
 
-def content(lines, context):
-    "Extract signature and, if context==background, replace function with a shim."
+
+def param_table(signatures):
+    """JS for a table of the signatures that cmdParamTable unpacks.
+
+    Each row is the command name followed by each parameter name and the
+    index of its type in a separate list, as the same few types are used
+    over and over.
+    """
+    types = {}
+    rows = []
+    for name, params in signatures.items():
+        row = [name]
+        for param, typ in params.items():
+            row += [param, types.setdefault(typ, len(types))]
+        rows.append("    " + json.dumps(row) + ",\n")
+    return "cmdParamTable(\n    [\n{}    ],\n    [\n{}    ],\n)".format(
+        "".join("        " + json.dumps(typ) + ",\n" for typ in types),
+        textwrap.indent("".join(rows), "    "))
+
+
+class ParamTable:
+    "Placeholder for the table, which can only be written out at the end."
+    def __init__(self, line):
+        self.line = line
+
+    def render(self, signatures):
+        "Replace the declaration's initialiser with a LazyMap of the table."
+        declaration = self.line[:self.line.index("=") + 1]
+        table = param_table(signatures)
+        return "{declaration} new LazyMap(() =>\n{table},\n)\n".format(
+            declaration=declaration, table=textwrap.indent(table, "    "))
+
+
+def cmd_params(lines, signatures):
+    "Mark where the table of signatures goes."
+
+    table = ParamTable(next(lines))
+    return {"background": table, "content": table}
+
+
+def content(lines, signatures):
+    "Extract signature and, for the background, replace function with a shim."
 
     block = get_block(lines)
     sig = Signature(block.split('\n')[0])
-    cmd_params = "cmd_params.set('{sig.name}', ".format(**locals()) + dict_to_js(sig.params) + ")"
+    signatures[sig.name] = sig.params
     message_params = ", ".join(sig.params.keys())
-    if context == "background":
-        # Consume and replace this block. We emit the line to add the
-        # function's signature to cmd_params, the function's signature
-        # line unchanged, then a command to message the browser's
-        # active tab forwarding all parameters.
-        return textwrap.dedent("""\
-               {cmd_params}
+    return {
+        # Consume and replace this block. We emit the function's
+        # signature line unchanged, then a command to message the
+        # browser's active tab forwarding all parameters.
+        "background": textwrap.dedent("""\
                {sig.raw}
                    logger.debug("shimming excmd {sig.name} from background to content")
                    return Messaging.messageActiveTab(
@@ -106,34 +163,29 @@ def content(lines, context):
                        "{sig.name}",
                        [{message_params}],
                    )
-               }}\n""".format(**locals()))
-    else:
-        # Emit the line to add the function to cmd_params, then
-        # re-emit the original block (because we consumed the block so
+               }}\n""".format(**locals())),
+        # Re-emit the original block (because we consumed the block so
         # we could compute the cmd params)
-        return "{cmd_params}\n{block}".format(**locals())
+        "content": block,
+    }
 
 
-def background(lines, context):
-    "Extract signature and, if context==content, replace function with a shim."
+def background(lines, signatures):
+    "Extract signature and, for the content script, replace function with a shim."
 
     block = get_block(lines)
     sig = Signature(block.split('\n')[0])
-    cmd_params = "cmd_params.set('{sig.name}', ".format(**locals()) + dict_to_js(sig.params) + ")"
+    signatures[sig.name] = sig.params
     message_params = ", ".join(sig.params.keys())
 
-    if context == "background":
-        # Emit the line to add the function to cmd_params, then
-        # re-emit the original block (because we consumed the block so
+    return {
+        # Re-emit the original block (because we consumed the block so
         # we could compute the cmd params)
-        return "{cmd_params}\n{block}".format(**locals())
-    else:
-        # Consume and replace this block. We emit the line to add the
-        # function's signature to cmd_params, the function's signature
-        # line unchanged, then a command to message the browser's
-        # active tab forwarding all parameters.
-        return textwrap.dedent("""\
-               {cmd_params}
+        "background": block,
+        # Consume and replace this block. We emit the function's
+        # signature line unchanged, then a command to message the
+        # browser's active tab forwarding all parameters.
+        "content": textwrap.dedent("""\
                {sig.raw}
                    logger.debug("shimming excmd {sig.name} from content to background")
                    return Messaging.message(
@@ -141,65 +193,151 @@ def background(lines, context):
                        "{sig.name}",
                        {message_params}
                    )
-               }}\n""".format(**locals()))
+               }}\n""".format(**locals())),
+    }
 
-def both(lines, context):
+def both(lines, signatures):
     "Just extract the signature of the command."
 
     sig = Signature(next(lines))
-    return "cmd_params.set('{sig.name}', ".format(**locals()) + dict_to_js(sig.params) + """)\n{sig.raw}""".format(**locals())
+    signatures[sig.name] = sig.params
+    return {"background": sig.raw, "content": sig.raw}
 
 
-def omit_helper_func_factory(desired_context):
-    "Consume this block if context isn't what we want"
-    def inner(lines, context):
-        if context != desired_context:
-            # Consume this block
-            get_block(lines)
-        return ""
+def helper_func_factory(desired_context):
+    "Keep this block only in the context we want"
+    def inner(lines, signatures):
+        # Consume this block
+        return {desired_context: get_block(lines)}
 
     return inner
 
 
-def omit_line_factory(desired_context):
-    def inner(lines, context):
-        if context != desired_context:
-            next(lines)
-        return ""
+def line_factory(desired_context):
+    "Keep the next line only in the context we want"
+    def inner(lines, signatures):
+        return {desired_context: next(lines)}
 
     return inner
 
 
+MACROS = {
+        "content": content,
+        "background": background,
+        "both": both,
+        "cmd_params": cmd_params,
+        "content_helper": helper_func_factory("content"),
+        "background_helper": helper_func_factory("background"),
+        "content_omit_line": line_factory("content"),
+        "background_omit_line": line_factory("background"),
+        }
+
+
+def generate(path=SOURCE):
+    """Iterate over the file once, dispatching to appropriate macro handlers.
+
+    Returns the text of each context's version and the signatures of the
+    commands.
+    """
+
+    with open(path, encoding="utf-8") as source:
+        lines = iter(source.readlines())
+    outputs = {context: [PRELUDE] for context in CONTEXTS}
+    signatures = OrderedDict()
+    for line in lines:
+        if line.startswith("//#"):
+            macrocmd = line[3:].strip()
+            if macrocmd not in MACROS:
+                raise Exception("Unknown macrocmd! {macrocmd}".format(**locals()))
+            emitted = MACROS[macrocmd](lines, signatures)
+            for context in CONTEXTS:
+                outputs[context].append(emitted.get(context, ""))
+        else:
+            for context in CONTEXTS:
+                outputs[context].append(line)
+    texts = {}
+    for context, output in outputs.items():
+        tables = [i for i, part in enumerate(output) if isinstance(part, ParamTable)]
+        if len(tables) != 1:
+            raise Exception("Need exactly one //#cmd_params, found {}".format(len(tables)))
+        output[tables[0]] = output[tables[0]].render(signatures)
+        texts[context] = "".join(output).rstrip() + "\n"
+    return texts, signatures
+
+
+def write_if_changed(path, text):
+    "Write text to path unless it's there already. Returns whether it wrote."
+
+    try:
+        with open(path, encoding="utf-8", newline="") as old:
+            if old.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    # newline="" both ways, or on Windows the \r\n written would never
+    # compare equal to the \n generated
+    with open(path, "w", encoding="utf-8", newline="") as sink:
+        sink.write(text)
+    return True
+
+
+def regenerate():
+    "Bring the generated files up to date. Returns those that changed."
+
+    changed = []
+    for context, text in generate()[0].items():
+        path = "src/.excmds_{context}.generated.ts".format(**locals())
+        if write_if_changed(path, text):
+            changed.append(path)
+    return changed
+
+
+def watch(interval):
+    "Regenerate whenever excmds.ts changes, until interrupted."
+
+    last = None
+    while True:
+        try:
+            mtime = os.stat(SOURCE).st_mtime_ns
+        except FileNotFoundError:
+            # Editors may replace the file rather than write to it
+            mtime = None
+        if mtime is not None and mtime != last:
+            last = mtime
+            start = time.perf_counter()
+            try:
+                changed = regenerate()
+            except Exception as e:
+                print("excmds_macros: {}".format(e), file=sys.stderr)
+            else:
+                print("excmds_macros: {} in {:.0f}ms".format(
+                    ", ".join(changed) or "unchanged",
+                    (time.perf_counter() - start) * 1000,
+                ), file=sys.stderr)
+        time.sleep(interval)
+
+
 def main():
-    """Iterate over the file, dispatching to appropriate macro handlers."""
-
-    macros = {
-            "content": content,
-            "background": background,
-            "both": both,
-            "content_helper": omit_helper_func_factory("content"),
-            "background_helper": omit_helper_func_factory("background"),
-            "content_omit_line": omit_line_factory("content"),
-            "background_omit_line": omit_line_factory("background"),
-            }
-
-    for context in ("background", "content"):
-        with open("src/excmds.ts", encoding="utf-8") as source:
-            output = PRELUDE
-            lines = iter(source)
-            for line in lines:
-                if line.startswith("//#"):
-                    macrocmd = line[3:].strip()
-                    if macrocmd in macros:
-                        output += macros[macrocmd](lines, context)
-                    else:
-                        raise Exception("Unknown macrocmd! {macrocmd}".format(**locals()))
-                else:
-                    output += line
-            # print(output.rstrip())
-            with open("src/.excmds_{context}.generated.ts".format(**locals()), "w", encoding="utf-8") as sink:
-                print(output.rstrip(), file=sink)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="regenerate whenever src/excmds.ts changes",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=0.2,
+        help="seconds between checks for changes when watching",
+    )
+    args = parser.parse_args()
+    if args.watch:
+        try:
+            watch(args.interval)
+        except KeyboardInterrupt:
+            pass
+    else:
+        regenerate()
 
 
 PRELUDE = "/* Generated from excmds.ts. Don't edit this file! */"
-main()
+
+if __name__ == "__main__":
+    main()
@@ -271,6 +271,10 @@ const messages = {
         downloadUrlAs: download_background.downloadUrlAs,
     },
     browser_proxy_background: { shim: proxy_background.shim },
+    native_background: {
+        sendNativeMsg: native.sendNativeMsg,
+        nativeCapabilities: native.nativeCapabilities,
+    },
     omniscient_background: omniscient_controller,
 }
 export type Messages = typeof messages
@@ -1,6 +1,12 @@
 import * as controller from "@src/lib/controller"
 import * as config from "@src/lib/config"
 import * as Native from "@src/lib/native"
+import Logger from "@src/lib/logging"
+const logger = new Logger("native")
+
+// How long to wait for an rc file to stop changing before sourcing it again:
+// editors often save in several steps
+const RC_WATCH_DELAY = 200
 
 export async function source(filename = "auto") {
     let rctext = ""
@@ -11,9 +17,43 @@ export async function source(filename = "auto") {
     }
     if (rctext === undefined) return false
     await runRc(rctext)
+    if (filename === "auto") watchRc()
     return true
 }
 
+// The watch started by watchRc, resolving to the function that stops it
+let rcWatch: Promise<(() => void) | undefined> | undefined
+
+/**
+ * With rcwatch set, sources the rc file again whenever it changes. Called
+ * whenever the rc file is sourced, so watching starts or stops the next time
+ * it is sourced after rcwatch is changed.
+ */
+function watchRc() {
+    if (config.get("rcwatch") !== "true") {
+        rcWatch?.then(unwatch => unwatch?.())
+        rcWatch = undefined
+        return
+    }
+    let timer: ReturnType<typeof setTimeout>
+    rcWatch ??= Native.watchrc(change => {
+        // Candidates that are shadowed by the rc file don't matter
+        if (change.exists && change.path !== change.config) return
+        clearTimeout(timer)
+        timer = setTimeout(
+            () =>
+                source().catch(e =>
+                    logger.error("Couldn't source the changed rc file:", e),
+                ),
+            RC_WATCH_DELAY,
+        )
+    }).catch(e => {
+        rcWatch = undefined
+        logger.error("Couldn't watch the rc file:", e)
+        return undefined
+    })
+}
+
 /*
  * This should be moved out to a library but I am lazy
  */
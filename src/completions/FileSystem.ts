@@ -16,6 +16,9 @@ class FileSystemCompletionOption
 }
 
 export class FileSystemCompletionSource extends Completions.CompletionSourceFuse {
+    // Most entries asked of the native messenger for one directory
+    static readonly MAX_ENTRIES = 500
+
     public options: FileSystemCompletionOption[]
 
     constructor(private _parent) {
@@ -58,9 +61,30 @@ export class FileSystemCompletionSource extends Completions.CompletionSourceFuse
         // Update lastExstr because we modified the path and scoreOptions uses that in order to assign scores
         this.lastExstr = [cmd, path].join(" ")
 
+        // "dir/**/query" fuzzily finds files anywhere below dir
+        const deep = path.indexOf("/**")
+        if (deep !== -1 && (await Native.hasNativeCapability("find_files"))) {
+            return this.findDeep(
+                cmd,
+                path.substring(0, deep) || "/",
+                path.substring(deep + 3).replace(/^\//, ""),
+            )
+        }
+
+        // Let the native messenger do the filtering if it can, so that huge
+        // directories don't get sent over in full on every keystroke
+        const listOpts = (await Native.hasNativeCapability("list_dir_v2"))
+            ? {
+                  complete: true,
+                  // Fuse, which this replaces, ignored case too
+                  ignore_case: true,
+                  limit: FileSystemCompletionSource.MAX_ENTRIES,
+              }
+            : {}
+
         let req
         try {
-            req = await Native.listDir(path)
+            req = await Native.listDir(path, listOpts)
         } catch (e) {
             // Failing silently because we can't nativegate (the user is typing stuff in the commandline)
             this.state = "hidden"
@@ -80,4 +104,23 @@ export class FileSystemCompletionSource extends Completions.CompletionSourceFuse
         this.state = "normal"
         return this.updateChain()
     }
+
+    private async findDeep(cmd: string, root: string, query: string) {
+        let found
+        try {
+            found = await Native.findFiles(query, [root], {
+                limit: FileSystemCompletionSource.MAX_ENTRIES,
+            })
+        } catch (e) {
+            this.state = "hidden"
+            return
+        }
+
+        this.options = found.files.map(p => new FileSystemCompletionOption(p))
+
+        this.state = "normal"
+        // The native messenger has done the ranking; show everything it
+        // found, in its order
+        return this.updateChain(cmd + " ")
+    }
 }
@@ -370,3 +370,38 @@ test("`ttscontrol` rejects unknown actions", async () => {
         "Unknown text-to-speech action: invalid",
     )
 })
+
+// As excmds_macros.py used to emit them, one cmd_params.set per excmd
+test.each([
+    ["getNativeVersion", []],
+    [
+        "rssexec",
+        [
+            ["url", "string"],
+            ["type", "string"],
+            ["...title", "string[]"],
+        ],
+    ],
+    [
+        "scrollto",
+        [
+            ["a", "number | string"],
+            ["b", 'number | "x" | "y" = "y"'],
+        ],
+    ],
+    ["mode", [["mode", "ModeName"]]],
+    [
+        "autocmd",
+        [
+            ["event", "string"],
+            ["url", "string"],
+            ["...excmd", "string[]"],
+        ],
+    ],
+])("cmd_params has the signature of `%s`", (name, params) => {
+    const expected = new Map(params as [string, string][])
+    const contentExcmds = require("@src/.excmds_content.generated")
+
+    expect(backgroundExcmds.cmd_params.get(name)).toEqual(expected)
+    expect(contentExcmds.cmd_params.get(name)).toEqual(expected)
+})
@@ -101,6 +101,7 @@ import * as arg from "@src/lib/arg_util"
 import * as R from "ramda"
 import * as treestyletab from "@src/interop/tst"
 import { uuidv4 } from "@src/lib/math"
+import { LazyMap } from "@src/lib/memoise"
 import { ABOUT_PAGES } from "@src/lib/about_pages"
 import glossary from "@src/.glossary.generated.json"
 
@@ -122,9 +123,29 @@ import { keyMuncher as KEY_MUNCHER, startBufferingPageKeys } from "@src/content/
  * Used to store the types of the parameters for each excmd for
  * self-documenting functionality.
  *
+ * excmds_macros.py fills this in from the signatures of the excmds.
+ *
+ * @hidden
+ */
+//#cmd_params
+export const cmd_params: ReadonlyMap<string, ReadonlyMap<string, string>> = new LazyMap(() => [])
+
+/**
+ * Unpack the table of excmd signatures generated for cmd_params: each row
+ * is the excmd's name followed by pairs of parameter names and indices
+ * into types.
+ *
  * @hidden
  */
-export const cmd_params = new Map<string, Map<string, string>>()
+function cmdParamTable(types: string[], table: (string | number)[][]): [string, Map<string, string>][] {
+    return table.map(([name, ...params]) => {
+        const param_types = new Map<string, string>()
+        for (let i = 0; i < params.length; i += 2) {
+            param_types.set(params[i] as string, types[params[i + 1] as number])
+        }
+        return [name as string, param_types]
+    })
+}
 
 /** @hidden */
 const logger = new Logging.Logger("excmd")
@@ -383,8 +404,9 @@ export async function editor() {
         const text = await editor.getContent()
         const pos = await editor.getCursor()
 
-        const file = (await Native.temp(text, document.location.hostname)).content
-        const exec = await Native.editor(file, ...pos)
+        // Keep the file: its path is part of our return value
+        const exec = await Native.editTemp(text, document.location.hostname, ...pos, true)
+        const file = exec.file
 
         if (exec.code == 0) {
             await editor.setContent(exec.content)
@@ -884,7 +906,7 @@ export async function mktridactylrc(...args: string[]) {
  *
  * With no argument, it loads only the first file selected by the native messenger. The platform config directory (usually `$XDG_CONFIG_HOME/tridactyl/tridactylrc` or `~/.config/tridactyl/tridactylrc`) takes precedence over `~/.tridactylrc`. Windows also accepts `~/_config/tridactyl/tridactylrc` and `~/_tridactylrc`.
  *
- * Local files require the [[native]] messenger. With the default configuration, this no-argument form runs once at browser startup. Run `:findrc` to display the path it would currently select or `:source` after editing it.
+ * Local files require the [[native]] messenger. With the default configuration, this no-argument form runs once at browser startup. Run `:findrc` to display the path it would currently select or `:source` after editing it, or set [[rcwatch]] to have it sourced again whenever it changes.
  *
  * On Windows, the `~` expands to `%USERPROFILE%`.
  *
@@ -953,6 +975,8 @@ export async function updatenative(interactive = true) {
 
     if (semverCompare(native_version, "0.2.0") < 0) {
         await Native.run(update_command)
+        // Make sure the next message reaches the updated messenger
+        Native.disconnectNativePort()
     } else if (semverCompare(native_version, "0.3.1") < 0) {
         if (interactive) {
             throw new Error("Updating is broken on this version of the native messenger. Please use `:nativeinstall` instead.")
@@ -976,14 +1000,17 @@ export async function restart() {
     const browsercmd = await config.get("browser")
 
     if ((await browser.runtime.getPlatformInfo()).os === "win") {
-        const reply = await Native.winFirefoxRestart(profiledir, browsercmd)
-        logger.info("[+] win_firefox_restart 'reply' = " + JSON.stringify(reply))
-        if (Number(reply.code) === 0) {
-            fillcmdline("#" + reply.content)
-            qall()
-        } else {
-            fillcmdline("#" + reply.error)
+        let reply
+        try {
+            reply = await Native.winFirefoxRestart(profiledir, browsercmd)
+        } catch (e) {
+            if (!(e instanceof Native.NativeCommandError)) throw e
+            fillcmdline("#" + e.message)
+            return
         }
+        logger.info("[+] win_firefox_restart 'reply' = " + JSON.stringify(reply))
+        fillcmdline("#" + reply.content)
+        qall()
     } else {
         const firefox = (await Native.ff_cmdline()).join(" ")
         // Wait for the lock to disappear, then wait a bit more, then start firefox
@@ -1217,6 +1217,13 @@ export class default_config {
     nativeinstallcmd =
         "curl -fsSl https://raw.githubusercontent.com/tridactyl/native_messenger/master/installers/install.sh -o /tmp/trinativeinstall.sh && sh /tmp/trinativeinstall.sh %TAG"
 
+    /**
+     * Whether to [[source]] your rc file again whenever it changes, e.g. when you save it in your editor. Takes effect the next time the rc file is sourced, such as when the browser starts.
+     *
+     * Needs a native messenger that can watch files.
+     */
+    rcwatch: "true" | "false" = "false"
+
     /**
      * Used by :updatecheck and related built-in functionality to automatically check for updates and prompt users to upgrade.
      */
@@ -0,0 +1,28 @@
+import { LazyMap } from "@src/lib/memoise"
+
+test("LazyMap only builds its map on first use, and only once", () => {
+    const build = jest.fn(() => [
+        ["a", 1],
+        ["b", 2],
+    ] as const)
+    const map = new LazyMap<string, number>(build)
+
+    expect(build).not.toHaveBeenCalled()
+    expect(map.get("b")).toBe(2)
+    expect(map.has("c")).toBe(false)
+    expect(map.size).toBe(2)
+    expect([...map]).toEqual([
+        ["a", 1],
+        ["b", 2],
+    ])
+    expect(build).toHaveBeenCalledTimes(1)
+})
+
+test("LazyMap.forEach passes the LazyMap itself", () => {
+    const map = new LazyMap(() => [["a", 1]] as const)
+    const callback = jest.fn()
+
+    map.forEach(callback)
+
+    expect(callback).toHaveBeenCalledWith(1, "a", map)
+})
@@ -10,3 +10,51 @@ export function memoise<TArg, TResult>(fn: (arg: TArg) => TResult) {
         return cached.value
     }
 }
+
+/** A read-only Map that isn't built until it's first used */
+export class LazyMap<K, V> implements ReadonlyMap<K, V> {
+    private map?: Map<K, V>
+
+    constructor(private build: () => Iterable<readonly [K, V]>) {}
+
+    private get built() {
+        return (this.map ??= new Map(this.build()))
+    }
+
+    get size() {
+        return this.built.size
+    }
+
+    get(key: K) {
+        return this.built.get(key)
+    }
+
+    has(key: K) {
+        return this.built.has(key)
+    }
+
+    forEach(
+        callback: (value: V, key: K, map: ReadonlyMap<K, V>) => void,
+        thisArg?: any,
+    ) {
+        this.built.forEach((value, key) =>
+            callback.call(thisArg, value, key, this),
+        )
+    }
+
+    entries() {
+        return this.built.entries()
+    }
+
+    keys() {
+        return this.built.keys()
+    }
+
+    values() {
+        return this.built.values()
+    }
+
+    [Symbol.iterator]() {
+        return this.built[Symbol.iterator]()
+    }
+}
@@ -26,6 +26,7 @@ export type NonTabMessageType =
     | "excmd_background"
     | "controller_background"
     | "browser_proxy_background"
+    | "native_background"
     | "download_background"
     | "performance_background"
 export type MessageType = TabMessageType | NonTabMessageType
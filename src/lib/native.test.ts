@@ -0,0 +1,203 @@
+jest.mock("@src/lib/webext", () => ({
+    getContext: () => "background",
+    browserBg: browser,
+}))
+
+type Reply = Record<string, unknown>
+
+/**
+ * A stand-in for the port to a messenger that speaks the port protocol.
+ * answer is called with each message posted to it, and the port itself to
+ * reply through.
+ */
+function fakePort(answer: (message: any, port: FakePort) => void = () => {}) {
+    const messageListeners = []
+    const port = {
+        posted: [] as any[],
+        postMessage: jest.fn(message => {
+            port.posted.push(message)
+            queueMicrotask(() => answer(message, port))
+        }),
+        disconnect: jest.fn(),
+        onMessage: { addListener: listener => messageListeners.push(listener) },
+        onDisconnect: { addListener: jest.fn() },
+        reply: (message: Reply) => messageListeners.forEach(l => l(message)),
+    }
+    return port
+}
+type FakePort = ReturnType<typeof fakePort>
+
+let Native: typeof import("@src/lib/native")
+
+function useMessenger(port: FakePort, capabilities: string[] = []) {
+    Object.assign(browser.runtime, {
+        sendNativeMessage: jest.fn().mockResolvedValue({
+            cmd: "version",
+            version: "0.5.0",
+            protocol: 1,
+            capabilities,
+        }),
+        connectNative: jest.fn().mockReturnValue(port),
+    })
+}
+
+async function posted(port: FakePort, count: number) {
+    for (let i = 0; port.posted.length < count && i < 100; i++) {
+        await new Promise(resolve => setTimeout(resolve, 0))
+    }
+    return port.posted
+}
+
+beforeEach(() => {
+    jest.resetModules()
+    Native = require("@src/lib/native")
+})
+
+test("replies over the port settle the request with the same id", async () => {
+    const port = fakePort()
+    useMessenger(port)
+
+    const first = Native.sendNativeMsg("run", { command: "first" })
+    const second = Native.sendNativeMsg("run", { command: "second" })
+    const [a, b] = await posted(port, 2)
+    port.reply({ id: b.id, cmd: "run", content: "2" })
+    port.reply({ id: a.id, cmd: "run", content: "1" })
+
+    expect(a.id).not.toBe(b.id)
+    expect((await first).content).toBe("1")
+    expect((await second).content).toBe("2")
+    expect(browser.runtime.connectNative).toHaveBeenCalledTimes(1)
+})
+
+test("runStream yields partial replies in order and returns the final one", async () => {
+    const port = fakePort((message, port) => {
+        if (message.cmd === "version") {
+            port.reply({ id: message.id, cmd: "version", protocol: 1 })
+            return
+        }
+        port.reply({ id: message.id, more: true, stream: "stdout", content: "a" })
+        port.reply({ id: message.id, more: true, stream: "stderr", content: "b" })
+        port.reply({ id: message.id, cmd: "run_stream", code: 0 })
+    })
+    useMessenger(port, ["run_stream"])
+
+    const stream = Native.runStream("cmd", "", { stderr: true })
+    const chunks = []
+    let next = await stream.next()
+    while (!next.done) {
+        chunks.push(next.value)
+        next = await stream.next()
+    }
+
+    expect(chunks).toEqual([
+        { stream: "stdout", content: "a" },
+        { stream: "stderr", content: "b" },
+    ])
+    expect(next.value.code).toBe(0)
+})
+
+test("a streamed command that fails rejects after its partial replies", async () => {
+    const port = fakePort((message, port) => {
+        port.reply({ id: message.id, more: true, stream: "stdout", content: "a" })
+        port.reply({ id: message.id, cmd: "error", error: "boom" })
+    })
+    useMessenger(port, ["run_stream"])
+
+    const stream = Native.runStream("cmd")
+
+    expect((await stream.next()).value).toEqual({
+        stream: "stdout",
+        content: "a",
+    })
+    await expect(stream.next()).rejects.toThrow("boom")
+})
+
+test("read only has an unchanged file sent once", async () => {
+    const port = fakePort((message, port) => {
+        const stat = { mtime: 1, size: 5, code: 0, cmd: "read" }
+        port.reply(
+            message.if_mtime === 1 && message.if_size === 5
+                ? { id: message.id, unchanged: true, ...stat }
+                : { id: message.id, content: "hello", ...stat },
+        )
+    })
+    useMessenger(port)
+
+    const first = await Native.read("/rc")
+    first.content = "mangled by the caller"
+    const second = await Native.read("/rc")
+
+    expect(port.posted[1]).toMatchObject({ if_mtime: 1, if_size: 5 })
+    expect(second.content).toBe("hello")
+})
+
+test("firstinpath looks up every candidate in one which_many", async () => {
+    const port = fakePort((message, port) =>
+        port.reply({
+            id: message.id,
+            cmd: "which_many",
+            code: 0,
+            content: [{ command: "emacs", index: 2, path: "/usr/bin/emacs" }],
+        }),
+    )
+    useMessenger(port, ["which_many"])
+
+    const found = await Native.firstinpath(["gvim -f", "nvim", "emacs -nw"])
+
+    expect(found).toBe("emacs -nw")
+    expect(port.posted).toEqual([
+        expect.objectContaining({
+            cmd: "which_many",
+            commands: ["gvim", "nvim", "emacs"],
+        }),
+    ])
+})
+
+test("getrc resolves to nothing if the messenger can't read the rc", async () => {
+    const port = fakePort((message, port) =>
+        port.reply({
+            id: message.id,
+            cmd: "error",
+            error: "UnicodeDecodeError: invalid start byte",
+        }),
+    )
+    useMessenger(port)
+
+    expect(await Native.getrc()).toBeUndefined()
+})
+
+test("other commands reject with the messenger's error", async () => {
+    const port = fakePort((message, port) =>
+        port.reply({ id: message.id, cmd: "error", error: "no such job" }),
+    )
+    useMessenger(port)
+
+    const reply = Native.sendNativeMsg("job_status", { job: 1 })
+
+    await expect(reply).rejects.toBeInstanceOf(Native.NativeCommandError)
+    await expect(reply).rejects.toThrow("no such job")
+})
+
+test("getrc only asks for a watched rc again once it changed", async () => {
+    const port = fakePort((message, port) => {
+        const rc = { mtime: 1, size: 5, path: "/rc", content: "set x" }
+        port.reply({ id: message.id, cmd: message.cmd, code: 0, ...rc })
+    })
+    useMessenger(port, ["watch_config"])
+    const changes = []
+
+    await Native.watchrc(change => changes.push(change))
+    await Native.getrc()
+    await Native.getrc()
+    const asked = port.posted.length
+    port.reply({ cmd: "configchanged", path: "/rc", exists: true, config: "/rc" })
+    await Native.getrc()
+
+    expect(asked).toBe(2)
+    expect(changes).toEqual([expect.objectContaining({ path: "/rc" })])
+    expect(port.posted.map(m => m.cmd)).toEqual([
+        "watch_config",
+        "getconfig",
+        "getconfig",
+    ])
+})
@@ -4,6 +4,7 @@
 
 import semverCompare from "semver-compare"
 import * as config from "@src/lib/config"
+import * as messaging from "@src/lib/messaging"
 import { browserBg, getContext } from "@src/lib/webext"
 
 import Logger from "@src/lib/logging"
@@ -13,18 +14,41 @@ const NATIVE_NAME = "tridactyl"
 type MessageCommand =
     | "version"
     | "run"
+    | "run_stream"
+    | "cancel"
+    | "batch"
+    | "which_many"
+    | "edit"
+    | "proc_cmdline"
+    | "detect_profile"
+    | "clipboard"
     | "run_async"
+    | "job_status"
+    | "job_output"
+    | "job_wait"
     | "read"
     | "write"
+    | "write_begin"
+    | "write_chunk"
+    | "write_commit"
+    | "write_abort"
     | "writerc"
     | "temp"
     | "list_dir"
+    | "index"
+    | "find_files"
+    | "stats"
+    | "log"
     | "mkdir"
     | "move"
     | "eval" // Only works in native < 0.2.0 (NB: use "run" for non-Python eval)
     | "getconfig"
     | "getconfigpath"
+    | "watch_config"
+    | "unwatch"
     | "env"
+    | "env_many"
+    | "env_snapshot"
     | "win_firefox_restart"
     | "ppid" // Removed from Windows since native >= 0.2.0
 interface MessageResp {
@@ -33,25 +57,313 @@ interface MessageResp {
     content: string | null
     code?: number | null
     error?: string | null
+    id?: number
+    protocol?: number
+    capabilities?: string[]
+    // Set on partial replies; the request is answered by the first reply
+    // without it
+    more?: boolean
+    stream?: "stdout" | "stderr"
+    // File metadata from "read"
+    size?: number
+    mtime?: number
+    unchanged?: boolean
+    offset?: number
+    next_offset?: number
+    // Replies to the messages of a "batch"
+    replies?: MessageResp[]
+    // From "edit": the temporary file and milliseconds spent in each phase
+    file?: string
+    timings?: Record<string, number>
+    // From "getconfig", and "configchanged" pushes: whether the file that
+    // changed exists and which rc file the messenger would now read
+    path?: string
+    exists?: boolean
+    config?: string | null
+    // From "list_dir" and "find_files"
+    files?: string[]
+    total?: number
+    truncated?: boolean
+    // From "detect_profile": the profile, as in parseProfilesIni, and
+    // whether it came from "profiledir", "cmdline", "lock" or "default"
+    profile?: Record<string, string>
+    how?: string
+    // The tool "clipboard" used, and the command line it ran
+    backend?: string
+    argv?: string[]
+    // Expanded path templates from "env_many" and "env_snapshot"
+    paths?: string[]
+    // From "write" and chunked writes
+    sha256?: string
+    session?: string
+    // Why "run" or "run_stream" killed the command, if it did
+    timed_out?: boolean
+    cancelled?: boolean
+    // From "run_async" and the job commands
+    job?: number
+    state?: "running" | "exited" | "lost"
+    jobs?: MessageResp[]
+    eof?: boolean
+}
+
+// How long the answer to a one-time capability probe is trusted for, when the
+// messenger doesn't speak the port protocol
+const NATIVE_PROBE_TTL = 60 * 1000
+// Close the persistent port after this long without a request in flight
+const NATIVE_PORT_IDLE_TIMEOUT = 60 * 1000
+
+// The messenger's reply to "version", if we have one we still trust
+let nativeInfo: Promise<MessageResp> | undefined
+// Whether the messenger speaks the port protocol (version >= 1), once known
+let nativePortSupported: boolean | undefined
+
+/**
+ * Asks a freshly spawned native messenger for its version, protocol and
+ * capabilities. Uses the one-time message API so that it works with every
+ * messenger. If the messenger speaks the port protocol, opens the port: the
+ * answer then holds for as long as the port stays open.
+ */
+async function probeNativeMessenger(): Promise<MessageResp> {
+    const probe = (await browserBg.runtime.sendNativeMessage(NATIVE_NAME, {
+        cmd: "version",
+    })) as MessageResp
+    nativePortSupported = probe.protocol >= 1
+    if (nativePortSupported) openNativePort()
+    return probe
+}
+
+/**
+ * The messenger's reply to "version": its version, protocol and
+ * capabilities.
+ *
+ * Only the first call, or the first after the port closed, costs a message:
+ * over the port if the messenger is known to speak the port protocol, else
+ * with the one-time message API. Answers from older messengers are trusted
+ * for NATIVE_PROBE_TTL, as they can't tell us when they're replaced.
+ */
+async function getNativeInfo(): Promise<MessageResp> {
+    if (nativeInfo !== undefined) return nativeInfo
+    const info = nativePortSupported
+        ? sendPortMsg(openNativePort(), { cmd: "version" })
+        : probeNativeMessenger()
+    const forget = () => {
+        if (nativeInfo === info) nativeInfo = undefined
+    }
+    nativeInfo = info
+    info.then(
+        resp => {
+            if (!(resp.protocol >= 1)) setTimeout(forget, NATIVE_PROBE_TTL)
+        },
+        // Don't remember failures: the user may be installing the messenger
+        () => {
+            forget()
+            nativePortSupported = undefined
+        },
+    )
+    return info
+}
+
+/**
+ * The capabilities advertised by the native messenger. Empty if the messenger
+ * is missing or predates capability reporting.
+ *
+ * Other contexts ask the background script, which keeps the answer for as
+ * long as its port to the messenger is open.
+ */
+export async function nativeCapabilities(): Promise<string[]> {
+    if (getContext() !== "background") {
+        return messaging.message("native_background", "nativeCapabilities")
+    }
+    try {
+        return (await getNativeInfo()).capabilities ?? []
+    } catch (e) {
+        return []
+    }
+}
+
+export async function getNativeCapabilities(): Promise<Set<string>> {
+    return new Set(await nativeCapabilities())
+}
+
+export async function hasNativeCapability(capability: string) {
+    return (await getNativeCapabilities()).has(capability)
+}
+
+interface PendingRequest {
+    resolve: (resp: MessageResp) => void
+    reject: (e: Error) => void
+    onPartial?: (resp: MessageResp) => void
+}
+
+let nativePort: browser.runtime.Port | undefined
+let nativePortIdleTimer: ReturnType<typeof setTimeout>
+let nextRequestId = 0
+const pendingRequests = new Map<number, PendingRequest>()
+
+function connectNativePort(): browser.runtime.Port {
+    const port = browser.runtime.connectNative(NATIVE_NAME)
+    port.onMessage.addListener((message: object) => {
+        const resp = message as MessageResp
+        if (resp.cmd === "configchanged" && resp.id === undefined) {
+            rcChanged(resp)
+            return
+        }
+        let id = resp.id
+        if (id === undefined && pendingRequests.size === 1) {
+            // The messenger couldn't even read the request, e.g. because it
+            // was too large. If only one was in flight, this is its answer.
+            id = pendingRequests.keys().next().value
+        }
+        const pending = pendingRequests.get(id)
+        if (pending === undefined) {
+            logger.warning("Native reply to unknown request:", resp)
+            return
+        }
+        if (resp.more) {
+            pending.onPartial?.(resp)
+            return
+        }
+        pendingRequests.delete(id)
+        pending.resolve(resp)
+        if (pendingRequests.size === 0 && rcListeners.size === 0) {
+            nativePortIdleTimer = setTimeout(
+                disconnectNativePort,
+                NATIVE_PORT_IDLE_TIMEOUT,
+            )
+        }
+    })
+    port.onDisconnect.addListener(p => {
+        if (nativePort === port) {
+            nativePort = undefined
+            // The messenger went away by itself: it may have been replaced
+            nativeInfo = undefined
+            nativePortSupported = undefined
+        }
+        const error = new Error(
+            `Native messenger disconnected. ${p.error?.message ?? ""}`,
+        )
+        for (const pending of pendingRequests.values()) pending.reject(error)
+        pendingRequests.clear()
+        rcWatching = rcCacheFresh = false
+        if (nativePort === undefined && rcListeners.size > 0) {
+            // Give a replaced messenger a moment to be in place
+            setTimeout(rewatchrc, 1000)
+        }
+    })
+    return port
+}
+
+function openNativePort(): browser.runtime.Port {
+    if (nativePort === undefined) nativePort = connectNativePort()
+    return nativePort
+}
+
+/**
+ * Closes the persistent native messenger port, e.g. so that an updated
+ * messenger gets picked up. The next message will open a new one; if the rc
+ * file is being watched, that is right away.
+ */
+export function disconnectNativePort() {
+    if (nativePort === undefined || pendingRequests.size > 0) return
+    nativePort.disconnect()
+    nativePort = undefined
+    nativeInfo = undefined
+    rcWatching = rcCacheFresh = false
+    if (rcListeners.size > 0) rewatchrc()
 }
 
 /**
- * Posts using the one-time message API; native is killed after message returns
+ * The persistent port to the native messenger, or undefined if the messenger
+ * doesn't speak the port protocol (version >= 1).
+ */
+async function getNativePort(): Promise<browser.runtime.Port | undefined> {
+    if (nativePort !== undefined) return nativePort
+    if (nativePortSupported === undefined) await getNativeInfo()
+    return nativePortSupported ? openNativePort() : undefined
+}
+
+function sendPortMsg(
+    port: browser.runtime.Port,
+    send: Record<string, unknown>,
+    onPartial?: (resp: MessageResp) => void,
+    signal?: AbortSignal,
+): Promise<MessageResp> {
+    const id = nextRequestId++
+    clearTimeout(nativePortIdleTimer)
+    return new Promise((resolve, reject) => {
+        pendingRequests.set(id, { resolve, reject, onPartial })
+        try {
+            port.postMessage(Object.assign({ id }, send))
+        } catch (e) {
+            pendingRequests.delete(id)
+            reject(e)
+            return
+        }
+        // The messenger kills the command and still replies
+        signal?.addEventListener("abort", () => {
+            if (pendingRequests.has(id)) {
+                sendPortMsg(port, { cmd: "cancel", request: id }).catch(
+                    e => logger.warning("Failed to cancel request:", e),
+                )
+            }
+        })
+    })
+}
+
+/**
+ * The native messenger failed to carry out a command and said why, e.g. a
+ * "read" of a file that can't be read.
+ */
+export class NativeCommandError extends Error {
+    constructor(cmd: string, public reply: MessageResp) {
+        super(`Native messenger failed to ${cmd}: ${reply.error}`)
+    }
+}
+
+/**
+ * Posts a message to the native messenger.
+ *
+ * In the background script, messengers that speak the port protocol get all
+ * messages over a single long-lived port, so bursts of messages don't spawn a
+ * process each. Older messengers use the one-time message API; native is
+ * killed after message returns. Other contexts forward their messages to the
+ * background script so that they share its port.
+ *
+ * Rejects with a NativeCommandError if the messenger replies with an error,
+ * unless quiet.
  */
 export async function sendNativeMsg(
     cmd: MessageCommand,
     opts: Record<string, unknown>,
     quiet = false,
+    signal?: AbortSignal,
 ): Promise<MessageResp> {
+    if (getContext() !== "background") {
+        return messaging.message(
+            "native_background",
+            "sendNativeMsg",
+            cmd,
+            opts,
+            quiet,
+        )
+    }
+
     const send = Object.assign({ cmd }, opts)
     let resp
     logger.info(`Sending message: ${JSON.stringify(send)}`)
 
     try {
-        resp = await browserBg.runtime.sendNativeMessage(NATIVE_NAME, send)
+        const port = await getNativePort()
+        if (port !== undefined) {
+            resp = await sendPortMsg(port, send, undefined, signal)
+        } else {
+            resp = await browserBg.runtime.sendNativeMessage(NATIVE_NAME, send)
+        }
         logger.info(`Received response:`, resp)
+        if (resp?.cmd === "error") throw new NativeCommandError(cmd, resp)
         return resp as MessageResp
     } catch (e) {
+        if (e instanceof NativeCommandError && !quiet) throw e
         if (!quiet) {
             throw new Error(
                 "Failed to send message to native messenger. If it is correctly installed (run `:native`), please report this bug on https://github.com/tridactyl/tridactyl/issues . " + e,
@@ -60,6 +372,59 @@ export async function sendNativeMsg(
     }
 }
 
+/**
+ * Sends a message whose command replies in several parts and yields the
+ * partial replies as they arrive. The generator returns the final reply.
+ *
+ * Needs the persistent port, so it only works in the background script.
+ */
+async function* streamNativeMsg(
+    cmd: MessageCommand,
+    opts: Record<string, unknown>,
+    capability: string = cmd,
+): AsyncGenerator<MessageResp, MessageResp> {
+    const port = getContext() === "background" && (await getNativePort())
+    if (!port || !(await hasNativeCapability(capability))) {
+        throw new Error(
+            `Streaming '${cmd}' needs a native messenger that supports it, and the background script.`,
+        )
+    }
+
+    const partials: MessageResp[] = []
+    let wake: (() => void) | undefined
+    let finished = false
+    let final: MessageResp
+    let failure: Error
+
+    sendPortMsg(port, Object.assign({ cmd }, opts), partial => {
+        partials.push(partial)
+        wake?.()
+    }).then(
+        resp => {
+            if (resp.cmd === "error") failure = new NativeCommandError(cmd, resp)
+            final = resp
+            finished = true
+            wake?.()
+        },
+        e => {
+            failure = e
+            finished = true
+            wake?.()
+        },
+    )
+
+    while (partials.length > 0 || !finished) {
+        if (partials.length > 0) {
+            yield partials.shift()
+        } else {
+            await new Promise<void>(resolve => (wake = resolve))
+            wake = undefined
+        }
+    }
+    if (failure !== undefined) throw failure
+    return final
+}
+
 export async function getrcpath(
     separator: "unix" | "auto" = "auto",
 ): Promise<string> {
@@ -80,8 +445,101 @@ export async function getrcpath(
     }
 }
 
+// The last rc file we got, so that it needn't be sent again if it's unchanged
+let rcCache: MessageResp | undefined
+// Whether rcCache is known to be current: the rc files are being watched and
+// haven't changed since it was read
+let rcCacheFresh = false
+// Bumped by every change the messenger tells us about
+let rcChanges = 0
+// Whether the messenger has started watching the rc files for us
+let rcWatching = false
+// Called with each "configchanged" the messenger pushes while watching
+const rcListeners = new Set<(change: MessageResp) => void>()
+// Files watched on top of the rc file's candidate paths
+const rcExtraFiles = new Set<string>()
+
+function rcChanged(change: MessageResp) {
+    rcChanges++
+    rcCacheFresh = false
+    for (const listener of rcListeners) listener(change)
+}
+
+function rewatchrc() {
+    sendNativeMsg("watch_config", { files: [...rcExtraFiles] }).then(
+        () => (rcWatching = true),
+        e => logger.error("Couldn't watch the rc file again:", e),
+    )
+}
+
+/**
+ * Calls listener whenever the rc file, or one of extraFiles (e.g. a file it
+ * sources), changes, is created or is removed, until the returned function is
+ * called. While anything is watching, getrc only asks the messenger for the
+ * rc file after it changed.
+ *
+ * The messenger watches on a thread of its own and pushes each change over
+ * the persistent port, which is kept open for as long as anything watches.
+ * Only works in the background script, with a messenger that supports
+ * "watch_config".
+ */
+export async function watchrc(
+    listener: (change: MessageResp) => void,
+    extraFiles: string[] = [],
+): Promise<() => void> {
+    if (
+        getContext() !== "background" ||
+        !(await getNativePort()) ||
+        !(await hasNativeCapability("watch_config"))
+    ) {
+        throw new Error(
+            "Watching the rc file needs a native messenger that supports it, and the background script.",
+        )
+    }
+    rcListeners.add(listener)
+    extraFiles.forEach(file => rcExtraFiles.add(file))
+    try {
+        await sendNativeMsg("watch_config", { files: extraFiles })
+        rcWatching = true
+    } catch (e) {
+        rcListeners.delete(listener)
+        throw e
+    }
+    return () => {
+        if (!rcListeners.delete(listener) || rcListeners.size > 0) return
+        rcExtraFiles.clear()
+        rcWatching = rcCacheFresh = false
+        sendNativeMsg("unwatch", {}, true)
+    }
+}
+
 export async function getrc(): Promise<string> {
-    const res = await sendNativeMsg("getconfig", {})
+    if (rcCacheFresh) return rcCache.content
+    const changes = rcChanges
+    let res: MessageResp
+    try {
+        res = await sendNativeMsg(
+            "getconfig",
+            rcCache === undefined
+                ? {}
+                : {
+                      if_path: rcCache.path,
+                      if_mtime: rcCache.mtime,
+                      if_size: rcCache.size,
+                  },
+        )
+    } catch (e) {
+        // e.g. an rc that isn't UTF-8
+        if (!(e instanceof NativeCommandError)) throw e
+        res = e.reply
+    }
+    if (res.unchanged) {
+        res = rcCache
+    } else {
+        rcCache = res.mtime !== undefined && res.content ? res : undefined
+    }
+    rcCacheFresh =
+        rcCache !== undefined && rcWatching && rcChanges === changes
 
     if (res.content && !res.error) {
         logger.info(`Successfully retrieved fs config:\n${res.content}`)
@@ -102,7 +560,7 @@ export async function getNativeMessengerVersion(
     const res = await sendNativeMsg("version", {}, quiet)
     if (res === undefined) {
         if (quiet) return undefined
-        throw new Error(`Error retrieving version: ${res.error}`)
+        throw new Error("Error retrieving version: no reply")
     }
     if (res.version && !res.error) {
         logger.info(`Native version: ${res.version}`)
@@ -291,7 +749,31 @@ export async function inpath(cmd) {
     return (await run(pathcmd + cmd.split(" ")[0])).code === 0
 }
 
+/**
+ * Looks up many executables on the native messenger's $PATH in one go.
+ * Returns the ones that were found, in the order given, with the index of
+ * each in `commands` and its absolute path.
+ */
+export async function whichMany(
+    commands: string[],
+): Promise<Array<{ command: string; index: number; path: string }>> {
+    const response = await sendNativeMsg("which_many", { commands })
+    if (response.code !== 0) {
+        throw new Error(`Failed to look up commands: ${response.error}`)
+    }
+    return response.content as unknown as Array<{
+        command: string
+        index: number
+        path: string
+    }>
+}
+
 export async function firstinpath(cmdarray) {
+    if (await hasNativeCapability("which_many")) {
+        const found = await whichMany(cmdarray.map(cmd => cmd.split(" ")[0]))
+        return found.length > 0 ? cmdarray[found[0].index] : undefined
+    }
+
     let ind = 0
     let cmd = cmdarray[ind]
     // Try to find a text editor
@@ -303,41 +785,215 @@ export async function firstinpath(cmdarray) {
     return cmd
 }
 
+async function getEditorCmd(): Promise<string> {
+    return config.get("editorcmd") === "auto"
+        ? getBestEditor()
+        : config.get("editorcmd")
+}
+
 export async function editor(
     file: string,
     line: number,
     col: number,
     content?: string,
 ) {
-    if (content !== undefined) await write(file, content)
-    const editorcmd = (config.get("editorcmd") === "auto"
-        ? await getBestEditor()
-        : config.get("editorcmd")
-    )
+    const editorcmd = (await getEditorCmd())
         .replace(/%l/, line)
         .replace(/%c/, col)
-    let exec
-    if (editorcmd.indexOf("%f") !== -1) {
-        exec = await run(editorcmd.replace(/%f/, file))
-    } else {
-        exec = await run(editorcmd + " " + file)
+    const command =
+        editorcmd.indexOf("%f") !== -1
+            ? editorcmd.replace(/%f/, file)
+            : editorcmd + " " + file
+
+    if (await hasNativeCapability("batch")) {
+        const messages: Record<string, unknown>[] = [
+            { cmd: "run", command, content: "" },
+            { cmd: "read", file },
+        ]
+        if (content !== undefined)
+            messages.unshift({ cmd: "write", file, content })
+        const replies = await batch(messages)
+        if (content !== undefined && replies[0].error) {
+            throw new Error(
+                `Failed to write to '${file}': ${replies[0].error}.`,
+            )
+        }
+        const exec = replies[content !== undefined ? 1 : 0]
+        if (exec.code != 0) return exec
+        return replies[replies.length - 1]
     }
+
+    if (content !== undefined) await write(file, content)
+    const exec = await run(command)
     if (exec.code != 0) return exec
     return read(file)
 }
 
+/**
+ * Writes content to a new temporary file named after prefix, opens it in the
+ * user's editor and returns the reply for the edited file: its path in file
+ * and, if the editor exited with code 0, its new content.
+ *
+ * With a messenger that supports "edit" this is a single native call, which
+ * also reports how long each phase took.
+ *
+ * @param keep Keep the temporary file around afterwards. Older messengers
+ * always keep it.
+ */
+export async function editTemp(
+    content: string,
+    prefix: string,
+    line: number,
+    col: number,
+    keep = false,
+): Promise<MessageResp> {
+    if (await hasNativeCapability("edit")) {
+        const editorcmd = await getEditorCmd()
+        const response = await sendNativeMsg("edit", {
+            content,
+            prefix,
+            editorcmd,
+            line,
+            col,
+            keep,
+        })
+        logger.info(`Editor timings (ms): ${JSON.stringify(response.timings)}`)
+        if (response.error) throw new Error(response.error)
+        return response
+    }
+
+    const file = (await temp(content, prefix)).content
+    return Object.assign({ file }, await editor(file, line, col))
+}
+
+/**
+ * Runs several native messages in one round-trip and returns their replies.
+ * A message may take fields from earlier replies by naming them in refs as
+ * "N.key", e.g. `{ cmd: "read", refs: { file: "0.content" } }` after a
+ * "temp". Nothing else in a message is ever substituted.
+ *
+ * @param stopOnError Skip the remaining messages once one fails.
+ */
+export async function batch(
+    messages: Record<string, unknown>[],
+    stopOnError = true,
+): Promise<MessageResp[]> {
+    const response = await sendNativeMsg("batch", {
+        messages,
+        stop_on_error: stopOnError,
+    })
+    if (response.replies === undefined) {
+        throw new Error(`Native batch failed: ${response.error}`)
+    }
+    return response.replies
+}
+
+export interface ListDirOptions {
+    // If dir isn't a directory, treat its last component as a partially
+    // typed name and use it as the fuzzy filter
+    complete?: boolean
+    // Only names starting with this
+    prefix?: string
+    // Only names containing these letters in order, best matches first
+    fuzzy?: string
+    ignore_case?: boolean
+    sort?: "name" | "mtime" | "size" | "type"
+    limit?: number
+    // Include the size and mtime of each entry. Costs a stat per entry.
+    stat?: boolean
+}
+
+export interface FindFilesOptions {
+    limit?: number
+    // Shell patterns of names not to descend into or list
+    ignore?: string[]
+    max_depth?: number
+    // Cap on the files and directories indexed below each root
+    max_entries?: number
+    // Seconds after which the index is refreshed before answering
+    max_age?: number
+}
+
+// Recently read small files, so that unchanged ones needn't be sent again
+const READ_CACHE_MAX_FILES = 64
+const READ_CACHE_MAX_SIZE = 256 * 1024
+const readCache = new Map<string, MessageResp>()
+
 export async function read(file: string) {
-    return sendNativeMsg("read", { file }).catch(e => {
+    const cached = readCache.get(file)
+    const opts =
+        cached === undefined
+            ? { file }
+            : { file, if_mtime: cached.mtime, if_size: cached.size }
+    const response = await sendNativeMsg("read", opts).catch(e => {
         throw new Error(`Failed to read ${file}. ${e}`)
     })
+    readCache.delete(file)
+    if (response.unchanged && cached !== undefined) {
+        readCache.set(file, cached)
+        return { ...cached }
+    }
+    if (response.code === 0 && response.size <= READ_CACHE_MAX_SIZE) {
+        readCache.set(file, response)
+        if (readCache.size > READ_CACHE_MAX_FILES) {
+            readCache.delete(readCache.keys().next().value)
+        }
+    }
+    return { ...response }
 }
 
-export async function write(file: string, content: string) {
-    const response = await sendNativeMsg("write", { file, content }).catch(
-        e => {
-            throw new Error(`Failed to write '${content}' to '${file}'. ${e}`)
-        },
+/**
+ * Reads length bytes of a file starting at byte offset. The range is cut
+ * short to end on a character boundary: continue from the reply's
+ * next_offset.
+ */
+export async function readRange(file: string, offset: number, length: number) {
+    if (!(await hasNativeCapability("read_range"))) {
+        throw new Error(
+            "Reading part of a file needs a native messenger with read_range support.",
+        )
+    }
+    return sendNativeMsg("read", { file, offset, length }).catch(e => {
+        throw new Error(`Failed to read ${file}. ${e}`)
+    })
+}
+
+/**
+ * Yields the content of a file in chunks of at most chunkSize bytes, so
+ * that files bigger than native messaging's size limit can be read. The
+ * generator returns the final reply, with the file's size and mtime.
+ *
+ * Only works in the background script.
+ */
+export async function* readChunks(
+    file: string,
+    chunkSize = 64 * 1024,
+): AsyncGenerator<string, MessageResp> {
+    const replies = streamNativeMsg(
+        "read",
+        { file, chunk_size: chunkSize },
+        "read_range",
     )
+    let reply = await replies.next()
+    while (!reply.done) {
+        yield reply.value.content
+        reply = await replies.next()
+    }
+    return reply.value
+}
+
+export interface WriteOptions {
+    // Add content to the end of the file instead of replacing it
+    append?: boolean
+    // Wait until the content has reached the disk
+    fsync?: boolean
+}
+
+// Contents longer than this (in UTF-16 code units) are sent in chunks of at
+// most this size
+const WRITE_CHUNK_SIZE = 256 * 1024
+
+function checkWrite(file: string, response: MessageResp) {
     if (response.error || (response.code != null && response.code !== 0)) {
         const error =
             response.error || `native messenger returned code ${response.code}`
@@ -346,6 +1002,66 @@ export async function write(file: string, content: string) {
     return response
 }
 
+/**
+ * Writes content to file. Messengers with "write_v2" replace the file
+ * atomically, so that it is either left alone or completely written, and
+ * reply with the size and SHA-256 of what they wrote. They also take
+ * WriteOptions and large contents in chunks.
+ */
+export async function write(
+    file: string,
+    content: string,
+    opts: WriteOptions = {},
+) {
+    if (
+        content.length > WRITE_CHUNK_SIZE &&
+        (await hasNativeCapability("write_v2"))
+    ) {
+        return writeChunked(file, content, opts)
+    }
+    const response = await sendNativeMsg("write", {
+        file,
+        content,
+        ...opts,
+    }).catch(e => {
+        throw new Error(`Failed to write '${content}' to '${file}'. ${e}`)
+    })
+    return checkWrite(file, response)
+}
+
+async function writeChunked(file: string, content: string, opts: WriteOptions) {
+    const begin = checkWrite(
+        file,
+        await sendNativeMsg("write_begin", { file, ...opts }),
+    )
+    const session = begin.session
+    const encoder = new TextEncoder()
+    try {
+        let offset = 0
+        for (let start = 0; start < content.length; ) {
+            let end = Math.min(start + WRITE_CHUNK_SIZE, content.length)
+            // Don't split a surrogate pair
+            const last = content.charCodeAt(end - 1)
+            if (end < content.length && last >= 0xd800 && last < 0xdc00) end--
+            const chunk = content.slice(start, end)
+            checkWrite(
+                file,
+                await sendNativeMsg("write_chunk", {
+                    session,
+                    content: chunk,
+                    offset,
+                }),
+            )
+            offset += encoder.encode(chunk).length
+            start = end
+        }
+    } catch (e) {
+        await sendNativeMsg("write_abort", { session }, true)
+        throw e
+    }
+    return checkWrite(file, await sendNativeMsg("write_commit", { session }))
+}
+
 export async function writerc(file: string, force: boolean, content: string) {
     return sendNativeMsg("writerc", { file, force, content }).catch(e => {
         throw new Error(`Failed to write '${content}' to '${file}'. ${e}`)
@@ -386,12 +1102,69 @@ export async function move(
 
 }
 
-export async function listDir(dir: string) {
-    return sendNativeMsg("list_dir", { path: dir }).catch(e => {
+/**
+ * Lists a directory, or the directory containing dir if it isn't one.
+ *
+ * Messengers with "list_dir_v2" can filter, sort and cap the listing
+ * themselves; see ListDirOptions. Older ones ignore the options and return
+ * every name.
+ */
+export async function listDir(dir: string, opts: ListDirOptions = {}) {
+    return sendNativeMsg("list_dir", { path: dir, ...opts }).catch(e => {
         throw new Error(`Failed to read directory '${dir}'. ${e}`)
     })
 }
 
+/**
+ * Fuzzily finds files anywhere below roots, best matches first.
+ *
+ * The part of query after its last "/" is matched against file names, the
+ * part before it against their directories. Needs "find_files".
+ *
+ * The messenger keeps an index of each root under ~/.tridactyl/index,
+ * building it on first use and refreshing it when it gets older than
+ * max_age.
+ */
+export async function findFiles(
+    query: string,
+    roots: string[],
+    opts: FindFilesOptions = {},
+) {
+    const resp = await sendNativeMsg("find_files", { query, roots, ...opts })
+    return resp
+}
+
+/**
+ * The native messenger's counters, latency histograms and payload sizes per
+ * command, and counts and durations of the processes it ran, since it
+ * started or was last reset. Needs "stats".
+ *
+ * Only interesting with a messenger that outlives a message, i.e. over the
+ * persistent port or in daemon mode.
+ */
+export async function getNativeStats(reset = false) {
+    return sendNativeMsg("stats", { reset })
+}
+
+/**
+ * Turn the native messenger's structured log on (at path, or
+ * ~/.tridactyl/native_main.log) or off. Returns the log's path.
+ */
+export async function setNativeLog(enabled: boolean, path?: string) {
+    return (await sendNativeMsg("log", { enabled, path })).path
+}
+
+/**
+ * (Re)builds the file indexes of roots now, e.g. ahead of findFiles.
+ */
+export async function indexFiles(
+    roots: string[],
+    opts: Omit<FindFilesOptions, "limit" | "max_age"> = {},
+) {
+    const resp = await sendNativeMsg("index", { roots, ...opts })
+    return resp
+}
+
 export async function winFirefoxRestart(
     profiledir: string,
     browsercmd: string,
@@ -407,20 +1180,150 @@ export async function winFirefoxRestart(
     return sendNativeMsg("win_firefox_restart", { profiledir, browsercmd })
 }
 
-export async function run(command: string, content = "") {
-    const msg = await sendNativeMsg("run", { command, content })
+export interface RunOptions {
+    // Kill the command, and whatever it started, after this many seconds
+    timeout?: number
+    // Kill it once it has written more than this many bytes
+    maxBytes?: number
+    // Kill it when this is aborted. Only works in the background script.
+    signal?: AbortSignal
+}
+
+/**
+ * Runs command, a shell command line or, to skip the shell, an argv list,
+ * and returns its output and exit code. If the command was killed, the
+ * reply says why: timed_out, truncated or cancelled.
+ *
+ * Options and argv lists need a messenger with "run_v2".
+ */
+export async function run(
+    command: string | string[],
+    content = "",
+    opts: RunOptions = {},
+) {
+    if (Array.isArray(command) && !(await hasNativeCapability("run_v2"))) {
+        throw new Error(
+            "Running a command without a shell needs a newer native messenger.",
+        )
+    }
+    const msg = await sendNativeMsg(
+        "run",
+        {
+            command,
+            content,
+            timeout: opts.timeout,
+            max_bytes: opts.maxBytes,
+        },
+        false,
+        opts.signal,
+    )
     logger.info(msg)
     return msg
 }
 
-export async function runAsync(command: string) {
+export interface RunStreamChunk {
+    stream: "stdout" | "stderr"
+    content: string
+}
+
+/**
+ * Like run(), but yields the command's output as it arrives instead of
+ * buffering all of it, so the output isn't bound by native messaging's
+ * message size limit. The generator returns the final reply, whose code is
+ * the command's exit code.
+ *
+ * Needs the persistent port, so it only works in the background script.
+ *
+ * @param opts.stderr Also capture stderr, as chunks with stream "stderr".
+ * @param opts.maxBytes Kill the command after this much output.
+ */
+export async function* runStream(
+    command: string,
+    content = "",
+    opts: { stderr?: boolean; maxBytes?: number } = {},
+): AsyncGenerator<RunStreamChunk, MessageResp> {
+    const replies = streamNativeMsg("run_stream", {
+        command,
+        content,
+        stderr: opts.stderr ?? false,
+        max_bytes: opts.maxBytes,
+    })
+    let reply = await replies.next()
+    while (!reply.done) {
+        yield { stream: reply.value.stream, content: reply.value.content }
+        reply = await replies.next()
+    }
+    logger.info(reply.value)
+    return reply.value
+}
+
+/**
+ * Starts command in the background without waiting for it. With a
+ * messenger that has "run_async" job support, returns the job's id, for
+ * use with jobStatus, jobOutput and waitForJob.
+ *
+ * @param opts.cwd Directory to run command in, by default the home
+ * directory.
+ * @param opts.maxOutput Bytes of output the messenger keeps around.
+ */
+export async function runAsync(
+    command: string,
+    opts: { cwd?: string; maxOutput?: number } = {},
+): Promise<number | undefined> {
     const required_version = "0.3.1"
-    if (!await nativegate(required_version, false)) {
+    if (
+        !(await hasNativeCapability("run_async")) &&
+        !(await nativegate(required_version, false))
+    ) {
         throw new Error(
             `runAsync needs native messenger version >= ${required_version}.`,
         )
     }
-    logger.info(await sendNativeMsg("run_async", { command }))
+    const resp = await sendNativeMsg("run_async", {
+        command,
+        cwd: opts.cwd,
+        max_output: opts.maxOutput,
+    })
+    logger.info(resp)
+    return resp.job
+}
+
+async function jobMsg(
+    cmd: "job_status" | "job_output" | "job_wait",
+    opts: Record<string, unknown>,
+) {
+    if (!(await hasNativeCapability("run_async"))) {
+        throw new Error(
+            "Background jobs need a native messenger with run_async support.",
+        )
+    }
+    return sendNativeMsg(cmd, opts)
+}
+
+/**
+ * The state of a job started by runAsync: "running", "exited" (with its
+ * exit code) or "lost". Without a job, the states of all jobs the
+ * messenger still knows about, in jobs.
+ */
+export async function jobStatus(job?: number) {
+    return jobMsg("job_status", { job })
+}
+
+/**
+ * Up to length bytes of a job's output (stdout and stderr together),
+ * starting at byte offset. Continue from the reply's next_offset; eof is
+ * set once the job is over and everything has been read.
+ */
+export async function jobOutput(job: number, offset = 0, length?: number) {
+    return jobMsg("job_output", { job, offset, length })
+}
+
+/**
+ * Waits up to timeout seconds for a job to end and returns its state,
+ * with timed_out set if it's still running.
+ */
+export async function waitForJob(job: number, timeout = 30) {
+    return jobMsg("job_wait", { job, timeout })
 }
 
 /** Evaluates a string in the native messenger. This has to be python code. If
@@ -432,26 +1335,112 @@ export async function pyeval(command: string): Promise<MessageResp> {
     return sendNativeMsg("eval", { command })
 }
 
+// The messenger's environment is Firefox's, so it won't change under us:
+// variables read once are kept for the rest of the session. Unset ones are
+// cached as null.
+const envCache = new Map<string, string | null>()
+type EnvVars = Record<string, string | null>
+
+// Read along with the first variable asked for, as they are often wanted
+const COMMON_ENV_VARS = [
+    "HOME",
+    "APPDATA",
+    "EDITOR",
+    "VISUAL",
+    "TERM",
+    "BROWSER",
+    "XDG_CONFIG_HOME",
+    "XDG_DATA_HOME",
+    "XDG_RUNTIME_DIR",
+]
+
 export async function getenv(variable: string) {
     const required_version = "0.1.2"
 
+    if (envCache.has(variable)) return envCache.get(variable) ?? ""
+    if (await hasNativeCapability("env_many")) {
+        const vars =
+            envCache.size === 0 ? [variable, ...COMMON_ENV_VARS] : [variable]
+        return (await getenvMany(vars))[variable] ?? ""
+    }
+
     if (!(await nativegate(required_version, false))) {
         throw new Error(
             `'getenv' needs native messenger version >= ${required_version}.`,
         )
     }
 
-    return (await sendNativeMsg("env", { var: variable })).content
+    const value = (await sendNativeMsg("env", { var: variable })).content
+    envCache.set(variable, value || null)
+    return value
+}
+
+/**
+ * The values of many environment variables (null if unset), read in one
+ * message. Needs "env_many".
+ */
+export async function getenvMany(variables: string[]): Promise<EnvVars> {
+    const missing = variables.filter(v => !envCache.has(v))
+    if (missing.length > 0) {
+        const resp = await sendNativeMsg("env_many", { vars: missing })
+        const content = resp.content as unknown as EnvVars
+        for (const v of missing) envCache.set(v, content[v] ?? null)
+    }
+    return Object.fromEntries(variables.map(v => [v, envCache.get(v)]))
+}
+
+/**
+ * The messenger's environment variables whose names match one of the
+ * shell patterns in match, e.g. ["XDG_*"]. Needs "env_many".
+ */
+export async function getenvSnapshot(
+    match: string[] = ["*"],
+): Promise<Record<string, string>> {
+    const resp = await sendNativeMsg("env_snapshot", { match })
+    const content = resp.content as unknown as Record<string, string>
+    for (const [v, value] of Object.entries(content)) envCache.set(v, value)
+    return content
+}
+
+/**
+ * Expands ~ and $VARIABLES in paths the way the messenger's
+ * os.path.expanduser and os.path.expandvars do, in one message. Needs
+ * "env_many".
+ */
+export async function expandPaths(paths: string[]): Promise<string[]> {
+    const resp = await sendNativeMsg("env_many", { vars: [], paths })
+    return resp.paths
 }
 
-/** Calls an external program, to either set or get the content of the X selection.
- *  When setting the selection or if getting it failed, will return an empty string.
- **/
+/**
+ * Gets or sets the primary selection (or, with selection "clipboard", the
+ * clipboard) with externalclipboardcmd.
+ *
+ * If that's "auto" and the messenger has "clipboard", it picks the tool and
+ * runs it itself, without a shell. Otherwise only the primary selection is
+ * available.
+ */
 export async function clipboard(
     action: "set" | "get",
     str: string,
+    selection: "primary" | "clipboard" = "primary",
 ): Promise<string> {
     let clipcmd = await config.get("externalclipboardcmd")
+    if (clipcmd === "auto" && (await hasNativeCapability("clipboard"))) {
+        const result = await sendNativeMsg("clipboard", {
+            action,
+            content: str,
+            selection,
+        })
+        if (result.code !== 0) {
+            const command = (result.argv ?? [result.backend]).join(" ")
+            const why = result.timed_out ? " (timed out)" : ""
+            throw new Error(
+                `External command failed with code ${result.code}${why}: ${command}`,
+            )
+        }
+        return result.content
+    }
     if (clipcmd === "auto") clipcmd = await firstinpath(["xsel", "xclip"])
 
     if (clipcmd === undefined) {
@@ -532,6 +1521,17 @@ Get-CimInstance -Property CommandLine,ProcessId -ClassName Win32_Process \
 "`
             )
         }
+    } else if (await hasNativeCapability("proc_cmdline")) {
+        // Already split properly, arguments with spaces and all
+        try {
+            const argv = await sendNativeMsg("proc_cmdline", {})
+            return argv.content as unknown as string[]
+        } catch (e) {
+            if (!(e instanceof NativeCommandError)) throw e
+            throw new Error(
+                `Couldn't read Firefox's command line: ${e.reply.error}`,
+            )
+        }
     } else {
         const actualVersion = await getNativeMessengerVersion()
 
@@ -610,6 +1610,14 @@ export async function getFirefoxDir() {
 }
 
 export async function getProfileUncached() {
+    if (await hasNativeCapability("detect_profile")) {
+        // All of the below in one message
+        const resp = await sendNativeMsg("detect_profile", {
+            profiledir: config.get("profiledir"),
+        })
+        logger.info(`Found profile from ${resp.how}`)
+        return resp.profile
+    }
     const ffDir = await getFirefoxDir()
     const iniPath = ffDir + "profiles.ini"
     let iniObject = {}
@@ -242,7 +242,9 @@ export async function launchProfile(profileName: string): Promise<void> {
     const result = await Native.run(cmd)
 
     if (result.code !== 0) {
-        throw new Error(`Failed to launch Firefox: ${result.error}`)
+        throw new Error(
+            `Failed to launch Firefox (exit code ${result.code}): ${result.content}`,
+        )
     }
 }
 
@@ -269,7 +271,9 @@ export async function createProfile(profileName: string): Promise<void> {
     )
 
     if (result.code !== 0) {
-        throw new Error(`Failed to create profile: ${result.error}`)
+        throw new Error(
+            `Failed to create profile (exit code ${result.code}): ${result.content}`,
+        )
     }
 }
 